@@ -0,0 +1,179 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, threading, time
+
+__all__ = ('PendingSnapshotLimiter', )
+log = logging.getLogger(__name__)
+
+class PendingSnapshotLimiter(object):
+    ''' Keeps at most limit snapshots pending in an account and region, and at
+    most per_volume pending for any one volume.
+
+    Workers call acquire(volume_id) before CreateSnapshot, then started() with
+    the new snapshot's id, or release() if it was not created. acquire() blocks
+    while there is no room. One blocked worker at a time describes the pending
+    snapshots, batch_size ids per call, and frees the slots of those no longer
+    pending. Polls are min_interval apart, growing by half up to max_interval
+    while nothing finishes.
+
+    limit_exceeded() lowers the limit to what is in flight when EC2 turns a
+    snapshot away with SnapshotLimitExceeded, so the rest queue instead of
+    retrying '''
+
+    # DescribeSnapshots is eventually consistent, so a new snapshot may be
+    # missing from a poll or two before it shows up
+    missing_polls = 2
+
+    def __init__(self, describe, limit, per_volume=1, min_interval=5.0, max_interval=60.0, batch_size=200):
+        self._describe = describe
+        self.limit = max(1, limit)
+        self.per_volume = max(1, per_volume)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._volumes = {}
+        self._missing = {}
+        self._reserved = 0
+        self._polling = False
+        self._interval = None
+        self._next_poll = 0.0
+        self.peak = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.polls = 0
+        self.calls = 0
+        self.lowered = 0
+
+    def seed(self, snapshots):
+        ''' Counts snapshots already pending, e.g. from an earlier run, as in flight '''
+        with self._cond:
+            for snapshot in snapshots:
+                self._add(snapshot.id, snapshot.volume_id)
+            self.peak = max(self.peak, self.in_flight)
+        return len(self._pending)
+
+    @property
+    def in_flight(self):
+        return len(self._pending) + self._reserved
+
+    def _add(self, snapshot_id, volume_id):
+        if snapshot_id not in self._pending:
+            self._pending[snapshot_id] = volume_id
+            self._volumes[volume_id] = self._volumes.get(volume_id, 0) + 1
+
+    def _remove(self, snapshot_id):
+        volume_id = self._pending.pop(snapshot_id, None)
+        self._missing.pop(snapshot_id, None)
+        if volume_id is not None:
+            self._volume_done(volume_id)
+
+    def _volume_done(self, volume_id):
+        count = self._volumes.get(volume_id, 0) - 1
+        if count > 0:
+            self._volumes[volume_id] = count
+        else:
+            self._volumes.pop(volume_id, None)
+
+    def _has_room(self, volume_id):
+        if not self.in_flight:
+            return True
+        return self.in_flight < self.limit and self._volumes.get(volume_id, 0) < self.per_volume
+
+    def acquire(self, volume_id):
+        ''' Blocks until a snapshot of volume_id may be started, and reserves its slot '''
+        waited_from = None
+        with self._cond:
+            while not self._has_room(volume_id):
+                if waited_from is None:
+                    waited_from = time.time()
+                    self.waits += 1
+                if self._polling:
+                    self._cond.wait(self.max_interval)
+                    continue
+                delay = self._next_poll - time.time()
+                if delay > 0:
+                    # A finished create or release wakes us sooner
+                    self._cond.wait(delay)
+                    continue
+                self._poll()
+            self._reserved += 1
+            self._volumes[volume_id] = self._volumes.get(volume_id, 0) + 1
+            self.peak = max(self.peak, self.in_flight)
+            if waited_from is not None:
+                self.wait_seconds += time.time() - waited_from
+
+    def _poll(self):
+        ''' Frees the slots of snapshots that are no longer pending. Called with
+        the lock held, which is let go during the describe calls '''
+        self._polling = True
+        ids = sorted(self._pending)
+        seen = {}
+        self._cond.release()
+        try:
+            for i in range(0, len(ids), self.batch_size):
+                self.calls += 1
+                for snapshot in self._describe(ids[i:i + self.batch_size]):
+                    seen[snapshot.id] = snapshot.status
+        finally:
+            self._cond.acquire()
+            self._polling = False
+            self._cond.notify_all()
+        self.polls += 1
+        finished = 0
+        for snapshot_id in ids:
+            status = seen.get(snapshot_id)
+            if status is None:
+                self._missing[snapshot_id] = self._missing.get(snapshot_id, 0) + 1
+                if self._missing[snapshot_id] < self.missing_polls:
+                    continue
+            elif status == 'pending':
+                continue
+            self._remove(snapshot_id)
+            finished += 1
+        if finished:
+            log.debug('%d pending snapshots finished, %d still in flight', finished, self.in_flight)
+        if finished or self._interval is None:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self._interval * 1.5, self.max_interval)
+        self._next_poll = time.time() + self._interval
+
+    def started(self, volume_id, snapshot_id):
+        ''' Turns the slot reserved for volume_id into a pending snapshot '''
+        with self._cond:
+            self._reserved -= 1
+            self._pending[snapshot_id] = volume_id
+
+    def release(self, volume_id):
+        ''' Gives back a slot reserved for a snapshot that was not created '''
+        with self._cond:
+            self._reserved -= 1
+            self._volume_done(volume_id)
+            self._cond.notify_all()
+
+    def limit_exceeded(self):
+        ''' Lowers the limit to what is in flight, after EC2 refused a snapshot.
+        Returns False when nothing is in flight to wait for '''
+        with self._cond:
+            in_flight = len(self._pending)
+            if not in_flight:
+                return False
+            if in_flight < self.limit:
+                log.warning('EC2 refused a snapshot with %d pending, lowering the pending snapshot limit from %d',
+                    in_flight, self.limit)
+                self.limit = in_flight
+                self.lowered += 1
+            return True
@@ -0,0 +1,151 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, os, threading, time
+
+from retention import parse_timestamp
+
+__all__ = ('ChangeDetector', 'DetachedSignal', 'WriteActivitySignal', 'ChangedBlocksSignal', 'local_changed_blocks',
+    'latest_snapshot')
+log = logging.getLogger(__name__)
+
+def latest_snapshot(records):
+    ''' The newest of a volume's snapshot records that did not fail, or None '''
+    records = [r for r in records if r.status != 'error']
+    return max(records, key=lambda r: r.start_time) if records else None
+
+class _JsonFile(object):
+    ''' A JSON object read from path, read again whenever the file changes '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._data = {}
+
+    def get(self):
+        ''' (data, mtime), or ({}, None) when the file cannot be read '''
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            log.warning('Cannot read %s: %s', self.path, e)
+            return {}, None
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path) as f:
+                        data = json.load(f)
+                    self._data = data if isinstance(data, dict) else {}
+                except (IOError, ValueError) as e:
+                    log.warning('Cannot read %s: %s', self.path, e)
+                    self._data = {}
+                self._mtime = mtime
+            return self._data, self._mtime
+
+class DetachedSignal(object):
+    ''' Nothing can write to a volume that is detached now and was detached
+    when its last snapshot was taken. Snapshot descriptions name the instance
+    a volume was attached to, so no extra calls are needed '''
+
+    name = 'detached'
+
+    def changed(self, volume, last):
+        if volume.attach_data.instance_id:
+            return None
+        parts = (last.description or '').split()
+        # Attached at the last snapshot, and perhaps written before it was detached
+        return any(part.startswith('i-') for part in parts[1:])
+
+class WriteActivitySignal(object):
+    ''' Reads when each volume was last written from a JSON file kept up to
+    date by something watching the volumes, e.g. {"vol-1": "2015-01-31T12:00:00Z"}
+    or epoch seconds. Says nothing about volumes missing from the file, or
+    when the file has not been written since the last snapshot '''
+
+    name = 'write-activity'
+
+    def __init__(self, path):
+        self._file = _JsonFile(path)
+
+    def changed(self, volume, last):
+        activity, mtime = self._file.get()
+        last_write = activity.get(volume.id)
+        started = parse_timestamp(last.start_time)
+        if last_write is None or mtime is None or mtime < started:
+            return None
+        try:
+            last_write = float(last_write) if isinstance(last_write, (int, float)) else parse_timestamp(last_write)
+        except (TypeError, ValueError):
+            return None
+        return last_write >= started
+
+class ChangedBlocksSignal(object):
+    ''' Asks changed_blocks(volume_id, snapshot_id) how many blocks of the
+    volume changed since the snapshot, which it may not know (None). Changes
+    of up to threshold blocks count as unchanged '''
+
+    name = 'changed-blocks'
+
+    def __init__(self, changed_blocks, threshold=0):
+        self._changed_blocks = changed_blocks
+        self.threshold = threshold
+
+    def changed(self, volume, last):
+        count = self._changed_blocks(volume.id, last.id)
+        if count is None:
+            return None
+        return count > self.threshold
+
+def local_changed_blocks(path):
+    ''' A changed_blocks for ChangedBlocksSignal that stands in for the EBS
+    direct APIs, reading counts from a JSON file such as
+    {"vol-1": {"since": "snap-1", "changed_blocks": 0}}. Counts since any
+    other snapshot are ignored '''
+    source = _JsonFile(path)
+    def changed_blocks(volume_id, snapshot_id):
+        entry = source.get()[0].get(volume_id)
+        if not isinstance(entry, dict) or entry.get('since') != snapshot_id:
+            return None
+        try:
+            return int(entry['changed_blocks'])
+        except (KeyError, TypeError, ValueError):
+            return None
+    return changed_blocks
+
+class ChangeDetector(object):
+    ''' Decides whether a volume needs a new snapshot, given its last one.
+    It does unless a signal reports it unchanged and none reports it changed.
+    Volumes without a snapshot, or whose last one is max_interval seconds old,
+    are always snapshotted '''
+
+    def __init__(self, signals, max_interval=7 * 86400, clock=time.time):
+        self.signals = list(signals)
+        self.max_interval = max_interval
+        self._clock = clock
+
+    def decide(self, volume, last):
+        ''' Returns (snapshot, reason) '''
+        if last is None:
+            return True, 'no earlier snapshot'
+        if self._clock() - parse_timestamp(last.start_time) >= self.max_interval:
+            return True, 'last snapshot too old'
+        unchanged = None
+        for signal in self.signals:
+            changed = signal.changed(volume, last)
+            if changed:
+                return True, signal.name
+            if changed is False and unchanged is None:
+                unchanged = signal.name
+        if unchanged:
+            return False, unchanged
+        return True, 'no signal'
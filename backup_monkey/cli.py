@@ -13,14 +13,25 @@
 # limitations under the License.
 
 import argparse
+import copy
+import json
 import logging
+import os
+import signal
 import sys
 
-from core import BackupMonkey, Logging
 from __init__ import __version__
+from changes import ChangeDetector, ChangedBlocksSignal, DetachedSignal, WriteActivitySignal, local_changed_blocks
 from exception import BackupMonkeyException
+from identity import DiskCache, default_cache_dir, instance_identity
+from planning import read_plan, write_plan
+from splunk_logging import SplunkLogging
+from retention import OVERRIDE_TAG, RetentionPolicy, parse_age
+from selection import Selection
 
-from boto.utils import get_instance_metadata
+# boto, and the modules that need it, are imported once the arguments have
+# been checked, so --help, --version and mistakes on the command line are
+# answered without loading it
 
 __all__ = ('run', )
 log = logging.getLogger(__name__)
@@ -29,12 +40,49 @@ def _fail(message="Unknown failure", code=1):
     log.error(message)
     sys.exit(code)
 
-def run():
+def _write_metrics(metrics, prom_path, json_path):
+    try:
+        if prom_path:
+            metrics.write_prometheus(prom_path)
+        if json_path:
+            metrics.write_json(json_path)
+    except (IOError, OSError) as e:
+        log.error('Cannot write metrics: %s', e)
+
+def _load_accounts_manifest(path, default_role=None):
+    ''' Reads the accounts manifest, returns a list of dicts with account, role and regions keys '''
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise ValueError('expected a list of accounts')
+    accounts = []
+    for entry in manifest:
+        account = str(entry.get('account', '')).strip()
+        role = entry.get('role', default_role)
+        if not account or not role:
+            raise ValueError('every account needs an "account" and a "role" (or pass --cross-account-role): %s' % entry)
+        regions = entry.get('regions') or []
+        if isinstance(regions, basestring):
+            regions = [r.strip() for r in regions.split(',') if r.strip()]
+        accounts.append({'account': account, 'role': role, 'regions': regions})
+    return accounts
+
+def _parser():
     parser = argparse.ArgumentParser(description='Loops through all EBS volumes, and snapshots them, then loops through all snapshots, and removes the oldest ones.')
     parser.add_argument('--region', metavar='REGION',
                         help='the region to loop through and snapshot (default is current region of EC2 instance this is running on). E.g. us-east-1')
-    parser.add_argument('--max-snapshots-per-volume', metavar='SNAPSHOTS', default=14, type=int,
-                        help='the maximum number of snapshots to keep per EBS volume. The oldest snapshots will be deleted. Default: 3')
+    parser.add_argument('--regions', metavar='REGIONS',
+                        help='a comma separated list of regions to loop through in parallel. E.g. us-east-1,eu-west-1')
+    parser.add_argument('--all-regions', action='store_true', default=False,
+                        help='loop through every EC2 region in parallel')
+    parser.add_argument('--parallel-regions', metavar='N', type=int,
+                        help='the maximum number of regions (or account and region pairs when using --accounts-manifest) to work on at the same time. Default: all of them')
+    parser.add_argument('--max-snapshots-per-volume', metavar='SNAPSHOTS', type=int,
+                        help='the maximum number of snapshots to keep per EBS volume. The oldest snapshots will be deleted. Default: 14, or 0 when --retention is given')
+    parser.add_argument('--retention', metavar='SPEC',
+                        help='grandfather-father-son retention, kept on top of --max-snapshots-per-volume. E.g. 7d4w12m keeps the newest snapshot of each of the last 7 days, 4 weeks and 12 months. A volume tag `%s` overrides this per volume' % OVERRIDE_TAG)
+    parser.add_argument('--max-age', metavar='AGE',
+                        help='delete snapshots older than this, whatever the retention policy. E.g. 400d, 52w or 1y')
     parser.add_argument('--snapshot-only', action='store_true', default=False,
                         help='Only snapshot EBS volumes, do not remove old snapshots')
     parser.add_argument('--remove-only', action='store_true', default=False,
@@ -47,13 +95,78 @@ def run():
                         help='Only snapshot instances that match passed in tags. E.g. --tag Name:foo will snapshot all instances with a tag `Name` and value is `foo`')
     parser.add_argument('--reverse-tags', action='store_true', default=False,
                         help='Do a reverse match on the passed in tags. E.g. --tag Name:foo --reverse-tags will snapshot all instances that do not have a `Name` tag with the value `foo`')
+    parser.add_argument('--select', metavar='EXPR',
+                        help='only snapshot volumes whose tags match EXPR, combining key=value (with * and ? wildcards), key!=value, has:key and missing:key with AND, OR, NOT and parentheses. E.g. --select "env=prod AND (team=db* OR has:Backup) AND missing:NoBackup". Combined with --tags when both are given')
     parser.add_argument('--cross-account-number', action='store',
                         help='Do a cross-account snapshot (this is the account number to do snapshots on). NOTE: This requires that you pass in the --cross-account-role parameter. E.g. --cross-account-number 111111111111 --cross-account-role Snapshot')
     parser.add_argument('--cross-account-role', action='store',
                         help='The name of the role that backup-monkey will assume when doing a cross-account snapshot. E.g. --cross-account-role Snapshot')
+    parser.add_argument('--require-marker-tag', action='store_true', default=False,
+                        help='Only remove snapshots carrying the BackupMonkey tag written when they were created. Snapshots made by older versions do not have this tag')
+    parser.add_argument('--accounts-manifest', metavar='PATH',
+                        help='a JSON file listing the accounts to work on, e.g. [{"account": "111111111111", "role": "Snapshot", "regions": ["us-east-1"]}]. Accounts without regions use the regions given on the command line')
+    parser.add_argument('--page-size', metavar='N', default=500, type=int,
+                        help='the number of volumes or snapshots to fetch per API call. Work starts as soon as the first page arrives. Default: 500')
+    parser.add_argument('--workers', metavar='N', default=1, type=int,
+                        help='the number of volumes to snapshot concurrently. Default: 1')
+    parser.add_argument('--delete-workers', metavar='N', type=int,
+                        help='the number of old snapshots to delete concurrently. Default: same as --workers')
+    parser.add_argument('--max-pending', metavar='N', type=int,
+                        help='keep at most N snapshots pending per account and region, counting those already pending, and queue the rest until earlier ones complete. Default: no limit')
+    parser.add_argument('--max-pending-per-volume', metavar='N', type=int, default=1,
+                        help='with --max-pending, the most snapshots of one volume that may be pending at once. Default: 1')
+    parser.add_argument('--retry-budget', metavar='RETRIES', type=int,
+                        help='the maximum number of throttled or failed API calls to retry during the whole run. Default: unlimited')
+    parser.add_argument('--plan', metavar='PATH',
+                        help='work out the snapshots to create and delete without changing anything, and write them to PATH as JSON along with the predicted API calls and duration')
+    parser.add_argument('--apply', metavar='PLAN',
+                        help='create and delete the snapshots listed in a plan written by --plan, without looking up volumes or snapshots again')
+    parser.add_argument('--log-format', choices=SplunkLogging.formats, default='kv',
+                        help='write the Splunk event log as key=value lines (kv) or as JSON lines (json). Default: kv')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='when the run finishes, write API call counts, errors, latencies, throttles and phase timings to PATH as a Prometheus textfile')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help='when the run finishes, write the same metrics as --metrics-prom to PATH as JSON')
+    parser.add_argument('--state-db', metavar='PATH',
+                        help='a SQLite database remembering the volumes and snapshots seen by earlier runs, so old snapshots can be found without listing them all again')
+    parser.add_argument('--state-db-max-age', metavar='AGE', default='1d',
+                        help='list every snapshot again once the --state-db listing is older than this. Default: 1d')
+    parser.add_argument('--wait', action='store_true', default=False,
+                        help='after creating snapshots, wait for them to complete and report how long each took. Old snapshots are only removed if none of the new ones failed')
+    parser.add_argument('--wait-timeout', metavar='AGE', default='2h',
+                        help='stop waiting for snapshots still pending after this long. Default: 2h')
+    parser.add_argument('--instance-snapshots', action='store_true', default=False,
+                        help='snapshot the selected volumes of each instance together, with one crash-consistent CreateSnapshots call that also tags them. Detached volumes, and volumes alone on their instance, are snapshotted one at a time')
+    parser.add_argument('--copy-to', metavar='REGIONS',
+                        help='a comma separated list of regions to copy new snapshots to once they complete, e.g. for disaster recovery. Copies keep the snapshot\'s tags, and old copies are removed by the same retention policy. Implies --wait')
+    parser.add_argument('--max-copies', metavar='N', type=int, default=5,
+                        help='with --copy-to, the most copies in progress at once in each destination region. Default: 5')
+    parser.add_argument('--skip-unchanged', action='store_true', default=False,
+                        help='do not snapshot volumes that have not changed since their last snapshot: volumes detached then and now, and volumes --write-activity or --changed-blocks report unchanged')
+    parser.add_argument('--write-activity', metavar='PATH',
+                        help='with --skip-unchanged, a JSON file of when each volume was last written, e.g. {"vol-1": "2015-01-31T12:00:00Z"}')
+    parser.add_argument('--changed-blocks', metavar='PATH',
+                        help='with --skip-unchanged, a JSON file of how many blocks of each volume changed since a snapshot, e.g. {"vol-1": {"since": "snap-1", "changed_blocks": 0}}')
+    parser.add_argument('--max-unchanged-age', metavar='AGE', default='7d',
+                        help='with --skip-unchanged, snapshot volumes anyway once their last snapshot is older than this. Default: 7d')
+    parser.add_argument('--journal-dir', metavar='DIR',
+                        help='journal the snapshots each run creates, tags and deletes to a file per account and region in DIR, so a run that dies part way can be resumed with --resume')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue the last run the --journal-dir journal has unfinished, skipping the work it did, instead of starting over')
 
-    args = parser.parse_args()
+    parser.add_argument('--cache-dir', metavar='DIR', default=default_cache_dir(),
+                        help='where to remember the region and account found from the instance metadata when --region is not given. Default: ~/.cache/backup-monkey')
+    parser.add_argument('--cache-ttl', metavar='AGE', default='1d',
+                        help='look the region and account up again once they are older than this; 0h turns the cache off. Default: 1d')
+    parser.add_argument('--daemon', metavar='JOBS',
+                        help='keep running, and run the jobs listed in the JSON file JOBS on their own cron schedules, e.g. {"jobs": [{"name": "prod", "schedule": "0 */6 * * *", "args": ["--select", "env=prod"]}]}. Each job\'s args are added to the command line. Connections and assumed roles are kept between runs, and a job is never run twice at once')
+    parser.add_argument('--listen', metavar='HOST:PORT', default='127.0.0.1:8321',
+                        help='with --daemon, serve /health, /jobs and /metrics on this address. Default: 127.0.0.1:8321')
+    return parser
 
+def _check_args(parser, args):
+    ''' Validates args, and adds the retention policy, accounts, plans and
+    other values worked out from them '''
     if args.cross_account_number and not args.cross_account_role:
         parser.error('The --cross-account-role parameter is required if you specify --cross-account-number (doing a cross-account snapshot)')
 
@@ -63,35 +176,299 @@ def run():
     if args.reverse_tags and not args.tags:
         parser.error('The --tags parameter is required if you specify --reverse-tags (doing a blacklist filter)')
 
-    Logging().configure(args.verbose, __name__)
+    try:
+        Selection.compile(args.select, args.tags, args.reverse_tags)
+    except ValueError as e:
+        parser.error('Invalid --tags or --select: %s' % e)
 
-    log.debug("CLI parse args: %s", args)
+    if len([a for a in (args.region, args.regions, args.all_regions) if a]) > 1:
+        parser.error('Only one of --region, --regions and --all-regions may be specified')
+
+    if args.accounts_manifest and args.cross_account_number:
+        parser.error('The --cross-account-number parameter cannot be used with --accounts-manifest')
+
+    if args.plan and args.apply:
+        parser.error('Only one of --plan and --apply may be specified')
+
+    if args.daemon and (args.plan or args.apply):
+        parser.error('The --plan and --apply parameters cannot be used with --daemon')
+
+    if args.parallel_regions is not None and args.parallel_regions < 1:
+        parser.error('The --parallel-regions parameter must be at least 1')
+
+    if not 5 <= args.page_size <= 1000:
+        parser.error('The --page-size parameter must be between 5 and 1000')
+
+    if args.workers < 1:
+        parser.error('The --workers parameter must be at least 1')
+
+    if args.delete_workers is not None and args.delete_workers < 1:
+        parser.error('The --delete-workers parameter must be at least 1')
+
+    if args.max_pending is not None and args.max_pending < 1:
+        parser.error('The --max-pending parameter must be at least 1')
+
+    if args.max_pending_per_volume < 1:
+        parser.error('The --max-pending-per-volume parameter must be at least 1')
+
+    if args.max_snapshots_per_volume is None:
+        args.max_snapshots_per_volume = 0 if args.retention else 14
+
+    try:
+        max_age = parse_age(args.max_age) if args.max_age else None
+        if args.retention:
+            args.retention_policy = RetentionPolicy.parse(args.retention, keep_last=args.max_snapshots_per_volume, max_age=max_age)
+        else:
+            args.retention_policy = RetentionPolicy(keep_last=args.max_snapshots_per_volume, max_age=max_age, keep_none=True)
+    except ValueError as e:
+        parser.error('Invalid retention policy: %s' % e)
+
+    try:
+        args.state_db_ttl = parse_age(args.state_db_max_age)
+    except ValueError as e:
+        parser.error('Invalid --state-db-max-age: %s' % e)
+
+    try:
+        args.cache_seconds = parse_age(args.cache_ttl)
+    except ValueError as e:
+        parser.error('Invalid --cache-ttl: %s' % e)
+
+    if args.wait and (args.remove_only or args.plan):
+        parser.error('The --wait parameter cannot be used with --remove-only or --plan')
+
+    if args.instance_snapshots and (args.max_pending or args.plan or args.apply):
+        parser.error('The --instance-snapshots parameter cannot be used with --max-pending, --plan or --apply')
+
+    args.copy_regions = [r.strip() for r in (args.copy_to or '').split(',') if r.strip()]
+    if args.copy_regions and (args.plan or args.apply):
+        parser.error('The --copy-to parameter cannot be used with --plan or --apply')
+
+    if args.resume and not args.journal_dir:
+        parser.error('The --resume parameter requires --journal-dir')
+
+    if args.journal_dir and args.plan:
+        parser.error('The --journal-dir parameter cannot be used with --plan')
+
+    if args.max_copies < 1:
+        parser.error('The --max-copies parameter must be at least 1')
+
+    try:
+        args.wait_seconds = parse_age(args.wait_timeout) if args.wait or args.copy_regions else None
+    except ValueError as e:
+        parser.error('Invalid --wait-timeout: %s' % e)
+
+    if (args.write_activity or args.changed_blocks) and not args.skip_unchanged:
+        parser.error('The --write-activity and --changed-blocks parameters require --skip-unchanged')
 
+    args.change_detector = None
+    if args.skip_unchanged:
+        try:
+            max_interval = parse_age(args.max_unchanged_age)
+        except ValueError as e:
+            parser.error('Invalid --max-unchanged-age: %s' % e)
+        signals = [DetachedSignal()]
+        if args.write_activity:
+            signals.append(WriteActivitySignal(args.write_activity))
+        if args.changed_blocks:
+            signals.append(ChangedBlocksSignal(local_changed_blocks(args.changed_blocks)))
+        args.change_detector = ChangeDetector(signals, max_interval)
+
+    args.accounts = None
+    if args.accounts_manifest:
+        try:
+            args.accounts = _load_accounts_manifest(args.accounts_manifest, args.cross_account_role)
+        except (IOError, ValueError) as e:
+            parser.error('Cannot read --accounts-manifest %s: %s' % (args.accounts_manifest, e))
+
+    args.plans = None
+    if args.apply:
+        try:
+            args.plans = dict(((p['region'], p.get('account')), p) for p in read_plan(args.apply)['jobs'])
+        except (IOError, ValueError, KeyError) as e:
+            parser.error('Cannot read --apply %s: %s' % (args.apply, e))
+
+_identity = []
+
+def _regions(args):
+    ''' The regions to work on when the accounts manifest or plan does not say '''
+    if args.plans is not None or (args.accounts and all(a['regions'] for a in args.accounts)):
+        return []
+    if args.regions:
+        return [r.strip() for r in args.regions.split(',') if r.strip()]
+    if args.all_regions:
+        from boto import ec2
+        # The China and GovCloud partitions need their own credentials
+        return sorted(r.name for r in ec2.regions() if not r.name.startswith(('cn-', 'us-gov-')))
     if args.region:
-        region = args.region
-    else:
+        return [args.region]
+    if not _identity:
         # If no region was specified, assume this is running on an EC2 instance
         # and work out what region it is in
         log.debug("Figure out which region I am running in...")
-        instance_metadata = get_instance_metadata(timeout=5)
-        log.debug('Instance meta-data: %s', instance_metadata)
-        if not instance_metadata:
+        identity = instance_identity(DiskCache(os.path.join(args.cache_dir, 'identity.json'), args.cache_seconds))
+        if not identity:
             _fail('Could not determine region. This script is either not running on an EC2 instance (in which case you should use the --region option), or the meta-data service is down')
 
-        region = instance_metadata['placement']['availability-zone'][:-1]
-        log.debug("Running in region: %s", region)
+        _identity.append(identity)
+        log.debug("Running in region %s of account %s", identity['region'], identity['account'])
+    return [_identity[0]['region']]
+
+def _execute(args, regions, metrics, connections):
+    ''' Runs backup-monkey as args say in every region (or account and region
+    pair), returning the plans made with --plan. Raises BackupMonkeyException
+    if any of them failed '''
+    from core import BackupMonkey
+    from fanout import run_jobs, format_results
+    from inventory import SqliteInventory
+    from journal import RunJournal
+
+    planned = []
+    plans = args.plans
+
+    def run_region(job):
+        region, account, role = job
+        inventory = None
+        journal = None
+        if args.state_db:
+            inventory = SqliteInventory(args.state_db, '%s/%s' % (account or 'self', region), args.state_db_ttl)
+        try:
+            if args.journal_dir:
+                journal = RunJournal(os.path.join(args.journal_dir, '%s-%s.journal' % (account or 'self', region)),
+                    resume=args.resume)
+            monkey = BackupMonkey(region, args.max_snapshots_per_volume, args.tags, args.reverse_tags, account,
+                role, args.verbose, workers=args.workers,
+                delete_workers=args.delete_workers, retry_budget=args.retry_budget,
+                require_marker_tag=args.require_marker_tag, page_size=args.page_size, retention_policy=args.retention_policy,
+                inventory=inventory, metrics=metrics, connections=connections, select=args.select,
+                max_pending=args.max_pending, max_pending_per_volume=args.max_pending_per_volume,
+                change_detector=args.change_detector, instance_snapshots=args.instance_snapshots, journal=journal)
+
+            if args.plan:
+                planned.append(monkey.plan(snapshot=not args.remove_only, remove=not args.snapshot_only))
+            elif plans is not None:
+                monkey.apply(plans[(region, account)], wait_timeout=args.wait_seconds)
+            else:
+                if not args.remove_only:
+                    monkey.snapshot_volumes()
+                    if args.wait:
+                        monkey.wait_for_snapshots(args.wait_seconds)
+                    if args.copy_regions:
+                        monkey.copy_snapshots(args.copy_regions, args.max_copies, args.wait_seconds)
+                if not args.snapshot_only:
+                    monkey.remove_old_snapshots()
+                    if args.copy_regions:
+                        monkey.remove_old_copies(args.copy_regions)
+            monkey.complete_journal()
+        finally:
+            if journal:
+                journal.close()
+            if inventory:
+                inventory.close()
+
+    if plans is not None:
+        jobs = [('%s/%s' % (p['account'], p['region']) if p.get('account') else p['region'], (p['region'], p.get('account'), p.get('role')))
+            for p in sorted(plans.values(), key=lambda p: (p.get('account'), p['region']))]
+        heading = 'Account/Region' if any(p.get('account') for p in plans.values()) else 'Region'
+    elif args.accounts:
+        jobs = [('%s/%s' % (a['account'], r), (r, a['account'], a['role'])) for a in args.accounts for r in a['regions'] or regions]
+        heading = 'Account/Region'
+    else:
+        jobs = [(r, (r, args.cross_account_number, args.cross_account_role)) for r in regions]
+        heading = 'Region'
+
+    try:
+        if len(jobs) == 1:
+            run_region(jobs[0][1])
+        else:
+            log.info('Running %d jobs in parallel: %s', len(jobs), ', '.join(name for name, job in jobs))
+            results = run_jobs(jobs, run_region, args.parallel_regions)
+            for line in format_results(results, heading=heading):
+                log.info(line)
+            failed = [r.name for r in results if not r.ok]
+            if failed:
+                raise BackupMonkeyException('Backup Monkey failed in %d of %d jobs: %s' % (len(failed), len(results), ', '.join(failed)))
+    finally:
+        _write_metrics(metrics, args.metrics_prom, args.metrics_json)
+    return planned
+
+def _run_daemon(parser, args, metrics, connections):
+    ''' Runs the jobs in --daemon on their schedules until SIGTERM or SIGINT '''
+    import socket
+    from daemon import Scheduler, StatusServer, load_jobs, parse_address
+
+    try:
+        jobs = load_jobs(args.daemon)
+        address = parse_address(args.listen)
+    except (IOError, ValueError) as e:
+        parser.error('Cannot read --daemon %s: %s' % (args.daemon, e))
+
+    for job in jobs:
+        # Each job's arguments are parsed on top of the daemon's command line
+        options = parser.parse_args(job.args, namespace=copy.copy(args))
+        if options.daemon != args.daemon or options.listen != args.listen:
+            parser.error('Job %s cannot use --daemon or --listen' % job.name)
+        if options.plan or options.apply:
+            parser.error('Job %s cannot use --plan or --apply' % job.name)
+        _check_args(parser, options)
+        job.options = options
+        job.regions = _regions(options)
+
+    def run_job(job):
+        _execute(job.options, job.regions, metrics, connections)
+
+    scheduler = Scheduler(jobs, run_job)
+    try:
+        server = StatusServer(address, scheduler, metrics)
+    except socket.error as e:
+        _fail('Cannot listen on %s: %s' % (args.listen, e))
+    server.start()
 
+    def stop(signum, frame):
+        log.info('Stopping once running jobs finish')
+        scheduler.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
     try:
-        monkey = BackupMonkey(region, args.max_snapshots_per_volume, args.tags, args.reverse_tags, args.cross_account_number,
-            args.cross_account_role, args.verbose)
+        scheduler.run_forever()
+    finally:
+        server.stop()
+    log.info('Backup Monkey daemon stopped')
+    sys.exit(0)
+
+def run():
+    parser = _parser()
+    args = parser.parse_args()
+    # Daemon jobs are parsed on top of the command line as it was given
+    given = copy.copy(args)
+    _check_args(parser, args)
 
-        if not args.remove_only:
-            monkey.snapshot_volumes()
-        if not args.snapshot_only:
-            monkey.remove_old_snapshots()
+    from core import Logging
+    from connections import ConnectionCache, CredentialCache
+    from metrics import Metrics
 
+    Logging().configure(args.verbose, __name__)
+    SplunkLogging.set_format(args.log_format)
+
+    log.debug("CLI parse args: %s", args)
+
+    metrics = Metrics()
+    connections = ConnectionCache(CredentialCache(metrics=metrics), metrics=metrics)
+
+    if args.daemon:
+        _run_daemon(parser, given, metrics, connections)
+
+    try:
+        planned = _execute(args, _regions(args), metrics, connections)
     except BackupMonkeyException as e:
         _fail(str(e))
 
+    if args.plan:
+        planned.sort(key=lambda p: (p['account'], p['region']))
+        try:
+            plan = write_plan(args.plan, planned)
+        except IOError as e:
+            _fail('Cannot write --plan %s: %s' % (args.plan, e))
+        log.info('Plan: %s', ', '.join('%s %d' % i for i in sorted(plan['api_calls'].items())))
+
     log.info('Backup Monkey completed successfully!')
     sys.exit(0)
@@ -0,0 +1,164 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime, logging, threading, time
+
+from boto import ec2
+from boto.sts import STSConnection
+from boto.utils import parse_ts
+
+__all__ = ('CredentialCache', 'ConnectionCache', 'ConnectionPool')
+log = logging.getLogger(__name__)
+
+class CredentialCache(object):
+    ''' Caches assumed-role credentials per role, and assumes the role again
+    once the credentials are within refresh_margin seconds of expiring.
+    AssumeRole calls are recorded in metrics, when given '''
+
+    def __init__(self, refresh_margin=300, duration=3600, session_name='AssumeRoleSession', metrics=None):
+        self._metrics = metrics
+        self._refresh_margin = refresh_margin
+        self._duration = duration
+        self._session_name = session_name
+        self._lock = threading.Lock()
+        self._credentials = {}
+
+    def get(self, account, role):
+        ''' Returns (credentials, refresh_at) for the role, where refresh_at is
+        the epoch time after which the credentials should no longer be used '''
+        role_arn = 'arn:aws:iam::%s:role/%s' % (account, role)
+        with self._lock:
+            cached = self._credentials.get(role_arn)
+            if cached and time.time() < cached[1]:
+                return cached
+            log.debug('Assuming role %s', role_arn)
+            kwargs = dict(role_arn=role_arn, role_session_name=self._session_name, duration_seconds=self._duration)
+            if self._metrics:
+                assumed_role = self._metrics.call('AssumeRole', 'sts', STSConnection().assume_role, **kwargs)
+            else:
+                assumed_role = STSConnection().assume_role(**kwargs)
+            credentials = assumed_role.credentials
+            remaining = parse_ts(credentials.expiration) - datetime.datetime.utcnow()
+            refresh_at = time.time() + remaining.days * 86400 + remaining.seconds - self._refresh_margin
+            self._credentials[role_arn] = (credentials, refresh_at)
+            return self._credentials[role_arn]
+
+class _Lease(object):
+    ''' A connection held by one thread, given back to its pool when the thread ends '''
+    __slots__ = ('pool', 'conn', 'refresh_at')
+
+    def __init__(self, pool, conn, refresh_at):
+        self.pool = pool
+        self.conn = conn
+        self.refresh_at = refresh_at
+
+    def __del__(self):
+        try:
+            self.pool._release(self.conn, self.refresh_at)
+        except Exception:
+            # Modules may already be torn down when the interpreter exits
+            pass
+
+class ConnectionPool(object):
+    ''' EC2 connections to one region with one set of credentials, one per
+    thread, so threads never share a boto connection or its keep-alive HTTP
+    connections. Attribute lookups go to the calling thread's connection, so
+    the pool can be used wherever a connection is. A thread takes an idle
+    connection left by a thread that has ended, or makes a new one with
+    connect(), which returns (connection, refresh_at). Connections are
+    replaced once refresh_at passes, so assumed-role credentials are
+    refreshed without the caller noticing. Hits (idle connections taken by a
+    thread), misses and the time taken to connect are recorded in metrics,
+    when given '''
+
+    def __init__(self, connect, region, metrics=None):
+        self._connect = connect
+        self._region = region
+        self._metrics = metrics
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def connection(self):
+        ''' The calling thread's connection '''
+        lease = getattr(self._local, 'lease', None)
+        expired = lease is not None and lease.refresh_at is not None and time.time() >= lease.refresh_at
+        if lease is None or expired:
+            lease = self._lease(expired)
+            if lease is None:
+                return None
+            self._local.lease = lease
+        return lease.conn
+
+    def _lease(self, expired):
+        with self._lock:
+            while self._idle:
+                conn, refresh_at = self._idle.pop()
+                if refresh_at is None or time.time() < refresh_at:
+                    if self._metrics:
+                        self._metrics.pool_hit(self._region)
+                    return _Lease(self, conn, refresh_at)
+        started = time.time()
+        conn, refresh_at = self._connect()
+        if self._metrics:
+            self._metrics.pool_miss(self._region, time.time() - started, expired)
+        if conn is None:
+            return None
+        return _Lease(self, conn, refresh_at)
+
+    def _release(self, conn, refresh_at):
+        if refresh_at is None or time.time() < refresh_at:
+            with self._lock:
+                self._idle.append((conn, refresh_at))
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+class ConnectionCache(object):
+    ''' Keeps a ConnectionPool per (account, region) pair, shared by every
+    BackupMonkey in the process '''
+
+    def __init__(self, credentials=None, metrics=None):
+        self._credentials = credentials or CredentialCache()
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def get(self, region, account=None, role=None):
+        ''' Returns the connection pool, or None for an unknown region.
+        The pool refreshes assumed-role credentials itself '''
+        key = (account, role, region)
+        with self._lock:
+            pool = self._pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(lambda: self._connect(region, account, role), region, self._metrics)
+            # Connect in the calling thread, so a bad region or role fails here
+            if pool.connection() is None:
+                return None
+            with self._lock:
+                pool = self._pools.setdefault(key, pool)
+        return pool
+
+    def _connect(self, region, account, role):
+        if account and role:
+            credentials, refresh_at = self._credentials.get(account, role)
+            conn = ec2.connect_to_region(
+                region,
+                aws_access_key_id=credentials.access_key,
+                aws_secret_access_key=credentials.secret_key,
+                security_token=credentials.session_token
+            )
+        else:
+            refresh_at = None
+            conn = ec2.connect_to_region(region)
+        return conn, refresh_at
@@ -0,0 +1,172 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, time
+from collections import deque
+
+__all__ = ('CopyQueue', 'CopyResult', 'CopyLimitExceeded', 'SOURCE_REGION_TAG', 'SOURCE_VOLUME_TAG', 'SOURCE_SNAPSHOT_TAG')
+log = logging.getLogger(__name__)
+
+# Written on every copy. EC2 gives copies a made-up volume id, so retention in
+# the destination groups them by the source volume tag instead
+SOURCE_REGION_TAG = 'BackupMonkeySourceRegion'
+SOURCE_VOLUME_TAG = 'BackupMonkeySourceVolume'
+SOURCE_SNAPSHOT_TAG = 'BackupMonkeySourceSnapshot'
+
+# DescribeSnapshots is eventually consistent, so a new copy may be missing
+# from a few polls before it shows up
+MISSING_POLLS = 3
+
+class CopyLimitExceeded(Exception):
+    ''' Raised by a CopyQueue's copy function when the destination refuses a
+    copy because too many are already in progress '''
+
+class CopyResult(object):
+    ''' What became of the snapshots a CopyQueue was given: completed maps
+    source snapshot ids to (copy id, seconds from starting the copy to its
+    completion), failed maps them to the error or status the copy ended in,
+    pending lists those whose copies were still in progress at the timeout and
+    queued those never started '''
+
+    def __init__(self, completed, failed, pending, queued, elapsed, polls, calls, gib):
+        self.completed = completed
+        self.failed = failed
+        self.pending = pending
+        self.queued = queued
+        self.elapsed = elapsed
+        self.polls = polls
+        self.calls = calls
+        self.gib = gib
+
+    def latency(self, q):
+        ''' The q quantile of the copy durations, in seconds '''
+        latencies = sorted(seconds for copy_id, seconds in self.completed.values())
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+class CopyQueue(object):
+    ''' Copies snapshots into one destination region, with at most limit
+    copies in progress there at once. The rest wait in a queue and are started
+    as earlier copies complete.
+
+    copy(snapshot_id) starts a copy and returns its snapshot id, or None if it
+    failed, and raises CopyLimitExceeded if the destination refused it for
+    having too many copies in progress, which lowers the limit to what is in
+    flight. describe(snapshot_ids) is called with at most batch_size copy ids
+    at a time and returns the copies that still exist. on_complete is called
+    with the source and copy ids, the copy's duration and its size in GiB.
+    Polls start min_interval apart and grow by half up to max_interval while
+    nothing finishes '''
+
+    def __init__(self, copy, describe, limit=5, timeout=7200, min_interval=10.0, max_interval=120.0, batch_size=200,
+                 on_complete=None, on_fail=None, clock=time.time, sleep=time.sleep):
+        self._copy = copy
+        self._describe = describe
+        self.limit = max(1, limit)
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self._on_complete = on_complete
+        self._on_fail = on_fail
+        self._clock = clock
+        self._sleep = sleep
+        self.peak = 0
+        self.lowered = 0
+
+    def _fail(self, failed, snapshot_id, copy_id, status):
+        failed[snapshot_id] = status
+        if self._on_fail:
+            self._on_fail(snapshot_id, copy_id, status)
+
+    def _start(self, queue, in_flight, failed, deadline):
+        ''' Starts queued copies while there is room, until the deadline '''
+        while queue and len(in_flight) < self.limit and self._clock() < deadline:
+            snapshot_id = queue[0]
+            try:
+                copy_id = self._copy(snapshot_id)
+            except CopyLimitExceeded:
+                if not in_flight:
+                    # Nothing of ours to wait for
+                    queue.popleft()
+                    self._fail(failed, snapshot_id, None, 'limit exceeded')
+                    continue
+                if len(in_flight) < self.limit:
+                    log.warning('The destination refused a copy with %d in progress, lowering the copy limit from %d',
+                        len(in_flight), self.limit)
+                    self.limit = len(in_flight)
+                    self.lowered += 1
+                return
+            queue.popleft()
+            if copy_id is None:
+                self._fail(failed, snapshot_id, None, 'error')
+                continue
+            in_flight[copy_id] = (snapshot_id, self._clock())
+            self.peak = max(self.peak, len(in_flight))
+
+    def run(self, snapshot_ids):
+        began = self._clock()
+        deadline = began + self.timeout
+        queue = deque(snapshot_ids)
+        in_flight = {}
+        completed = {}
+        failed = {}
+        missing = {}
+        polls = calls = 0
+        gib = 0
+        interval = self.min_interval
+        while True:
+            self._start(queue, in_flight, failed, deadline)
+            now = self._clock()
+            if not in_flight or now >= deadline:
+                break
+            self._sleep(max(0.0, min(interval, deadline - now)))
+            seen = {}
+            ids = sorted(in_flight)
+            for i in range(0, len(ids), self.batch_size):
+                calls += 1
+                for snapshot in self._describe(ids[i:i + self.batch_size]):
+                    seen[snapshot.id] = snapshot
+            now = self._clock()
+            polls += 1
+            finished = 0
+            for copy_id in ids:
+                snapshot = seen.get(copy_id)
+                status = snapshot.status if snapshot is not None else 'missing'
+                if status == 'missing':
+                    missing[copy_id] = missing.get(copy_id, 0) + 1
+                    if missing[copy_id] < MISSING_POLLS:
+                        continue
+                if status == 'pending':
+                    continue
+                snapshot_id, started_at = in_flight.pop(copy_id)
+                finished += 1
+                if status == 'completed':
+                    completed[snapshot_id] = (copy_id, max(0.0, now - started_at))
+                    size = _size(getattr(snapshot, 'volume_size', None))
+                    gib += size
+                    if self._on_complete:
+                        self._on_complete(snapshot_id, copy_id, completed[snapshot_id][1], size)
+                else:
+                    self._fail(failed, snapshot_id, copy_id, status)
+            interval = self.min_interval if finished else min(interval * 1.5, self.max_interval)
+        pending = sorted(snapshot_id for snapshot_id, started_at in in_flight.values())
+        return CopyResult(completed, failed, pending, list(queue), self._clock() - began, polls, calls, gib)
+
+def _size(value):
+    ''' A snapshot's volume size in GiB, or 0 when it is not known '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
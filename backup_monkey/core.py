@@ -11,81 +11,151 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import logging, sys, os, re, time
+import ast, logging, sys, os, re, threading, time
+from collections import namedtuple
 
 from boto.exception import NoAuthHandlerFound, BotoServerError
-from boto import ec2
+from boto.ec2.instance import Reservation
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
 
 from exception import BackupMonkeyException
 
-__all__ = ('BackupMonkey', 'Logging')
+__all__ = ('BackupMonkey', 'SnapshotRecord', 'Logging')
 log = logging.getLogger(__name__)
 
 from splunk_logging import SplunkLogging
 from status import BackupMonkeyStatus as _status
+from workers import WorkerPool, Counters
+from connections import ConnectionCache, CredentialCache
+from metrics import Metrics, InstrumentedConnection, timed_iter
+from inventory import Inventory, SnapshotRecord
+from paging import build_filter_params, iter_pages
+from selection import Selection
+from waiter import SnapshotWaiter
+from admission import PendingSnapshotLimiter
+from tagging import TagBatcher, tag_specification_params
+from changes import latest_snapshot
+from copies import CopyQueue, CopyLimitExceeded, SOURCE_REGION_TAG, SOURCE_VOLUME_TAG, SOURCE_SNAPSHOT_TAG
+import retention
+import planning
+from retry import classify, RetryBudget, RetryPolicy, AdaptiveLimiter, THROTTLE, PERMANENT
+
+# Metrics, connections and assumed-role credentials are shared by every
+# BackupMonkey in the process, so accounts and regions that run together reuse them
+_metrics = Metrics()
+_connections = ConnectionCache(CredentialCache(metrics=_metrics), metrics=_metrics)
+
+# The volumes of one instance to snapshot together with CreateSnapshots
+_InstanceVolumes = namedtuple('_InstanceVolumes', 'instance volumes')
 
 class BackupMonkey(object):
 
-    def __init__(self, region, max_snapshots_per_volume, tags, reverse_tags, cross_account_number, cross_account_role, verbose):
+    def __init__(self, region, max_snapshots_per_volume, tags, reverse_tags, cross_account_number, cross_account_role, verbose,
+                 workers=1, delete_workers=None, retry_budget=None, connections=None, require_marker_tag=False,
+                 page_size=500, retention_policy=None, inventory=None, metrics=None, select=None,
+                 max_pending=None, max_pending_per_volume=1, change_detector=None, instance_snapshots=False,
+                 journal=None):
         Logging().configure(verbose)
+        self._verbose = verbose
         self._region = region
         self._prefix = 'BACKUP_MONKEY'
+        # Written on every snapshot at creation, so retention can select them server side
+        self._marker_tag = ('BackupMonkey', self._prefix)
+        self._require_marker_tag = require_marker_tag
+        # EC2 accepts at most 200 values per filter
+        self._filter_values_limit = 200
+        self._inventory = inventory or Inventory()
+        self._page_size = page_size
+        self._tag_on_create = True
+        self._tag_batcher = TagBatcher(self._create_tags)
         self._snapshots_per_volume = max_snapshots_per_volume
+        self._retention_policy = retention_policy or retention.RetentionPolicy(keep_last=max_snapshots_per_volume,
+            keep_none=True)
         self._tags = tags
         self._reverse_tags = reverse_tags
+        self._select = select
+        self._compiled_selection = (None, None)
         self._cross_account_number = cross_account_number
         self._cross_account_role = cross_account_role
-        self._conn = self.get_connection()
+        self._workers = workers
+        self._delete_workers = delete_workers or workers
+        self._stats = Counters()
+        # A SnapshotRecord of every snapshot this run created
+        self._created = []
+        # The ids of those that completed, once they have been waited for
+        self._completed = None
+        # A BackupMonkey per region snapshots are copied to
+        self._destinations = {}
+        self._destinations_lock = threading.Lock()
+        self._max_pending = max_pending
+        self._max_pending_per_volume = max_pending_per_volume
+        self._pending_limiter = None
+        self._change_detector = change_detector
+        self._instance_snapshots = instance_snapshots
+        # A RunJournal of the work done, so an interrupted run can be resumed
+        self._journal = journal
+        self._journal_resumed = False
+        self._retry_policy = RetryPolicy(budget=RetryBudget(retry_budget))
+        self._limiter = AdaptiveLimiter(max(self._workers, self._delete_workers))
+        self._metrics = metrics or _metrics
+        self._connections = connections or _connections
+        self._connection = self.get_connection()
 
     def _info(self, **kwargs):
-        log.info('%s: %s' % (kwargs['subject'], kwargs['body']) if 'subject' in kwargs and 'body' in kwargs else kwargs['subject'] if 'subject' in kwargs else None)
+        # The subject is usually a StatusEvent, only formatted if the line is written out
+        if 'body' in kwargs:
+            log.info('%s: %s', kwargs.get('subject'), kwargs['body'])
+        else:
+            log.info('%s', kwargs.get('subject'))
         kwargs['severity'] = kwargs['severity'] if 'severity' in kwargs else 'informational'
         kwargs['type'] = kwargs['type'] if 'type' in kwargs else 'event'
         kwargs['src_region'] = self._region
         SplunkLogging.write(**kwargs)
 
+    @property
+    def _conn(self):
+        ''' The EC2 connection. Its pool reconnects when assumed-role credentials are about to expire '''
+        return self._connection
+
     def get_connection(self):
+        with self._metrics.phase('connect', self._region):
+            conn = self._get_connection()
+        return InstrumentedConnection(conn, self._metrics, self._region)
+
+    def _get_connection(self):
         ret = None
         if self._cross_account_number and self._cross_account_role:
             self._info(
-                subject=_status.parse_status('cross_account_connect', (self._cross_account_number, self._cross_account_role, self._region)), 
+                subject=_status.event('cross_account_connect', (self._cross_account_number, self._cross_account_role, self._region)), 
                 src_account=self._cross_account_number,
                 src_role=self._cross_account_role,
                 category='connection')
-            from boto.sts import STSConnection
-            import boto
             try:
-                role_arn = 'arn:aws:iam::%s:role/%s' % (self._cross_account_number, self._cross_account_role)
-                sts = STSConnection()
-                assumed_role = sts.assume_role(role_arn=role_arn, role_session_name='AssumeRoleSession')
-                ret = ec2.connect_to_region(
-                    self._region,
-                    aws_access_key_id=assumed_role.credentials.access_key,
-                    aws_secret_access_key=assumed_role.credentials.secret_key,
-                    security_token=assumed_role.credentials.session_token
-                )
+                ret = self._connections.get(self._region,
+                    self._cross_account_number, self._cross_account_role)
             except BotoServerError, e:
                 raise BackupMonkeyException('%s: %s' % (_status.parse_status('cross_account_error'), e.message),
-                    subject=_status.parse_status('cross_account_error'),
+                    subject=_status.event('cross_account_error'),
                     body=e.message,
                     src_account=self._cross_account_number,
                     src_role=self._cross_account_role,
                     category='connection')
         else:
             self._info(
-                subject=_status.parse_status('region_connect', self._region),
+                subject=_status.event('region_connect', self._region),
                 category='connection')
             try:
-                ret = ec2.connect_to_region(self._region)
+                ret = self._connections.get(self._region)
             except NoAuthHandlerFound, e:
                 log.critical('No AWS credentials found. To configure Boto, please read: http://boto.readthedocs.org/en/latest/boto_config_tut.html')
                 raise BackupMonkeyException('%s: %s' % (_status.parse_status('region_connect_error'), e.message),
-                    subject=_status.parse_status('region_connect_error'),
+                    subject=_status.event('region_connect_error'),
                     body=e.message,
                     category='connection')
         if not ret:
             raise BackupMonkeyException(_status.parse_status('region_connect_invalid', self._region),
-                subject=_status.parse_status('region_connect_invalid', self._region),
+                subject=_status.event('region_connect_invalid', self._region),
                 category='connection')
         return ret
 
@@ -95,12 +165,12 @@ class BackupMonkey(object):
             filters = dict([t.split(':') for t in self._tags])
             for f in filters.keys():
                 try:
-                    filters[f] = eval(filters[f])
-                except Exception:
+                    filters[f] = ast.literal_eval(filters[f])
+                except (ValueError, SyntaxError):
                     pass
         except ValueError, e:
             raise BackupMonkeyException('%s: %s' % (_status.parse_status('tags_invalid'), str(e)),
-                subject=_status.parse_status('tags_invalid'),
+                subject=_status.event('tags_invalid'),
                 body=str(e),
                 src_tags=' '.join(self._tags),
                 category='parameters')
@@ -109,38 +179,56 @@ class BackupMonkey(object):
                 filters['tag:%s' % f] = filters.pop(f)
         return filters
 
-    def get_all_volumes(self, **kwargs):
+    def iter_all_volumes(self, filters=None):
+        ''' Yields volumes one page at a time '''
+        params = {}
+        if filters:
+            build_filter_params(params, filters)
         try:
-            return self._conn.get_all_volumes(**kwargs)
+            # DescribeVolumes returns at most 500 volumes per page
+            for volume in iter_pages(self._conn, 'DescribeVolumes', params, Volume, min(self._page_size, 500), self._stats):
+                yield volume
         except BotoServerError, e:
             raise BackupMonkeyException('%s: %s' % (_status.parse_status('volumes_fetch_error', self._region), e.message),
-                subject=_status.parse_status('volumes_fetch_error', self._region),
+                subject=_status.event('volumes_fetch_error', self._region),
                 body=e.message,
                 category='volumes')
 
-    def get_volumes_to_snapshot(self):
-        ''' Returns volumes to snapshot based on passed in tags '''
+    def get_all_volumes(self, **kwargs):
+        return list(self.iter_all_volumes(**kwargs))
+
+    def get_selection(self):
+        ''' The --select expression and --tags compiled into a Selection, once
+        for each combination of them '''
+        key = (tuple(self._tags or ()), bool(self._reverse_tags), self._select)
+        if self._compiled_selection[0] != key:
+            try:
+                selection = Selection.compile(self._select, self._tags, self._reverse_tags)
+            except ValueError, e:
+                status = 'select_invalid' if self._select else 'tags_invalid'
+                raise BackupMonkeyException('%s: %s' % (_status.parse_status(status), str(e)),
+                    subject=_status.event(status),
+                    body=str(e),
+                    src_tags=self._select or ' '.join(self._tags),
+                    category='parameters')
+            log.debug('Selecting volumes where %s, filtered server side by %s', selection, selection.filters)
+            self._compiled_selection = (key, selection)
+        return self._compiled_selection[1]
+
+    def iter_volumes_to_snapshot(self):
+        ''' Yields volumes to snapshot based on passed in tags, as they are fetched.
+        EC2 evaluates what it can of the selection, and the rest is evaluated here '''
         self._info(
-            subject=_status.parse_status('volumes_fetch', self._region), 
+            subject=_status.event('volumes_fetch', self._region), 
             category='volumes')
-        volumes = []
-        if self._reverse_tags:
-            filters = self.get_filters()
-            black_list = []
-            for f in filters.keys():
-                if isinstance(filters[f], list):
-                    black_list = black_list + [(f, i) for i in filters[f]]
-                else:
-                    black_list.append((f, filters[f]))
-            for v in self.get_all_volumes():
-                if len(set(v.tags.items()) - set(black_list)) == len(set(v.tags.items())):
-                    volumes.append(v)
-            return volumes
-        else:
-            if self._tags:
-                return self.get_all_volumes(filters=self.get_filters())
-            else:
-                return self.get_all_volumes()
+        selection = self.get_selection()
+        volumes = self.iter_all_volumes(filters=selection.filters or None)
+        for v in selection.select(volumes):
+            yield v
+
+    def get_volumes_to_snapshot(self):
+        ''' Returns volumes to snapshot based on passed in tags '''
+        return list(self.iter_volumes_to_snapshot())
 
     def remove_reserved_tags(self, tags):
         return dict((key,value) for key, value in tags.iteritems() if not key.startswith('aws:'))
@@ -149,146 +237,1165 @@ class BackupMonkey(object):
         ''' Loops through all EBS volumes and creates snapshots of them '''
 
         log.info('Getting list of EBS volumes')
-        volumes = self.get_volumes_to_snapshot()
-        log.info('Found %d volumes', len(volumes))
+        volumes_seen = {}
+        def volumes():
+            for volume in timed_iter(self.iter_volumes_to_snapshot(), self._metrics, 'discovery', self._region):
+                volumes_seen[volume.id] = self.remove_reserved_tags(volume.tags)
+                yield volume
+        self._resume_journal()
+        self._start_pending_limiter()
+        try:
+            with self._metrics.phase('snapshot', self._region):
+                count, elapsed = WorkerPool(self._workers, name='snapshot').run(self._snapshot_item,
+                    self._by_instance(self._changed_volumes(self._unjournaled(volumes()))))
+        finally:
+            # Tag whatever was created, even when the run was aborted
+            self._tag_batcher.flush()
+            self._inventory.commit()
+        self._inventory.set_volumes(volumes_seen)
+        log.info('Found %d volumes', len(volumes_seen))
+        self._change_summary(len(volumes_seen))
+        self._instance_summary()
+        self._snapshot_summary(len(volumes_seen) - self._stats.get('volumes_unchanged') - self._stats.get('volumes_journaled'),
+            elapsed)
+        return True
+
+    def _resume_journal(self):
+        ''' Once per resumed run, settles the creates and deletes the journal
+        has in flight with one DescribeSnapshots per 200 volumes or snapshots,
+        and takes back the snapshots the run had already created, so they are
+        waited for and copied like new ones. Those whose tags were never sent
+        are tagged again '''
+        journal = self._journal
+        if not journal or not journal.resumed or self._journal_resumed:
+            return
+        self._journal_resumed = True
+        creating = journal.in_flight_creates()
+        deleting = journal.in_flight_deletes()
+        self._info(subject=_status.event('journal_resume', (journal.run_id, self._region, str(journal.created_count),
+                str(journal.deleted_count), str(len(creating)), str(len(deleting)))),
+            category='snapshots')
+        calls = self._stats.get('DescribeSnapshots')
+        try:
+            created = self._retryInCaseOfException(self._reconcile_creates, creating,
+                action='DescribeSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+            deleted = self._retryInCaseOfException(self._reconcile_deletes, deleting,
+                action='DescribeSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
+                category='snapshots')
+        if creating or deleting:
+            self._info(subject=_status.event('journal_reconcile', (str(len(creating)), str(len(deleting)),
+                    str(self._stats.get('DescribeSnapshots') - calls), str(created), str(deleted))),
+                category='snapshots')
+        for entry in journal.created_entries():
+            record = SnapshotRecord(entry['snapshot'], entry['volume'], entry['start_time'], 'pending',
+                entry['description'], entry['tags'])
+            self._created.append(record)
+            self._inventory.add_snapshot(record)
+        for snapshot_id, tags in journal.untagged():
+            self._tag_batcher.add(snapshot_id, tags)
+        self._tag_batcher.flush()
+        self._inventory.commit()
+
+    def _reconcile_creates(self, entries):
+        ''' Journals the snapshots found for in-flight creates, returning how
+        many there were. A snapshot counts if it has the description the create
+        was given and started no earlier than the create was journaled '''
+        marker_key, marker_value = self._marker_tag
+        found = 0
+        for i in range(0, len(entries), self._filter_values_limit):
+            intents = dict((e['volume'], e) for e in entries[i:i + self._filter_values_limit])
+            params = build_filter_params({'Owner.1': 'self'}, {'volume-id': sorted(intents),
+                'description': '%s*' % self._prefix})
+            latest = {}
+            for snapshot in iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, self._stats):
+                entry = intents.get(snapshot.volume_id)
+                if entry is None or snapshot.description != entry['description']:
+                    continue
+                try:
+                    started_at = retention.parse_timestamp(snapshot.start_time)
+                except (TypeError, ValueError):
+                    continue
+                # The journal's clock and EC2's may disagree by a little
+                if started_at < entry['time'] - 300:
+                    continue
+                if snapshot.volume_id not in latest or started_at > latest[snapshot.volume_id][0]:
+                    latest[snapshot.volume_id] = (started_at, snapshot)
+            for volume_id, (started_at, snapshot) in sorted(latest.items()):
+                tags = intents[volume_id]['tags']
+                record = SnapshotRecord(snapshot.id, volume_id, snapshot.start_time, snapshot.status or 'pending',
+                    snapshot.description, tags)
+                self._journal.created(record, tagged=(snapshot.tags or {}).get(marker_key) == marker_value)
+                found += 1
+        return found
+
+    def _reconcile_deletes(self, snapshot_ids):
+        ''' Journals the in-flight deletes whose snapshots are gone, returning how many there were '''
+        found = 0
+        for i in range(0, len(snapshot_ids), self._filter_values_limit):
+            chunk = snapshot_ids[i:i + self._filter_values_limit]
+            seen = set(s.id for s in self._describe_snapshots(chunk))
+            for snapshot_id in chunk:
+                if snapshot_id not in seen:
+                    self._journal.deleted(snapshot_id)
+                    self._inventory.remove_snapshot(snapshot_id)
+                    found += 1
+        return found
+
+    def _unjournaled(self, volumes):
+        ''' Leaves out the volumes a resumed run already snapshotted '''
+        for volume in volumes:
+            if not self._journaled_create(volume.id):
+                yield volume
+
+    def _journaled_create(self, volume_id):
+        snapshot_id = self._journal.created_snapshot(volume_id) if self._journal else None
+        if snapshot_id is None:
+            return False
+        self._stats.incr('volumes_journaled')
+        self._info(subject=_status.event('journal_skip_create', (volume_id, snapshot_id)),
+            src_volume=volume_id,
+            src_snapshot=snapshot_id,
+            category='snapshots')
+        return True
+
+    def _by_instance(self, volumes):
+        ''' With instance snapshots, groups the volumes attached to the same
+        instance so they can be snapshotted together. Detached volumes are
+        passed on as they come. The groups follow once every volume has been
+        seen, describing their instances 200 at a time. Volumes alone on their
+        instance, or whose instance cannot be described, are passed on one by one '''
+        by_instance = {}
+        for volume in volumes:
+            instance_id = volume.attach_data.instance_id
+            if not self._instance_snapshots or not instance_id:
+                yield volume
+                continue
+            by_instance.setdefault(instance_id, []).append(volume)
+        instance_ids = sorted(by_instance)
+        for i in range(0, len(instance_ids), self._filter_values_limit):
+            chunk = instance_ids[i:i + self._filter_values_limit]
+            instances = self._describe_instances([instance_id for instance_id in chunk if len(by_instance[instance_id]) > 1])
+            for instance_id in chunk:
+                group = by_instance.pop(instance_id)
+                if instance_id in instances:
+                    yield _InstanceVolumes(instances[instance_id], group)
+                else:
+                    for volume in group:
+                        yield volume
+
+    def _describe_instances(self, instance_ids):
+        ''' The instances with these ids as {instance_id: instance}, or none if they cannot be described '''
+        if not instance_ids:
+            return {}
+        params = build_filter_params({}, {'instance-id': instance_ids})
+        def describe():
+            return [i for r in iter_pages(self._conn, 'DescribeInstances', params, Reservation, self._page_size, self._stats)
+                for i in r.instances]
+        try:
+            instances = self._retryInCaseOfException(describe,
+                action='DescribeInstances',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        except BotoServerError, e:
+            log.warning('Cannot describe %d instances, snapshotting their volumes one at a time: %s', len(instance_ids), e.message)
+            return {}
+        return dict((i.id, i) for i in instances)
+
+    def _snapshot_item(self, item):
+        if isinstance(item, _InstanceVolumes):
+            self._snapshot_instance(item.instance, item.volumes)
+        else:
+            self._snapshot_volume(item)
+
+    def _snapshot_instance(self, instance, volumes):
+        ''' Snapshots volumes of an instance with one crash-consistent
+        CreateSnapshots call, which also tags them. The instance's other volumes
+        are excluded. The call is retried as a whole, and if the endpoint does
+        not support it the volumes are snapshotted one at a time '''
+        mapping = instance.block_device_mapping or {}
+        attached = set(d.volume_id for d in mapping.values() if d.volume_id)
+        boot = mapping.get(instance.root_device_name)
+        boot_id = boot.volume_id if boot else None
+        volume_ids = set(v.id for v in volumes)
+        grouped = [v for v in volumes if v.id in attached]
+        if not self._instance_snapshots or len(grouped) < 2:
+            for volume in volumes:
+                self._snapshot_volume(volume)
+            return
+        description = '%s %s' % (self._prefix, instance.id)
+        params = {
+            'InstanceSpecification.InstanceId': instance.id,
+            'InstanceSpecification.ExcludeBootVolume': 'false' if boot_id in volume_ids else 'true',
+            'Description': description,
+            # Each snapshot gets its own volume's tags, the marker tag is added to all of them
+            'CopyTagsFromSource': 'volume',
+        }
+        for i, volume_id in enumerate(sorted(attached - volume_ids - set([boot_id])), 1):
+            params['InstanceSpecification.ExcludeDataVolumeId.%d' % i] = volume_id
+        tag_specification_params(params, dict([self._marker_tag]))
+
+        self._info(subject=_status.event('snapshot_create_instance', (str(len(grouped)), instance.id,
+                ' '.join(v.id for v in grouped))),
+            src_instance=instance.id,
+            category='snapshots')
+        if self._journal:
+            for volume in grouped:
+                self._journal.creating(volume.id, description, self._snapshot_tags(volume))
+        try:
+            snapshots = self._retryInCaseOfException(
+                self._create_instance_snapshots, params,
+                src_instance=instance.id,
+                action='CreateSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        except BotoServerError, e:
+            code = getattr(e, 'error_code', None) or getattr(e, 'code', None)
+            if code in ('InvalidAction', 'UnknownParameter', 'InvalidParameter', 'UnsupportedOperation'):
+                log.warning('Cannot snapshot instances with CreateSnapshots (%s), snapshotting their volumes one at a time instead', code)
+                self._instance_snapshots = False
+                for volume in volumes:
+                    self._snapshot_volume(volume)
+                return
+            if code == 'SnapshotLimitExceeded':
+                raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshot_create_instance_error', instance.id), e.message),
+                    subject=_status.event('snapshot_create_instance_error', instance.id),
+                    body=e.message,
+                    src_instance=instance.id,
+                    category='snapshots')
+            error = _status.event('snapshot_create_instance_error', instance.id)
+            log.error('%s: %s', error, e.message)
+            SplunkLogging.write(
+                subject=error,
+                body=e.message,
+                src_instance=instance.id,
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+            return
+        self._stats.incr('instance_snapshot_calls')
+        self._stats.incr('legacy_api_calls', sum(2 + ('Name' in v.tags) + bool(v.tags) for v in grouped))
+        by_volume = dict((s.volume_id, s) for s in snapshots)
+        for volume in grouped:
+            snapshot = by_volume.get(volume.id)
+            if snapshot is None:
+                error = _status.event('snapshot_create_error', volume.id)
+                log.error('%s: %s', error, 'not in the CreateSnapshots response for %s' % instance.id)
+                SplunkLogging.write(
+                    subject=error,
+                    src_volume=volume.id,
+                    src_instance=instance.id,
+                    category='snapshots',
+                    type='alarm',
+                    severity='critical')
+                continue
+            tags = self._snapshot_tags(volume)
+            self._stats.incr('snapshots_created')
+            self._stats.incr('instance_snapshots')
+            self._stats.incr('tagged_on_create')
+            record = SnapshotRecord(snapshot.id, volume.id, snapshot.start_time,
+                snapshot.status or getattr(snapshot, 'state', None) or 'pending', description, tags)
+            self._created.append(record)
+            self._inventory.add_snapshot(record)
+            if self._journal:
+                self._journal.created(record, tagged=True)
+            self._info(subject=_status.event('snapshot_create_success', (snapshot.id, volume.id)),
+                src_volume=volume.id,
+                src_snapshot=snapshot.id,
+                src_instance=instance.id,
+                src_tags=_status.tags(tags),
+                category='snapshots')
+        # Selected volumes that are no longer attached to the instance
+        for volume in volumes:
+            if volume.id not in attached:
+                self._snapshot_volume(volume)
+
+    def _create_instance_snapshots(self, params):
+        return self._conn.get_list('CreateSnapshots', params, [('item', Snapshot)], verb='POST')
+
+    def _instance_summary(self):
+        if not self._instance_snapshots and not self._stats.get('instance_snapshot_calls'):
+            return
+        self._info(subject=_status.event('snapshot_instance_summary', (str(self._stats.get('instance_snapshots')),
+                str(self._stats.get('instance_snapshot_calls')), str(self._stats.get('DescribeInstances')))),
+            category='snapshots')
+
+    def _changed_volumes(self, volumes):
+        ''' Yields the volumes that need a snapshot. With a change detector,
+        volumes it finds unchanged since their last snapshot are left out. The
+        last snapshots come from a fresh inventory, or else from one
+        DescribeSnapshots per 200 volumes '''
+        if not self._change_detector:
+            for volume in volumes:
+                yield volume
+            return
+        last_snapshots = None
+        if self._inventory.is_fresh():
+            by_volume = {}
+            for record in self._inventory.snapshots():
+                by_volume.setdefault(record.volume_id, []).append(record)
+            last_snapshots = dict((volume_id, latest_snapshot(records)) for volume_id, records in by_volume.iteritems())
+        chunk = []
         for volume in volumes:
-            description_parts = [self._prefix]
-            description_parts.append(volume.id)
-            if volume.attach_data.instance_id:
-                description_parts.append(volume.attach_data.instance_id)
-            if volume.attach_data.device:
-                description_parts.append(volume.attach_data.device)
-            description = ' '.join(description_parts)
-            self._info(subject=_status.parse_status('snapshot_create', (volume.id, description)),
+            chunk.append(volume)
+            if len(chunk) == self._filter_values_limit:
+                for changed in self._decide_changes(chunk, last_snapshots):
+                    yield changed
+                chunk = []
+        for changed in self._decide_changes(chunk, last_snapshots):
+            yield changed
+
+    def _decide_changes(self, volumes, last_snapshots):
+        if not volumes:
+            return
+        if last_snapshots is None:
+            try:
+                last_snapshots = self._retryInCaseOfException(self._last_snapshots, [v.id for v in volumes],
+                    action='DescribeSnapshots',
+                    category='snapshots',
+                    type='alert',
+                    severity='high')
+            except BotoServerError, e:
+                raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                    subject=_status.event('snapshots_fetch_error', self._region),
+                    body=e.message,
+                    category='snapshots')
+        for volume in volumes:
+            last = last_snapshots.get(volume.id)
+            snapshot, reason = self._change_detector.decide(volume, last)
+            if snapshot:
+                log.debug('Snapshotting %s: %s', volume.id, reason)
+                yield volume
+                continue
+            self._stats.incr('volumes_unchanged')
+            self._info(subject=_status.event('snapshot_skip_unchanged', (volume.id, last.id, reason)),
                 src_volume=volume.id,
-                src_tags=' '.join([':'.join(i) for i in volume.tags.items()]),
+                src_snapshot=last.id,
+                category='snapshots')
+
+    def _last_snapshots(self, volume_ids):
+        ''' The newest Backup Monkey snapshot of each volume that has one '''
+        params = build_filter_params({'Owner.1': 'self'}, {'volume-id': volume_ids, 'description': '%s*' % self._prefix})
+        lookups = Counters()
+        by_volume = {}
+        for snapshot in iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, lookups):
+            by_volume.setdefault(snapshot.volume_id, []).append(SnapshotRecord.from_snapshot(snapshot))
+        self._stats.incr('DescribeSnapshots', lookups.get('DescribeSnapshots'))
+        self._stats.incr('change_lookups', lookups.get('DescribeSnapshots'))
+        return dict((volume_id, latest_snapshot(records)) for volume_id, records in by_volume.iteritems())
+
+    def _change_summary(self, volumes):
+        if not self._change_detector:
+            return
+        unchanged = self._stats.get('volumes_unchanged')
+        self._info(subject=_status.event('snapshot_change_summary', (str(unchanged), str(volumes), str(unchanged),
+                str(self._stats.get('change_lookups')))),
+            category='snapshots')
+
+    def _start_pending_limiter(self):
+        ''' With max_pending, sets up the limiter that queues snapshots once that
+        many are pending, counting those already pending in the account '''
+        if not self._max_pending:
+            return
+        def describe(snapshot_ids):
+            return self._retryInCaseOfException(self._describe_snapshots, snapshot_ids,
+                action='DescribeSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        self._pending_limiter = PendingSnapshotLimiter(describe, self._max_pending, self._max_pending_per_volume,
+            batch_size=self._filter_values_limit)
+        params = build_filter_params({'Owner.1': 'self'}, {'status': 'pending'})
+        try:
+            pending = self._pending_limiter.seed(iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot,
+                self._page_size, self._stats))
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
                 category='snapshots')
+        self._info(subject=_status.event('snapshot_pending_limit', (str(self._max_pending), self._region, str(pending))),
+            category='snapshots')
+
+    def _snapshot_summary(self, count, elapsed):
+        limiter = self._pending_limiter
+        if limiter:
+            self._info(subject=_status.event('snapshot_pending_summary', (str(limiter.peak), str(limiter.limit),
+                    str(limiter.waits), '%.2f' % limiter.wait_seconds, str(limiter.calls), str(limiter.lowered))),
+                category='snapshots')
+        created = self._stats.get('snapshots_created')
+        self._info(subject=_status.event('snapshot_create_summary', (str(created), str(count - created),
+                '%.2f' % elapsed, '%.2f' % (created / elapsed if elapsed else 0), str(self._workers))),
+            retry_count=str(self._stats.get('retries')),
+            retry_sleep='%.2f' % self._stats.get('retry_sleep'),
+            category='snapshots')
+        api_calls = (created - self._stats.get('instance_snapshots') + self._stats.get('instance_snapshot_calls') +
+            self._stats.get('DescribeInstances') + self._stats.get('tagged_on_create_fallback') + self._tag_batcher.calls)
+        self._info(subject=_status.event('snapshot_tag_summary', (str(self._stats.get('tagged_on_create')),
+                str(self._tag_batcher.tagged), str(self._tag_batcher.calls),
+                str(self._stats.get('legacy_api_calls') - api_calls))),
+            category='snapshots')
+
+    def _create_snapshot(self, volume_id, description, tags):
+        ''' Creates a snapshot, tagged by the same call when the endpoint supports
+        TagSpecification. Otherwise the snapshot is marked for _queue_tags '''
+        return self._create_tagged('CreateSnapshot', {'VolumeId': volume_id, 'Description': description[0:255]}, tags)
+
+    def _create_tagged(self, action, params, tags):
+        if self._tag_on_create and tags:
+            try:
+                snapshot = self._conn.get_object(action, tag_specification_params(dict(params), tags),
+                    Snapshot, verb='POST')
+                snapshot.tags = dict(tags)
+                self._stats.incr('tagged_on_create')
+                return snapshot
+            except BotoServerError, e:
+                if e.error_code not in ('UnknownParameter', 'InvalidParameter'):
+                    raise
+                log.warning('Cannot tag snapshots on creation (%s), tagging them in batches instead', e.error_code)
+                self._tag_on_create = False
+                self._stats.incr('tagged_on_create_fallback')
+        snapshot = self._conn.get_object(action, params, Snapshot, verb='POST')
+        snapshot.tags = dict(tags)
+        snapshot.tags_pending = bool(tags)
+        return snapshot
+
+    def _queue_tags(self, snapshot):
+        ''' Queues the tags of a snapshot created without them for a batched
+        CreateTags. Only called once the create's retries are over, since a full
+        batch is sent right away and needs a limiter slot of its own '''
+        if getattr(snapshot, 'tags_pending', False):
+            self._tag_batcher.add(snapshot.id, snapshot.tags)
+
+    def _admitted_create_snapshot(self, volume_id, description, tags):
+        ''' Creates a snapshot once the pending snapshot limiter, if any, has
+        room for it. A snapshot EC2 refuses with SnapshotLimitExceeded waits
+        for one in flight to finish and is tried again '''
+        limiter = self._pending_limiter
+        while True:
+            if limiter:
+                limiter.acquire(volume_id)
             try:
                 snapshot = self._retryInCaseOfException(
-                    volume.create_snapshot, description,
-                    src_volume=volume.id,
+                    self._create_snapshot, volume_id, description, tags,
+                    src_volume=volume_id,
+                    action='CreateSnapshot',
                     category='snapshots',
                     type='alert',
                     severity='high')
-                if volume.tags:
-                    snapshot.add_tags(self.remove_reserved_tags(volume.tags))
-                self._info(subject=_status.parse_status('snapshot_create_success', (snapshot.id, volume.id)),
-                    src_volume=volume.id,
-                    src_snapshot=snapshot.id,
-                    src_tags=' '.join([':'.join(i) for i in snapshot.tags.items()]),
-                    category='snapshots')
             except BotoServerError, e:
-                if e.code == 'SnapshotLimitExceeded':
-                    raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshot_create_error', volume.id), e.message),
-                        subject=_status.parse_status('snapshot_create_error', volume.id),
-                        body=e.message,
-                        src_volume=volume.id,
-                        src_tags=' '.join([':'.join(i) for i in self.remove_reserved_tags(volume.tags).items()]),
-                        category='snapshots')
-                else:
-                    log.error('%s: %s' % (_status.parse_status('snapshot_create_error', volume.id), e.message))
-                    SplunkLogging.write(
-                        subject=_status.parse_status('snapshot_create_error', volume.id),
-                        body=e.message,
-                        src_volume=volume.id,
-                        src_tags=' '.join([':'.join(i) for i in self.remove_reserved_tags(volume.tags).items()]),
-                        category='snapshots',
-                        type='alarm',
-                        severity='critical')
+                if not limiter:
+                    raise
+                limiter.release(volume_id)
+                code = getattr(e, 'error_code', None) or getattr(e, 'code', None)
+                if code == 'SnapshotLimitExceeded' and limiter.limit_exceeded():
+                    self._stats.incr('snapshot_limit_requeued')
+                    continue
+                raise
+            except:
+                # Socket errors and the like must not hold on to the slot either
+                if limiter:
+                    limiter.release(volume_id)
+                raise
+            if limiter:
+                limiter.started(volume_id, snapshot.id)
+            self._queue_tags(snapshot)
+            return snapshot
+
+    def _create_tags(self, resource_ids, tags):
+        ''' Tags a batch of snapshots, logging rather than raising on failure '''
+        try:
+            self._retryInCaseOfException(
+                self._conn.create_tags, resource_ids, tags,
+                action='CreateTags',
+                category='snapshots',
+                type='alert',
+                severity='high')
+            if self._journal:
+                self._journal.tagged(resource_ids)
+        except BotoServerError, e:
+            error = _status.event('snapshot_tag_error', (str(len(resource_ids)), ' '.join(resource_ids)))
+            log.error('%s: %s', error, e.message)
+            SplunkLogging.write(
+                subject=error,
+                body=e.message,
+                src_tags=_status.tags(tags),
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+
+    def _snapshot_description(self, volume):
+        description_parts = [self._prefix]
+        description_parts.append(volume.id)
+        if volume.attach_data.instance_id:
+            description_parts.append(volume.attach_data.instance_id)
+        if volume.attach_data.device:
+            description_parts.append(volume.attach_data.device)
+        return ' '.join(description_parts)
+
+    def _snapshot_tags(self, volume):
+        tags = self.remove_reserved_tags(volume.tags)
+        tags[self._marker_tag[0]] = self._marker_tag[1]
+        return tags
+
+    def _snapshot_volume(self, volume):
+        ''' Creates a snapshot of a single volume. Any error other than
+        SnapshotLimitExceeded is logged and the volume is skipped '''
+        self._create_volume_snapshot(volume.id, self._snapshot_description(volume), self._snapshot_tags(volume),
+            volume.tags)
+
+    def _create_volume_snapshot(self, volume_id, description, tags, volume_tags):
+        self._info(subject=_status.event('snapshot_create', (volume_id, description)),
+            src_volume=volume_id,
+            src_tags=_status.tags(volume_tags),
+            category='snapshots')
+        # boto's create_snapshot and add_tags took a CreateSnapshot, a DescribeVolumes,
+        # a CreateTags for the Name tag and a CreateTags for the rest
+        self._stats.incr('legacy_api_calls', 2 + ('Name' in volume_tags) + bool(volume_tags))
+        if self._journal:
+            self._journal.creating(volume_id, description[0:255], tags)
+        try:
+            snapshot = self._admitted_create_snapshot(volume_id, description, tags)
+            self._stats.incr('snapshots_created')
+            record = SnapshotRecord(snapshot.id, volume_id, snapshot.start_time, snapshot.status or 'pending',
+                description, tags)
+            self._created.append(record)
+            self._inventory.add_snapshot(record)
+            if self._journal:
+                # Otherwise the tags are still queued for the batcher
+                self._journal.created(record, tagged=self._tag_on_create)
+            self._info(subject=_status.event('snapshot_create_success', (snapshot.id, volume_id)),
+                src_volume=volume_id,
+                src_snapshot=snapshot.id,
+                src_tags=_status.tags(snapshot.tags),
+                category='snapshots')
+        except BotoServerError, e:
+            if e.code == 'SnapshotLimitExceeded':
+                raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshot_create_error', volume_id), e.message),
+                    subject=_status.event('snapshot_create_error', volume_id),
+                    body=e.message,
+                    src_volume=volume_id,
+                    src_tags=_status.tags(volume_tags, skip_reserved=True),
+                    category='snapshots')
+            else:
+                error = _status.event('snapshot_create_error', volume_id)
+                log.error('%s: %s', error, e.message)
+                SplunkLogging.write(
+                    subject=error,
+                    body=e.message,
+                    src_volume=volume_id,
+                    src_tags=_status.tags(volume_tags, skip_reserved=True),
+                    category='snapshots',
+                    type='alarm',
+                    severity='critical')
+
+    def _describe_snapshots(self, snapshot_ids):
+        params = build_filter_params({'Owner.1': 'self'}, {'snapshot-id': snapshot_ids})
+        return list(iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, self._stats))
+
+    def wait_for_snapshots(self, timeout=7200, min_interval=10.0, max_interval=120.0):
+        ''' Polls the snapshots this run created until they complete, fail or
+        timeout seconds pass, describing up to 200 of them per call. Logs how
+        long each took from its start time and a summary of the whole wait.
+        Raises BackupMonkeyException if any failed, so older snapshots are not
+        removed in favour of them '''
+        self._completed = set()
+        if not self._created:
+            return None
+        created = dict((r.id, r) for r in self._created)
+        def complete(snapshot_id, volume_id, seconds):
+            self._completed.add(snapshot_id)
+            self._metrics.observe_completion(self._region, seconds)
+            self._inventory.add_snapshot(created[snapshot_id]._replace(status='completed'))
+            self._info(subject=_status.event('snapshot_wait_complete', (snapshot_id, volume_id, '%.0f' % seconds)),
+                src_snapshot=snapshot_id,
+                src_volume=volume_id,
+                category='snapshots')
+        def fail(snapshot_id, volume_id, status):
+            self._inventory.remove_snapshot(snapshot_id)
+            error = _status.event('snapshot_wait_error', (snapshot_id, volume_id, status))
+            log.error('%s', error)
+            SplunkLogging.write(
+                subject=error,
+                src_snapshot=snapshot_id,
+                src_volume=volume_id,
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+        def poll(completed, failed, pending, progress):
+            self._info(subject=_status.event('snapshot_wait_progress', (str(completed), str(len(waiter)), str(failed),
+                    str(pending), '%.0f%%' % progress if progress is not None else 'unknown')),
+                category='snapshots')
+        def describe(snapshot_ids):
+            return self._retryInCaseOfException(self._describe_snapshots, snapshot_ids,
+                action='DescribeSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+
+        waiter = SnapshotWaiter(describe, timeout, min_interval, max_interval, self._filter_values_limit,
+            on_complete=complete, on_fail=fail, on_poll=poll)
+        for record in self._created:
+            try:
+                started_at = retention.parse_timestamp(record.start_time)
+            except (TypeError, ValueError):
+                started_at = time.time()
+            waiter.add(record.id, record.volume_id, started_at)
+        self._info(subject=_status.event('snapshot_wait', (str(len(waiter)), str(timeout), self._region)),
+            category='snapshots')
+        try:
+            with self._metrics.phase('wait', self._region):
+                result = waiter.wait()
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
+                category='snapshots')
+        finally:
+            self._inventory.commit()
+        self._info(subject=_status.event('snapshot_wait_summary', ('%.0f' % result.elapsed, str(len(waiter)),
+                str(len(result.completed)), '%.0f' % result.latency(0.5), '%.0f' % result.latency(0.9),
+                '%.0f' % result.latency(1.0), str(len(result.failed)), str(len(result.pending)), str(result.calls))),
+            category='snapshots')
+        if result.pending:
+            error = _status.event('snapshot_wait_timeout', (str(len(result.pending)), str(timeout), ' '.join(result.pending)))
+            log.error('%s', error)
+            SplunkLogging.write(subject=error, category='snapshots', type='alarm', severity='high')
+        if result.failed:
+            raise BackupMonkeyException(_status.parse_status('snapshot_wait_failed', (str(len(result.failed)), self._region)),
+                subject=_status.event('snapshot_wait_failed', (str(len(result.failed)), self._region)),
+                body=' '.join('%s=%s' % item for item in sorted(result.failed.items())),
+                category='snapshots')
+        return result
+
+    def _destination(self, region):
+        ''' The BackupMonkey copy_snapshots and remove_old_copies use in a
+        destination region, sharing this one's account, retention policy,
+        connections and retry budget '''
+        with self._destinations_lock:
+            monkey = self._destinations.get(region)
+            if monkey is None:
+                monkey = BackupMonkey(region, self._snapshots_per_volume, self._tags, self._reverse_tags,
+                    self._cross_account_number, self._cross_account_role, self._verbose, workers=self._workers,
+                    delete_workers=self._delete_workers, connections=self._connections,
+                    require_marker_tag=self._require_marker_tag, page_size=self._page_size,
+                    retention_policy=self._retention_policy, metrics=self._metrics, select=self._select)
+                monkey._retry_policy = self._retry_policy
+                self._destinations[region] = monkey
+            return monkey
+
+    def copy_snapshots(self, destinations, max_copies=5, timeout=7200, min_interval=10.0, max_interval=120.0):
+        ''' Copies the snapshots this run created into each destination region
+        once they complete, waiting for them first if that has not been done.
+        Destinations are copied to in parallel, each with at most max_copies
+        copies in progress. Raises BackupMonkeyException if any copy failed,
+        so old snapshots are not removed in favour of them '''
+        if self._completed is None:
+            self.wait_for_snapshots(timeout)
+        records = [r for r in self._created if r.id in self._completed]
+        destinations = [d for d in destinations if d != self._region]
+        if not records or not destinations:
+            return {}
+        results = {}
+        def copy_to(destination):
+            results[destination] = self._destination(destination)._copy_from(self._region, records, max_copies, timeout,
+                min_interval, max_interval)
+        with self._metrics.phase('copy', self._region):
+            WorkerPool(len(destinations), name='copy').run(copy_to, destinations)
+        failed = sorted(d for d, result in results.iteritems() if result.failed)
+        if failed:
+            count = sum(len(results[d].failed) for d in failed)
+            raise BackupMonkeyException(_status.parse_status('snapshot_copy_failed', (str(count), ', '.join(failed))),
+                subject=_status.event('snapshot_copy_failed', (str(count), ', '.join(failed))),
+                body=' '.join('%s=%s' % item for d in failed for item in sorted(results[d].failed.items())),
+                category='snapshots')
+        return results
+
+    def _copy_from(self, source_region, records, max_copies, timeout, min_interval, max_interval):
+        ''' Copies records, snapshots in source_region, into this region '''
+        by_id = dict((r.id, r) for r in records)
+        def copy(snapshot_id):
+            return self._copy_snapshot(source_region, by_id[snapshot_id])
+        def describe(snapshot_ids):
+            return self._retryInCaseOfException(self._describe_snapshots, snapshot_ids,
+                action='DescribeSnapshots',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        def complete(snapshot_id, copy_id, seconds, size):
+            self._metrics.observe_copy(source_region, self._region, seconds, size)
+            self._info(subject=_status.event('snapshot_copy_complete', (copy_id, snapshot_id, self._region, '%.0f' % seconds)),
+                src_snapshot=snapshot_id,
+                src_volume=by_id[snapshot_id].volume_id,
+                category='snapshots')
+        def fail(snapshot_id, copy_id, status):
+            if copy_id is None:
+                # Starting the copy failed, which _copy_snapshot has logged
+                return
+            error = _status.event('snapshot_copy_error', (snapshot_id, self._region, status))
+            log.error('%s', error)
+            SplunkLogging.write(
+                subject=error,
+                src_snapshot=snapshot_id,
+                src_volume=by_id[snapshot_id].volume_id,
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+
+        queue = CopyQueue(copy, describe, max_copies, timeout, min_interval, max_interval, self._filter_values_limit,
+            on_complete=complete, on_fail=fail)
+        self._info(subject=_status.event('snapshot_copy', (str(len(by_id)), source_region, self._region, str(max_copies))),
+            category='snapshots')
+        try:
+            result = queue.run(sorted(by_id))
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
+                category='snapshots')
+        finally:
+            self._tag_batcher.flush()
+        self._info(subject=_status.event('snapshot_copy_summary', (str(len(result.completed)), str(result.gib),
+                self._region, '%.0f' % result.elapsed, '%.0f' % result.latency(0.5), '%.0f' % result.latency(0.9),
+                '%.0f' % result.latency(1.0), '%.1f' % (result.gib * 3600.0 / result.elapsed if result.elapsed else 0),
+                str(len(result.failed)), str(len(result.pending)), str(len(result.queued)), str(queue.peak),
+                str(result.calls))),
+            category='snapshots')
+        if result.pending or result.queued:
+            error = _status.event('snapshot_copy_timeout', (str(len(result.pending) + len(result.queued)), self._region,
+                str(timeout), ' '.join(result.pending + result.queued)))
+            log.error('%s', error)
+            SplunkLogging.write(subject=error, category='snapshots', type='alarm', severity='high')
+        return result
+
+    def _copy_snapshot(self, source_region, record):
+        ''' Starts a copy of a snapshot from source_region, with its description
+        and tags, and tags naming where it came from. Returns the copy's id, or
+        None if the copy could not be started '''
+        tags = dict(record.tags)
+        tags.update({SOURCE_REGION_TAG: source_region, SOURCE_VOLUME_TAG: record.volume_id, SOURCE_SNAPSHOT_TAG: record.id})
+        params = {'SourceRegion': source_region, 'SourceSnapshotId': record.id, 'Description': record.description[0:255]}
+        try:
+            snapshot = self._retryInCaseOfException(
+                self._create_tagged, 'CopySnapshot', params, tags,
+                src_snapshot=record.id,
+                action='CopySnapshot',
+                category='snapshots',
+                type='alert',
+                severity='high')
+        except BotoServerError, e:
+            code = getattr(e, 'error_code', None) or getattr(e, 'code', None)
+            if code == 'ResourceLimitExceeded':
+                raise CopyLimitExceeded(e.message)
+            error = _status.event('snapshot_copy_error', (record.id, self._region, code))
+            log.error('%s: %s', error, e.message)
+            SplunkLogging.write(
+                subject=error,
+                body=e.message,
+                src_snapshot=record.id,
+                src_volume=record.volume_id,
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+            return None
+        self._queue_tags(snapshot)
+        self._stats.incr('snapshots_copied')
+        return snapshot.id
+
+    def remove_old_copies(self, destinations):
+        ''' Removes the copies of this region's snapshots, in each destination
+        region, that the retention policy no longer keeps. Copies are grouped
+        by the volume they were taken of, just as the snapshots here are '''
+        volume_ids = None if self.get_selection().selects_all else self._selected_volume_ids()
+        for destination in destinations:
+            if destination != self._region:
+                self._destination(destination)._remove_copies_from(self._region, volume_ids)
         return True
 
-    def remove_old_snapshots(self):
-        ''' Loop through this account's snapshots, and remove the oldest ones
-        where there are more snapshots per volume than required '''
-        log.info('Configured to keep %d snapshots per volume', self._snapshots_per_volume)
+    def _remove_copies_from(self, source_region, volume_ids):
         self._info(
-            subject=_status.parse_status('snapshots_fetch', self._region),
+            subject=_status.event('snapshots_fetch', self._region),
             category='snapshots')
+        copies = timed_iter(self._iter_copies(source_region, volume_ids), self._metrics, 'discovery', self._region)
+        keep, delete = retention.plan(copies, self._retention_policy, key=lambda s: s.tags[SOURCE_VOLUME_TAG])
+        log.info('Keeping %d copies from %s and deleting %d', len(keep), source_region, len(delete))
+        self._delete_snapshots(delete)
+
+    def _iter_copies(self, source_region, volume_ids):
+        ''' Yields the completed copies of source_region's Backup Monkey
+        snapshots in this region, of the volumes in volume_ids unless it is None '''
+        filters = self.get_snapshot_filters()
+        filters['tag:%s' % SOURCE_REGION_TAG] = source_region
+        params = build_filter_params({'Owner.1': 'self'}, filters)
         try:
-            snapshots = self._conn.get_all_snapshots(owner='self')
+            for snapshot in iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, self._stats):
+                record = SnapshotRecord.from_snapshot(snapshot)
+                source_volume = record.tags.get(SOURCE_VOLUME_TAG)
+                if source_volume is None or (volume_ids is not None and source_volume not in volume_ids):
+                    continue
+                yield record
         except BotoServerError, e:
-            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshot_fetch_error', self._region), e.message),
-                subject=_status.parse_status('snapshot_fetch_error', self._region),
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
                 body=e.message,
                 category='snapshots')
+
+    def get_snapshot_filters(self):
+        ''' Returns the server side filters matching snapshots made by Backup Monkey '''
+        filters = {'description': '%s*' % self._prefix, 'status': 'completed'}
+        if self._require_marker_tag:
+            filters['tag:%s' % self._marker_tag[0]] = self._marker_tag[1]
+        return filters
+
+    def _selected_volume_ids(self):
+        ''' The ids of the volumes --tags selects, listing them if the snapshot phase did not '''
+        if self._inventory.volume_ids is None:
+            self._inventory.set_volumes(dict((v.id, self.remove_reserved_tags(v.tags)) for v in self.iter_volumes_to_snapshot()))
+        return self._inventory.volume_ids
+
+    def iter_backup_snapshots(self, scoped=True):
+        ''' Yields this account's completed Backup Monkey snapshots as SnapshotRecords,
+        one page at a time. When --tags limits the scope, only snapshots of the
+        selected volumes are fetched, unless scoped is False. Copies made by
+        copy_snapshots are left out, as EC2 gives them all the same volume id;
+        DescribeSnapshots cannot filter on a tag being absent, so they are
+        dropped here rather than server side '''
+        filters = self.get_snapshot_filters()
+        chunks = [None]
+        if scoped and not self.get_selection().selects_all:
+            volume_ids = sorted(self._selected_volume_ids())
+            chunks = [volume_ids[i:i + self._filter_values_limit] for i in range(0, len(volume_ids), self._filter_values_limit)]
+        try:
+            for chunk in chunks:
+                if chunk is not None:
+                    filters['volume-id'] = chunk
+                params = build_filter_params({'Owner.1': 'self'}, filters)
+                for snapshot in iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, self._stats):
+                    record = SnapshotRecord.from_snapshot(snapshot)
+                    if SOURCE_REGION_TAG in record.tags:
+                        continue
+                    yield record
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
+                category='snapshots')
+
+    def get_backup_snapshots(self):
+        snapshots = list(self.iter_backup_snapshots())
         log.info('Found %d snapshots', len(snapshots))
-        vol_snap_map = {}
+        return snapshots
+
+    def refresh_inventory(self):
+        ''' Brings the inventory's pending snapshots up to date with one batched
+        describe per 200 snapshots. Snapshots that no longer exist are dropped '''
+        pending = self._inventory.pending_snapshot_ids()
+        try:
+            for i in range(0, len(pending), self._filter_values_limit):
+                chunk = pending[i:i + self._filter_values_limit]
+                params = build_filter_params({'Owner.1': 'self'}, {'snapshot-id': chunk})
+                seen = set()
+                for snapshot in iter_pages(self._conn, 'DescribeSnapshots', params, Snapshot, self._page_size, self._stats):
+                    seen.add(snapshot.id)
+                    self._inventory.add_snapshot(SnapshotRecord.from_snapshot(snapshot))
+                for snapshot_id in set(chunk) - seen:
+                    self._inventory.remove_snapshot(snapshot_id)
+        except BotoServerError, e:
+            raise BackupMonkeyException('%s: %s' % (_status.parse_status('snapshots_fetch_error', self._region), e.message),
+                subject=_status.event('snapshots_fetch_error', self._region),
+                body=e.message,
+                category='snapshots')
+        self._inventory.commit()
+        return len(pending)
+
+    def _backup_snapshots_for_retention(self):
+        ''' Yields the completed Backup Monkey snapshots retention should consider,
+        logging how many were fetched versus kept once the stream is exhausted.
+        A fresh inventory is read instead of listing every snapshot again '''
+        if self._inventory.is_fresh():
+            refreshed = self.refresh_inventory()
+            self._info(subject=_status.event('snapshots_inventory', (self._region, str(refreshed))),
+                category='snapshots')
+            snapshots = self._inventory.snapshots()
+        else:
+            # A persistent inventory is synced with every snapshot, so it can serve any --tags scope later
+            snapshots = self._inventory.sync(self.iter_backup_snapshots(scoped=not self._inventory.persistent))
+        volume_ids = None if self.get_selection().selects_all else self._selected_volume_ids()
+        marker_key, marker_value = self._marker_tag
+        fetched = 0
+        kept = 0
         for snapshot in snapshots:
+            fetched += 1
             if not snapshot.description.startswith(self._prefix):
                 log.debug('Skipping %s as prefix does not match', snapshot.id)
                 continue
             if not snapshot.status == 'completed':
                 log.debug('Skipping %s as it is not a complete snapshot', snapshot.id)
                 continue
+            if volume_ids is not None and snapshot.volume_id not in volume_ids:
+                log.debug('Skipping %s as its volume was not selected', snapshot.id)
+                continue
+            if self._require_marker_tag and snapshot.tags.get(marker_key) != marker_value:
+                log.debug('Skipping %s as it does not have the %s tag', snapshot.id, marker_key)
+                continue
+            if SOURCE_REGION_TAG in snapshot.tags:
+                # Removed by remove_old_copies in the region it was copied from
+                log.debug('Skipping %s as it is a copy from %s', snapshot.id, snapshot.tags[SOURCE_REGION_TAG])
+                continue
 
             log.debug('Found %s: %s', snapshot.id, snapshot.description)
-            vol_snap_map.setdefault(snapshot.volume_id, []).append(snapshot)
-
-        for volume_id, most_recent_snapshots in vol_snap_map.iteritems():
-            most_recent_snapshots.sort(key=lambda s: s.start_time, reverse=True)
-            num_snapshots = len(most_recent_snapshots)
-            log.info('Found %d snapshots for %s', num_snapshots, volume_id)
-
-            for i in range(self._snapshots_per_volume, num_snapshots):
-                snapshot = most_recent_snapshots[i]
-                snapshot_id = snapshot.id
-                snapshot_description = snapshot.description
-                self._info(subject=_status.parse_status('snapshot_delete', (snapshot_id, snapshot_description)),
-                    src_snapshot=snapshot_id,
-                    src_volume=volume_id,
-                    category='snapshots')
-                try:
-                    self._retryInCaseOfException(
-                        snapshot.delete,
-                        src_snapshot=snapshot_id,
-                        category='snapshots',
-                        type='alert',
-                        severity='high')
-                    self._info(subject=_status.parse_status('snapshot_delete_success', (snapshot_id, snapshot_description)),
-                        src_snapshot=snapshot_id,
-                        category='snapshots')
-                except BotoServerError, e:
-                    log.error('%s: %s' % (_status.parse_status('snapshot_delete_error', (snapshot_id, snapshot_description)), e.message))
-                    SplunkLogging.write(
-                        subject=_status.parse_status('snapshot_delete_error', (snapshot_id, snapshot_description)),
-                        body=e.message,
-                        src_snapshot=snapshot_id,
-                        category='snapshots',
-                        type='alarm',
-                        severity='critical')
+            kept += 1
+            yield snapshot
+        self._info(subject=_status.event('snapshots_fetch_summary', (str(fetched), str(kept))),
+            category='snapshots')
+
+    def remove_old_snapshots(self):
+        ''' Loop through this account's snapshots, and remove the ones the
+        retention policy no longer keeps '''
+        log.info('Configured to keep %s per volume', self._retention_policy)
+        self._info(
+            subject=_status.event('snapshots_fetch', self._region),
+            category='snapshots')
+        self._resume_journal()
+        journal = self._journal
+        if journal and journal.planned_deletes is not None:
+            # The run was interrupted while deleting, so the snapshots need not be listed again
+            delete = [SnapshotRecord(snapshot_id, volume_id, start_time, 'completed', description, {})
+                for snapshot_id, volume_id, start_time, description in journal.planned_deletes]
+            self._info(subject=_status.event('journal_retention', (str(len([r for r in delete if not journal.is_deleted(r.id)])),
+                    str(len(delete)))),
+                category='snapshots')
+        else:
+            keep, delete = retention.plan(self._timed_backup_snapshots(), self._retention_policy)
+            log.info('Keeping %d snapshots and deleting %d', len(keep), len(delete))
+            if journal:
+                journal.plan_deletes(delete)
+        self._delete_snapshots(delete)
+        return True
+
+    def _timed_backup_snapshots(self):
+        return timed_iter(self._backup_snapshots_for_retention(), self._metrics, 'discovery', self._region)
+
+    def _delete_snapshots(self, snapshots):
+        retries = self._stats.get('retries')
+        retry_sleep = self._stats.get('retry_sleep')
+        with self._metrics.phase('retention', self._region):
+            count, elapsed = WorkerPool(self._delete_workers, name='delete').run(
+                self._delete_snapshot, ((s.volume_id, s) for s in snapshots if not self._journaled_delete(s)))
+        deleted = self._stats.get('snapshots_deleted')
+        self._info(subject=_status.event('snapshot_delete_summary', (str(deleted), str(count - deleted),
+                str(self._stats.get('retries') - retries), '%.2f' % elapsed,
+                '%.2f' % (deleted / elapsed if elapsed else 0), str(self._delete_workers))),
+            retry_count=str(self._stats.get('retries') - retries),
+            retry_sleep='%.2f' % (self._stats.get('retry_sleep') - retry_sleep),
+            category='snapshots')
+        self._inventory.commit()
+
+    def complete_journal(self):
+        ''' Ends the journaled run once all of it succeeded, compacting the journal '''
+        if not self._journal:
+            return None
+        summary = self._journal.complete()
+        self._info(subject=_status.event('journal_complete', (summary['run'], str(summary['created']),
+                str(summary['deleted']), str(summary['entries']))),
+            category='snapshots')
+        return summary
+
+    def _journaled_delete(self, snapshot):
+        if not self._journal or not self._journal.is_deleted(snapshot.id):
+            return False
+        log.debug('Skipping %s as the journal has it deleted', snapshot.id)
+        return True
+
+    def plan(self, snapshot=True, remove=True):
+        ''' Works out every snapshot the snapshot and retention phases would
+        create and delete, without making any mutating calls. Returns the plan
+        as a JSON-serialisable dict, with the API calls it predicts and an
+        estimate of how long they take at the configured concurrency '''
+        started = time.time()
+        creates = []
+        deletes = []
+        keep = []
+        if snapshot:
+            volumes_seen = {}
+            def volumes():
+                for volume in timed_iter(self.iter_volumes_to_snapshot(), self._metrics, 'discovery', self._region):
+                    volumes_seen[volume.id] = self.remove_reserved_tags(volume.tags)
+                    yield volume
+            for volume in self._changed_volumes(volumes()):
+                creates.append({'volume_id': volume.id, 'description': self._snapshot_description(volume),
+                    'tags': self._snapshot_tags(volume), 'volume_tags': volume.tags})
+            self._inventory.set_volumes(volumes_seen)
+            self._change_summary(len(volumes_seen))
+        if remove:
+            # Snapshots created by this run are still pending when retention runs, so they are not counted
+            keep, delete = retention.plan(self._timed_backup_snapshots(), self._retention_policy)
+            deletes = [{'snapshot_id': s.id, 'volume_id': s.volume_id, 'description': s.description,
+                'start_time': s.start_time} for s in delete]
+        elapsed = time.time() - started
+        self._inventory.commit()
+
+        discovery = dict((action, count) for action, count in self._stats.items() if action.startswith('Describe'))
+        calls = sum(discovery.values())
+        latency = elapsed / calls if calls else planning.DEFAULT_CALL_LATENCY
+        api_calls = dict(discovery, CreateSnapshot=len(creates), DeleteSnapshot=len(deletes))
+        estimated = (planning.estimate_seconds(len(creates), self._workers, latency) +
+            planning.estimate_seconds(len(deletes), self._delete_workers, latency))
+        self._info(subject=_status.event('plan_summary', (self._region, str(len(creates)), str(len(deletes)),
+                str(len(creates) + len(deletes)), '%.0f' % estimated)),
+            category='plan')
+        return {
+            'region': self._region,
+            'account': self._cross_account_number,
+            'role': self._cross_account_role,
+            'filters': self.get_selection().filters or None,
+            'selection': str(self.get_selection()),
+            'retention': str(self._retention_policy),
+            'creates': creates,
+            'deletes': deletes,
+            'keeps': len(keep),
+            'unchanged': self._stats.get('volumes_unchanged'),
+            'api_calls': api_calls,
+            # Used instead of CreateSnapshot's tags when the endpoint cannot tag on creation
+            'fallback_api_calls': {'CreateTags': planning.tag_batches(creates)},
+            'call_latency': round(latency, 3),
+            'workers': self._workers,
+            'delete_workers': self._delete_workers,
+            'estimated_seconds': round(estimated, 1),
+        }
+
+    def apply(self, plan, wait_timeout=None):
+        ''' Creates and deletes the snapshots listed by a plan from plan(),
+        without looking up volumes or snapshots again. With wait_timeout, the
+        new snapshots are waited for before anything is deleted '''
+        if plan['region'] != self._region or plan.get('account') != self._cross_account_number:
+            raise BackupMonkeyException(_status.parse_status('plan_mismatch', plan['region']),
+                subject=_status.event('plan_mismatch', plan['region']),
+                category='plan')
+        self._info(subject=_status.event('plan_apply', (str(len(plan['creates'])), str(len(plan['deletes'])),
+                self._region)),
+            category='plan')
+        self._resume_journal()
+        creates = [c for c in plan['creates'] if not self._journaled_create(c['volume_id'])]
+        if creates:
+            self._start_pending_limiter()
+            try:
+                with self._metrics.phase('snapshot', self._region):
+                    count, elapsed = WorkerPool(self._workers, name='snapshot').run(
+                        lambda c: self._create_volume_snapshot(c['volume_id'], c['description'], c['tags'], c['volume_tags']),
+                        creates)
+            finally:
+                self._tag_batcher.flush()
+                self._inventory.commit()
+            self._snapshot_summary(count, elapsed)
+        if wait_timeout and self._created:
+            self.wait_for_snapshots(wait_timeout)
+        if plan['deletes']:
+            self._delete_snapshots(SnapshotRecord(d['snapshot_id'], d['volume_id'], d['start_time'], 'completed',
+                d['description'], {}) for d in plan['deletes'])
         return True
 
+    def _delete_snapshot(self, item):
+        ''' Deletes a single snapshot, logging rather than raising on failure '''
+        volume_id, snapshot = item
+        snapshot_id = snapshot.id
+        snapshot_description = snapshot.description
+        self._info(subject=_status.event('snapshot_delete', (snapshot_id, snapshot_description)),
+            src_snapshot=snapshot_id,
+            src_volume=volume_id,
+            category='snapshots')
+        if self._journal:
+            self._journal.deleting(snapshot_id)
+        try:
+            self._retryInCaseOfException(
+                self._conn.delete_snapshot, snapshot_id,
+                src_snapshot=snapshot_id,
+                action='DeleteSnapshot',
+                category='snapshots',
+                type='alert',
+                severity='high')
+            self._stats.incr('snapshots_deleted')
+            self._inventory.remove_snapshot(snapshot_id)
+            if self._journal:
+                self._journal.deleted(snapshot_id)
+            self._info(subject=_status.event('snapshot_delete_success', (snapshot_id, snapshot_description)),
+                src_snapshot=snapshot_id,
+                category='snapshots')
+        except BotoServerError, e:
+            if e.error_code == 'InvalidSnapshot.NotFound':
+                self._inventory.remove_snapshot(snapshot_id)
+                if self._journal:
+                    self._journal.deleted(snapshot_id)
+            error = _status.event('snapshot_delete_error', (snapshot_id, snapshot_description))
+            log.error('%s: %s', error, e.message)
+            SplunkLogging.write(
+                subject=error,
+                body=e.message,
+                src_snapshot=snapshot_id,
+                category='snapshots',
+                type='alarm',
+                severity='critical')
+
     def _retryInCaseOfException(self, func, *args, **kwargs):
-        '''Retry with sleep in case of RequestLimitExceeded exception'''
-        result = None
-        for attempt in range(1, 6):
+        '''Retry throttling and transient errors with exponential backoff and jitter.
+        Permanent errors, and errors once the attempts or the run's retry budget
+        are used up, are re-raised. action names the EC2 action func makes, for
+        the retry metrics'''
+        action = kwargs.pop('action')
+        attempt = 0
+        while True:
+            attempt += 1
             try:
-                result = func(*args)
+                with self._limiter:
+                    result = func(*args)
             except BotoServerError, e:
-                sleep_time = attempt + 5
-                log.error("Encountered Error %s on %s, waiting %d seconds then retrying", e.message, str(kwargs), sleep_time)
+                kind = classify(e)
+                if kind == THROTTLE:
+                    self._limiter.on_throttle()
+                if not self._retry_policy.should_retry(kind, attempt):
+                    if kind == PERMANENT:
+                        log.error("Encountered %s Error %s on %s, not retrying", kind, e.message, str(kwargs))
+                        raise
+                    log.error("Encountered Error %s on %s, %d retries failed, continuing", e.message, str(kwargs), attempt - 1)
+                    splunk_kwargs = {
+                                        'subject':_status.event('retry_all_fail', str(attempt - 1)),
+                                        'body':e.message,
+                                        'retry_count':str(attempt - 1)
+                                    }
+                    splunk_kwargs.update(kwargs)
+                    SplunkLogging.write(**splunk_kwargs)
+                    raise
+                sleep_time = self._retry_policy.delay(attempt)
+                log.error("Encountered %s Error %s on %s, waiting %.2f seconds then retrying", kind, e.message, str(kwargs), sleep_time)
                 splunk_kwargs = {
-                                    'subject':_status.parse_status('retry_after_sleep', (str(attempt), str(sleep_time))),
-                                    'body':e.message
+                                    'subject':_status.event('retry_after_sleep', (str(attempt), '%.2f' % sleep_time)),
+                                    'body':e.message,
+                                    'retry_count':str(attempt),
+                                    'retry_sleep':'%.2f' % sleep_time
                                 }
                 splunk_kwargs.update(kwargs)
                 SplunkLogging.write(**splunk_kwargs)
+                self._stats.incr('retries')
+                self._stats.incr('retry_sleep', sleep_time)
+                self._metrics.add_retry_sleep(action, self._region, sleep_time)
                 time.sleep(sleep_time)
-                continue
             except Exception, e:
                 log.error("Encountered Error %s on %s", e.message, str(kwargs))
-                raise e
+                raise
             else:
+                self._limiter.on_success()
                 return result
-        else:
-            log.error("Encountered Error %s on %s, %d retries failed, continuing", e.message, str(kwargs), attempt)
-            splunk_kwargs = {
-                                'subject':_status.parse_status('retry_all_fail', (str(attempt))),
-                                'body':e.message
-                            }
-            splunk_kwargs.update(kwargs)
-            SplunkLogging.write(**splunk_kwargs)
-            raise e
 
 class ErrorFilter(object):
   def filter(self, record):
@@ -303,6 +1410,7 @@ class Logging(object):
     _log_simple_format = '%(asctime)s [%(levelname)s] %(message)s'
     _log_detailed_format = '%(asctime)s [%(levelname)s] [%(name)s(%(lineno)s):%(funcName)s] %(message)s'
     _log_date_format = '%F %T'
+    _lock = threading.Lock()
 
     def getHandler(self, stream, format_, handler_filter):
         _handler = logging.StreamHandler(stream)
@@ -317,6 +1425,10 @@ class Logging(object):
 
     def configure(self, verbosity = None, module = __name__):
         ''' Configure the logging format and verbosity '''
+        with self._lock:
+            self._configure(verbosity, module)
+
+    def _configure(self, verbosity, module):
         _log = logging.getLogger(module)
         self.clearLoggingHandlers(_log)
         # Configure our logging output
@@ -0,0 +1,260 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, shlex, threading, time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from exception import BackupMonkeyException
+from metrics import _escape, _number
+from schedule import CronSchedule
+
+__all__ = ('DaemonJob', 'Scheduler', 'StatusServer', 'load_jobs', 'parse_address')
+log = logging.getLogger(__name__)
+
+class DaemonJob(object):
+    ''' A named run of backup-monkey with its own command line arguments, on a
+    cron schedule, along with what happened the last time it ran '''
+
+    def __init__(self, name, schedule, args):
+        self.name = name
+        self.schedule = schedule
+        self.args = args
+        self.options = None
+        self.regions = []
+        self.lock = threading.Lock()
+        self.next_run = None
+        self.running_since = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_run = None
+        self.last_success = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'schedule': str(self.schedule),
+            'args': self.args,
+            'next_run': self.next_run,
+            'running_since': self.running_since,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_run': self.last_run,
+            'last_success': self.last_success,
+        }
+
+def load_jobs(path):
+    ''' Reads a jobs file such as
+    {"jobs": [{"name": "prod", "schedule": "0 */6 * * *", "args": ["--select", "env=prod"]}]}.
+    args may also be given as a single string, split as a shell would '''
+    with open(path) as f:
+        config = json.load(f)
+    entries = config.get('jobs') if isinstance(config, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('expected an object with a list of "jobs"')
+    jobs = []
+    for entry in entries:
+        name = str(entry.get('name', '')).strip()
+        if not name:
+            raise ValueError('every job needs a "name": %s' % entry)
+        if name in [j.name for j in jobs]:
+            raise ValueError('job `%s` is listed twice' % name)
+        schedule = CronSchedule(str(entry.get('schedule', '')))
+        schedule.next_after(time.time())
+        args = entry.get('args') or []
+        if isinstance(args, basestring):
+            args = shlex.split(args)
+        jobs.append(DaemonJob(name, schedule, [str(a) for a in args]))
+    return jobs
+
+def parse_address(value):
+    ''' Converts HOST:PORT, or just PORT, to a (host, port) pair '''
+    host, _, port = value.rpartition(':')
+    if not port.isdigit() or not 0 <= int(port) <= 65535:
+        raise ValueError('invalid address `%s`, expected HOST:PORT' % value)
+    return host or '127.0.0.1', int(port)
+
+class Scheduler(object):
+    ''' Starts each job on its own thread when its schedule comes due, calling
+    run(job). A job still running when it comes due again is skipped rather
+    than run twice. Runs missed while the process was busy or suspended are
+    collapsed into one '''
+
+    # Wake at least this often, so a change to the system clock is noticed
+    max_sleep = 60.0
+
+    def __init__(self, jobs, run, clock=time.time):
+        self.jobs = jobs
+        self._run = run
+        self._clock = clock
+        self._stop = threading.Event()
+        self._threads = []
+        self.started = clock()
+        self.last_tick = None
+        for job in jobs:
+            job.next_run = job.schedule.next_after(self.started)
+
+    def tick(self):
+        ''' Starts the jobs that are due, returns the seconds until the next one is '''
+        now = self._clock()
+        self.last_tick = now
+        for job in self.jobs:
+            if job.next_run <= now:
+                self.start(job)
+                job.next_run = job.schedule.next_after(now)
+        self._threads = [t for t in self._threads if t.is_alive()]
+        return max(0.0, min(job.next_run for job in self.jobs) - now)
+
+    def start(self, job):
+        ''' Runs job on a new thread, unless it is still running. Returns the thread '''
+        if not job.lock.acquire(False):
+            job.skipped += 1
+            log.warning('Job %s is still running since %s, skipping this run', job.name,
+                time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(job.running_since)))
+            return None
+        job.running_since = self._clock()
+        thread = threading.Thread(target=self._run_job, args=(job, ), name='job-%s' % job.name)
+        self._threads.append(thread)
+        thread.start()
+        return thread
+
+    def _run_job(self, job):
+        started = job.running_since
+        error = None
+        log.info('Starting job %s', job.name)
+        try:
+            self._run(job)
+        except BackupMonkeyException as e:
+            error = str(e)
+        except Exception as e:
+            log.exception('Unexpected error running job %s', job.name)
+            error = '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            finished = self._clock()
+            job.runs += 1
+            job.last_run = {'started': started, 'finished': finished, 'elapsed': round(finished - started, 3),
+                'ok': error is None, 'error': error}
+            if error is None:
+                job.last_success = finished
+                log.info('Job %s completed in %.1fs', job.name, finished - started)
+            else:
+                job.failures += 1
+                log.error('Job %s failed after %.1fs: %s', job.name, finished - started, error)
+            job.running_since = None
+            job.lock.release()
+
+    def run_forever(self):
+        ''' Ticks until stop() is called, then waits for running jobs to finish '''
+        log.info('Scheduling %d jobs: %s', len(self.jobs),
+            ', '.join('%s (%s)' % (j.name, j.schedule) for j in self.jobs))
+        while not self._stop.is_set():
+            self._stop.wait(min(self.tick(), self.max_sleep))
+        self.join()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        for thread in list(self._threads):
+            thread.join()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def health(self):
+        ''' (healthy, details). The scheduler is healthy while it is running and
+        ticking; jobs whose last run failed are listed but do not make it unhealthy '''
+        now = self._clock()
+        ticking = self.last_tick is not None and now - self.last_tick <= self.max_sleep * 2
+        healthy = ticking and not self.stopped
+        return healthy, {
+            'status': 'ok' if healthy else 'unhealthy',
+            'uptime_seconds': round(now - self.started, 3),
+            'running': sorted(j.name for j in self.jobs if j.running_since is not None),
+            'failing': sorted(j.name for j in self.jobs if j.last_run and not j.last_run['ok']),
+        }
+
+    def to_prometheus(self, prefix='backup_monkey'):
+        ''' Per job run counts and last run times, in the Prometheus text format '''
+        lines = []
+        def metric(name, kind, help_text, value):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for job in self.jobs:
+                sample = value(job)
+                if sample is not None:
+                    lines.append('%s_%s{job="%s"} %s' % (prefix, name, _escape(job.name), _number(sample)))
+        metric('job_runs_total', 'counter', 'Scheduled runs of the job', lambda j: j.runs)
+        metric('job_failures_total', 'counter', 'Scheduled runs of the job that failed', lambda j: j.failures)
+        metric('job_skipped_total', 'counter', 'Scheduled runs skipped because the job was still running', lambda j: j.skipped)
+        metric('job_running', 'gauge', 'Whether the job is running', lambda j: int(j.running_since is not None))
+        metric('job_last_run_seconds', 'gauge', 'How long the last run of the job took',
+            lambda j: j.last_run and j.last_run['elapsed'])
+        metric('job_last_success_timestamp_seconds', 'gauge', 'When the last successful run of the job finished',
+            lambda j: j.last_success)
+        metric('job_next_run_timestamp_seconds', 'gauge', 'When the job is next due', lambda j: j.next_run)
+        return '\n'.join(lines) + '\n'
+
+class _StatusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        scheduler = self.server.scheduler
+        if path == '/health':
+            healthy, details = scheduler.health()
+            self._send(200 if healthy else 503, json.dumps(details, sort_keys=True), 'application/json')
+        elif path == '/jobs':
+            self._send(200, json.dumps([j.to_dict() for j in scheduler.jobs], indent=2, sort_keys=True), 'application/json')
+        elif path == '/metrics':
+            body = scheduler.to_prometheus()
+            if self.server.metrics:
+                body = self.server.metrics.to_prometheus() + body
+            self._send(200, body, 'text/plain; version=0.0.4')
+        else:
+            self._send(404, json.dumps({'error': 'not found', 'paths': ['/health', '/jobs', '/metrics']}), 'application/json')
+
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    ''' Serves /health, /jobs (each job's schedule and last run) and /metrics
+    (the API call metrics and job counts for Prometheus) on its own thread '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, scheduler, metrics=None):
+        HTTPServer.__init__(self, address, _StatusHandler)
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='status-server')
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Serving /health, /jobs and /metrics on http://%s:%d', *self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
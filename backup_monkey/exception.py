@@ -20,4 +20,6 @@ class BackupMonkeyException(Exception):
     kwargs['type'] = 'alarm'
     kwargs['severity'] = 'critical'
     SplunkLogging.write(**kwargs)
+    # The run is usually about to stop, so make sure the alarm is on disk
+    SplunkLogging.flush()
     super(Exception, self).__init__(*args)
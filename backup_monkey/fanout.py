@@ -0,0 +1,63 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, time
+
+from exception import BackupMonkeyException
+from workers import WorkerPool
+
+__all__ = ('JobResult', 'run_jobs', 'format_results')
+log = logging.getLogger(__name__)
+
+class JobResult(object):
+    ''' The outcome of one unit of fan-out work, e.g. a single region '''
+
+    def __init__(self, name):
+        self.name = name
+        self.ok = False
+        self.elapsed = 0.0
+        self.error = None
+
+def run_jobs(jobs, func, workers=None):
+    ''' Runs func(job) for every (name, job) pair on up to workers threads.
+    A failing job never stops the others; its error is kept on its result.
+    Returns the results in the order the jobs were given '''
+    jobs = list(jobs)
+    results = dict((name, JobResult(name)) for name, job in jobs)
+
+    def run_one(item):
+        name, job = item
+        result = results[name]
+        start = time.time()
+        try:
+            func(job)
+            result.ok = True
+        except BackupMonkeyException as e:
+            result.error = str(e)
+        except Exception as e:
+            log.exception('Unexpected error running %s', name)
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            result.elapsed = time.time() - start
+
+    WorkerPool(workers or len(jobs), name='fanout').run(run_one, jobs)
+    return [results[name] for name, job in jobs]
+
+def format_results(results, heading='Region'):
+    ''' Formats results as a fixed width table, one line per job '''
+    width = max([len(heading)] + [len(r.name) for r in results])
+    lines = ['%-*s  %-6s  %9s  %s' % (width, heading, 'Status', 'Seconds', 'Error')]
+    for r in results:
+        line = '%-*s  %-6s  %9.2f  %s' % (width, r.name, 'OK' if r.ok else 'FAILED', r.elapsed, r.error or '')
+        lines.append(line.rstrip())
+    return lines
@@ -0,0 +1,94 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, os, time
+
+__all__ = ('DiskCache', 'default_cache_dir', 'instance_identity')
+log = logging.getLogger(__name__)
+
+# One request returns both the region and the account of the instance
+IDENTITY_URL = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
+
+def default_cache_dir():
+    ''' $XDG_CACHE_HOME/backup-monkey, or ~/.cache/backup-monkey '''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'backup-monkey')
+
+class DiskCache(object):
+    ''' JSON values kept in a file for ttl seconds after they were stored. A
+    missing or unreadable file is treated as empty, and a cache that cannot be
+    written is skipped, so the cache only ever saves time '''
+
+    def __init__(self, path, ttl, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        entry = self._load().get(key)
+        if not isinstance(entry, dict) or self._clock() - entry.get('stored', 0) >= self.ttl:
+            return None
+        return entry.get('value')
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        entries = self._load()
+        entries[key] = {'stored': self._clock(), 'value': value}
+        temp = '%s.%d' % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp, 'w') as f:
+                json.dump(entries, f)
+            os.rename(temp, self.path)
+        except (IOError, OSError) as e:
+            log.debug('Cannot write the cache %s: %s', self.path, e)
+
+    def cached(self, key, fetch):
+        ''' The cached value of key, or else fetch()'s, which is cached unless it is None '''
+        value = self.get(key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.set(key, value)
+        else:
+            log.debug('Using cached %s from %s', key, self.path)
+        return value
+
+def _fetch_identity(timeout, retries):
+    from boto.utils import retry_url
+    document = retry_url(IDENTITY_URL, num_retries=retries, timeout=timeout)
+    try:
+        document = json.loads(document)
+        return {'region': document['region'], 'account': document['accountId']}
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def instance_identity(cache=None, timeout=2, retries=2):
+    ''' The region and account of the EC2 instance this is running on, as a
+    dict, or None when it cannot be found out '''
+    if cache is None:
+        return _fetch_identity(timeout, retries)
+    return cache.cached('instance_identity', lambda: _fetch_identity(timeout, retries))
@@ -0,0 +1,183 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, sqlite3, threading, time
+from collections import namedtuple
+
+__all__ = ('SnapshotRecord', 'Inventory', 'SqliteInventory')
+log = logging.getLogger(__name__)
+
+class SnapshotRecord(namedtuple('SnapshotRecord', 'id volume_id start_time status description tags')):
+    ''' The parts of a boto Snapshot that retention needs, without the boto object '''
+    __slots__ = ()
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(snapshot.id, snapshot.volume_id, snapshot.start_time, snapshot.status, snapshot.description,
+            dict(snapshot.tags) if snapshot.tags else {})
+
+class Inventory(object):
+    ''' The volumes and Backup Monkey snapshots seen during a run, shared by the
+    snapshot and retention phases so neither has to list them again.
+
+    Snapshots are stored as records with the SnapshotRecord fields. The
+    inventory is fresh once it holds a complete snapshot listing, after which
+    it is kept up to date with every snapshot created or deleted '''
+
+    persistent = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._synced_at = None
+        self.volume_ids = None
+
+    def set_volumes(self, volumes):
+        ''' Records the volumes selected for snapshots, as a {volume_id: tags} dict '''
+        with self._lock:
+            self.volume_ids = set(volumes)
+
+    def is_fresh(self):
+        return self._synced_at is not None
+
+    def sync(self, records):
+        ''' Replaces every snapshot with a complete listing, yielding each record
+        as it is stored. The inventory only becomes fresh if the listing is
+        consumed to the end '''
+        with self._lock:
+            self._snapshots = {}
+            self._synced_at = None
+        for record in records:
+            with self._lock:
+                self._snapshots[record.id] = record
+            yield record
+        with self._lock:
+            self._synced_at = time.time()
+
+    def add_snapshot(self, record):
+        with self._lock:
+            self._snapshots[record.id] = record
+
+    def remove_snapshot(self, snapshot_id):
+        with self._lock:
+            self._snapshots.pop(snapshot_id, None)
+
+    def snapshots(self):
+        with self._lock:
+            return self._snapshots.values()
+
+    def pending_snapshot_ids(self):
+        with self._lock:
+            return [r.id for r in self._snapshots.itervalues() if r.status == 'pending']
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteInventory(Inventory):
+    ''' An Inventory persisted in a SQLite database, so later runs only need to
+    describe the snapshots still pending instead of listing every snapshot.
+    One database can hold many regions and accounts, each under its own scope.
+    Every write is committed straight away, so scopes run side by side never
+    wait on a transaction left open by another. A full listing is forced once
+    the last one is older than max_age seconds '''
+
+    persistent = True
+
+    def __init__(self, path, scope, max_age=86400):
+        super(SqliteInventory, self).__init__()
+        self._scope = scope
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                scope TEXT, id TEXT, volume_id TEXT, start_time TEXT, status TEXT, description TEXT, tags TEXT,
+                PRIMARY KEY (scope, id));
+            CREATE INDEX IF NOT EXISTS snapshots_volume ON snapshots (scope, volume_id);
+            CREATE TABLE IF NOT EXISTS volumes (
+                scope TEXT, id TEXT, tags TEXT, last_seen REAL,
+                PRIMARY KEY (scope, id));
+            CREATE TABLE IF NOT EXISTS syncs (scope TEXT PRIMARY KEY, synced_at REAL);
+        ''')
+        row = self._db.execute('SELECT synced_at FROM syncs WHERE scope = ?', (scope,)).fetchone()
+        if row and time.time() - row[0] < max_age:
+            self._synced_at = row[0]
+            log.debug('Inventory for %s was last fully synced at %s', scope, time.ctime(row[0]))
+
+    def _record(self, row):
+        return SnapshotRecord(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]) if row[5] else {})
+
+    def _row(self, record):
+        return (self._scope, record.id, record.volume_id, record.start_time, record.status, record.description,
+            json.dumps(record.tags) if record.tags else None)
+
+    def set_volumes(self, volumes):
+        super(SqliteInventory, self).set_volumes(volumes)
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?)',
+                ((self._scope, volume_id, json.dumps(tags) if tags else None, now) for volume_id, tags in volumes.iteritems()))
+            self._db.commit()
+
+    def sync(self, records):
+        # The listing is committed a batch at a time, so the scope is marked
+        # stale until it is complete in case the run dies part way
+        with self._lock:
+            self._synced_at = None
+            self._db.execute('DELETE FROM syncs WHERE scope = ?', (self._scope,))
+            self._db.execute('DELETE FROM snapshots WHERE scope = ?', (self._scope,))
+            self._db.commit()
+        batch = []
+        for record in records:
+            batch.append(self._row(record))
+            if len(batch) >= 1000:
+                with self._lock:
+                    self._db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                    self._db.commit()
+                batch = []
+            yield record
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            self._synced_at = time.time()
+            self._db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)', (self._scope, self._synced_at))
+            self._db.commit()
+
+    def add_snapshot(self, record):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', self._row(record))
+            self._db.commit()
+
+    def remove_snapshot(self, snapshot_id):
+        with self._lock:
+            self._db.execute('DELETE FROM snapshots WHERE scope = ? AND id = ?', (self._scope, snapshot_id))
+            self._db.commit()
+
+    def snapshots(self):
+        with self._lock:
+            rows = self._db.execute('SELECT id, volume_id, start_time, status, description, tags FROM snapshots WHERE scope = ?',
+                (self._scope,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def pending_snapshot_ids(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT id FROM snapshots WHERE scope = ? AND status = 'pending'",
+                (self._scope,))]
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,204 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, os, threading, time, uuid
+
+__all__ = ('RunJournal', )
+log = logging.getLogger(__name__)
+
+class RunJournal(object):
+    ''' An append-only record of the work a run has done, so a run that died
+    part way can be resumed without doing it again. Each entry is a JSON line
+    carrying the run id.
+
+    Creates and deletes are journaled before the call is made (in flight) and
+    once it succeeded, and tag batches once they were sent. Every entry is
+    flushed to the operating system as it is written, so it survives the
+    process dying, and the file is fsynced every sync_every entries or
+    sync_interval seconds, so at most that much work is redone after the host
+    goes down.
+
+    With resume, the last run that never completed is continued under its
+    run id. A completed run compacts the journal to a single summary line '''
+
+    def __init__(self, path, resume=False, sync_every=100, sync_interval=1.0, clock=time.time):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._creating = {}
+        self._created = {}
+        self._tagged = set()
+        self._deleting = set()
+        self._deleted = set()
+        self.planned_deletes = None
+        self.entries = 0
+        self.run_id, entries = self._last_incomplete_run()
+        self.resumed = bool(resume and self.run_id)
+        if self.resumed:
+            for entry in entries:
+                self._apply(entry)
+        else:
+            if self.run_id:
+                log.warning('The journal %s has an unfinished run %s, starting a new one. Use --resume to continue it',
+                    path, self.run_id)
+            self.run_id = uuid.uuid4().hex
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(path, 'a')
+        self._unsynced = 0
+        self._synced_at = clock()
+        self._write({'op': 'resume' if self.resumed else 'begin'})
+
+    def _last_incomplete_run(self):
+        ''' The id and entries of the last run in the journal, unless it completed.
+        A line cut short by a crash is skipped '''
+        runs = {}
+        last = None
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        run_id = entry['run']
+                    except (ValueError, TypeError, KeyError):
+                        continue
+                    if entry.get('op') == 'begin' or run_id not in runs:
+                        runs[run_id] = []
+                    runs[run_id].append(entry)
+                    last = run_id
+        except IOError:
+            return None, []
+        if last is None or any(e.get('op') == 'complete' for e in runs[last]):
+            return None, []
+        return last, runs[last]
+
+    def _apply(self, entry):
+        op = entry.get('op')
+        if op == 'creating':
+            self._creating[entry['volume']] = entry
+        elif op == 'create':
+            self._creating.pop(entry['volume'], None)
+            self._created[entry['volume']] = entry
+            if entry.get('tagged'):
+                self._tagged.add(entry['snapshot'])
+        elif op == 'tag':
+            self._tagged.update(entry['snapshots'])
+        elif op == 'deleting':
+            self._deleting.add(entry['snapshot'])
+        elif op == 'delete':
+            self._deleting.discard(entry['snapshot'])
+            self._deleted.add(entry['snapshot'])
+        elif op == 'retention':
+            self.planned_deletes = entry['deletes']
+
+    def _write(self, entry):
+        entry['run'] = self.run_id
+        entry.setdefault('time', self._clock())
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            self._apply(entry)
+            self._file.write(line)
+            self._file.flush()
+            self.entries += 1
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or self._clock() - self._synced_at >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = self._clock()
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+
+    def creating(self, volume_id, description, tags):
+        self._write({'op': 'creating', 'volume': volume_id, 'description': description, 'tags': tags})
+
+    def created(self, record, tagged):
+        self._write({'op': 'create', 'volume': record.volume_id, 'snapshot': record.id, 'start_time': record.start_time,
+            'description': record.description, 'tags': record.tags, 'tagged': tagged})
+
+    def tagged(self, snapshot_ids):
+        self._write({'op': 'tag', 'snapshots': list(snapshot_ids)})
+
+    def deleting(self, snapshot_id):
+        self._write({'op': 'deleting', 'snapshot': snapshot_id})
+
+    def deleted(self, snapshot_id):
+        self._write({'op': 'delete', 'snapshot': snapshot_id})
+
+    def plan_deletes(self, records):
+        ''' Records the snapshots retention decided to delete, so a resumed run need not list them all again '''
+        self._write({'op': 'retention', 'deletes': [[r.id, r.volume_id, r.start_time, r.description] for r in records]})
+
+    @property
+    def created_count(self):
+        return len(self._created)
+
+    @property
+    def deleted_count(self):
+        return len(self._deleted)
+
+    def created_snapshot(self, volume_id):
+        ''' The id of the snapshot the run created of a volume, or None '''
+        entry = self._created.get(volume_id)
+        return entry['snapshot'] if entry else None
+
+    def is_deleted(self, snapshot_id):
+        return snapshot_id in self._deleted
+
+    def created_entries(self):
+        with self._lock:
+            return list(self._created.values())
+
+    def untagged(self):
+        ''' (snapshot_id, tags) of the created snapshots whose tags were not yet sent '''
+        with self._lock:
+            return [(e['snapshot'], e['tags']) for e in self._created.values() if e['snapshot'] not in self._tagged and e['tags']]
+
+    def in_flight_creates(self):
+        ''' The creating entries of volumes that may or may not have been snapshotted '''
+        with self._lock:
+            return list(self._creating.values())
+
+    def in_flight_deletes(self):
+        with self._lock:
+            return sorted(self._deleting)
+
+    def complete(self):
+        ''' Ends the run, replacing the journal with a summary of it '''
+        summary = {'op': 'complete', 'run': self.run_id, 'time': self._clock(), 'created': len(self._created),
+            'deleted': len(self._deleted), 'entries': self.entries}
+        with self._lock:
+            self._file.close()
+            temp = '%s.%d' % (self.path, os.getpid())
+            with open(temp, 'w') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.path)
+            self._file = open(self.path, 'a')
+            self._unsynced = 0
+        return summary
+
+    def close(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+            self._file.close()
@@ -0,0 +1,369 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import bisect, json, logging, os, threading, time
+from contextlib import contextmanager
+
+from boto.exception import BotoServerError
+
+from retry import classify, THROTTLE
+
+__all__ = ('Metrics', 'Histogram', 'InstrumentedConnection', 'operation_name', 'timed_iter')
+log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the API call latency histogram buckets
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds, in seconds, of the snapshot completion histogram buckets
+COMPLETION_BUCKETS = (60.0, 300.0, 600.0, 1800.0, 3600.0, 7200.0, 14400.0, 28800.0)
+
+# boto methods that take the API action as their first argument
+_ACTION_METHODS = ('get_list', 'get_object', 'get_status', 'make_request')
+
+def operation_name(name):
+    ''' Converts a boto method name such as delete_snapshot to the API action
+    it calls, DeleteSnapshot '''
+    return ''.join(part.capitalize() for part in name.strip('_').split('_'))
+
+class Histogram(object):
+    ''' Counts observations into fixed buckets, as Prometheus histograms do '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        ''' Yields (upper bound, observations at or below it), ending with +Inf '''
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        ''' The upper bound of the bucket holding the q quantile '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class _Operation(object):
+    __slots__ = ('calls', 'errors', 'throttles', 'retry_sleep', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.throttles = 0
+        self.retry_sleep = 0.0
+        self.latency = Histogram()
+
+class _Pool(object):
+    __slots__ = ('hits', 'misses', 'expired', 'setup')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.setup = Histogram()
+
+class _Copies(object):
+    ''' How long snapshot copies from one region to another took, and their size '''
+
+    def __init__(self):
+        self.seconds = Histogram(COMPLETION_BUCKETS)
+        self.gib = 0
+
+class Metrics(object):
+    ''' Counts, error codes, latency histograms, throttles and retry sleeps per
+    API operation and region, the time spent in each phase of a run and how
+    long snapshots took to complete or to copy to other regions and how often
+    EC2 connections were reused.
+    Safe to share between threads, and between every BackupMonkey of a run '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._phases = {}
+        self._completions = {}
+        self._copies = {}
+        self._pools = {}
+        self.started = time.time()
+
+    def _operation(self, operation, region):
+        key = (operation, region)
+        op = self._operations.get(key)
+        if op is None:
+            op = self._operations[key] = _Operation()
+        return op
+
+    def observe(self, operation, region, seconds, error=None):
+        ''' Records one API call, and its BotoServerError if it failed '''
+        with self._lock:
+            op = self._operation(operation, region)
+            op.calls += 1
+            op.latency.observe(seconds)
+            if error is not None:
+                code = getattr(error, 'error_code', None) or str(getattr(error, 'status', 'Unknown'))
+                op.errors[code] = op.errors.get(code, 0) + 1
+                if classify(error) == THROTTLE:
+                    op.throttles += 1
+
+    def call(self, operation, region, func, *args, **kwargs):
+        ''' Calls func, recording how long it took and whether it failed '''
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except BotoServerError, e:
+            self.observe(operation, region, time.time() - started, e)
+            raise
+        self.observe(operation, region, time.time() - started)
+        return result
+
+    def add_retry_sleep(self, operation, region, seconds):
+        with self._lock:
+            self._operation(operation, region).retry_sleep += seconds
+
+    def add_phase(self, phase, region, seconds):
+        with self._lock:
+            self._phases[(phase, region)] = self._phases.get((phase, region), 0.0) + seconds
+
+    def observe_completion(self, region, seconds):
+        ''' Records how long a snapshot took from its start time to completion '''
+        with self._lock:
+            histogram = self._completions.get(region)
+            if histogram is None:
+                histogram = self._completions[region] = Histogram(COMPLETION_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_copy(self, source, destination, seconds, gib):
+        ''' Records how long a copy of a snapshot of gib GiB took from being started to completion '''
+        with self._lock:
+            copies = self._copies.get((source, destination))
+            if copies is None:
+                copies = self._copies[(source, destination)] = _Copies()
+            copies.seconds.observe(seconds)
+            copies.gib += gib
+
+    def _pool(self, region):
+        pool = self._pools.get(region)
+        if pool is None:
+            pool = self._pools[region] = _Pool()
+        return pool
+
+    def pool_hit(self, region):
+        ''' Records an API call made on a connection that was already open '''
+        with self._lock:
+            self._pool(region).hits += 1
+
+    def pool_miss(self, region, seconds, expired=False):
+        ''' Records a new connection, and how long it took to make. expired is
+        True when it replaces one whose credentials were refreshed '''
+        with self._lock:
+            pool = self._pool(region)
+            pool.misses += 1
+            pool.expired += int(expired)
+            pool.setup.observe(seconds)
+
+    @contextmanager
+    def phase(self, phase, region):
+        ''' Adds the time spent in the with block to the phase '''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, region, time.time() - started)
+
+    def to_dict(self):
+        ''' A JSON-serialisable summary '''
+        with self._lock:
+            operations = []
+            for (operation, region), op in sorted(self._operations.items()):
+                latency = op.latency
+                operations.append({
+                    'operation': operation,
+                    'region': region,
+                    'calls': op.calls,
+                    'errors': dict(op.errors),
+                    'throttles': op.throttles,
+                    'retry_sleep_seconds': round(op.retry_sleep, 3),
+                    'latency_seconds': {
+                        'sum': round(latency.sum, 3),
+                        'mean': round(latency.sum / latency.count, 3) if latency.count else 0.0,
+                        'p50': round(latency.quantile(0.5), 3),
+                        'p90': round(latency.quantile(0.9), 3),
+                        'p99': round(latency.quantile(0.99), 3),
+                        'max': round(latency.max, 3),
+                    },
+                })
+            phases = [{'phase': phase, 'region': region, 'seconds': round(seconds, 3)}
+                for (phase, region), seconds in sorted(self._phases.items())]
+            completions = [{'region': region, 'snapshots': h.count,
+                'p50': round(h.quantile(0.5), 1), 'p90': round(h.quantile(0.9), 1), 'max': round(h.max, 1)}
+                for region, h in sorted(self._completions.items())]
+            copies = [{'source': source, 'destination': destination, 'copies': c.seconds.count, 'gib': c.gib,
+                'p50': round(c.seconds.quantile(0.5), 1), 'p90': round(c.seconds.quantile(0.9), 1), 'max': round(c.seconds.max, 1)}
+                for (source, destination), c in sorted(self._copies.items())]
+            pools = [{'region': region, 'hits': p.hits, 'misses': p.misses, 'expired': p.expired,
+                'setup_seconds': {'sum': round(p.setup.sum, 3), 'max': round(p.setup.max, 3)}}
+                for region, p in sorted(self._pools.items())]
+        return {
+            'started': self.started,
+            'elapsed_seconds': round(time.time() - self.started, 3),
+            'operations': operations,
+            'phases': phases,
+            'snapshot_completion_seconds': completions,
+            'snapshot_copy_seconds': copies,
+            'connection_pool': pools,
+        }
+
+    def to_prometheus(self, prefix='backup_monkey'):
+        ''' The metrics in the Prometheus text exposition format '''
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s_%s%s{%s} %s' % (prefix, name, suffix,
+                    ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels), _number(value)))
+        with self._lock:
+            operations = sorted(self._operations.items())
+            phases = sorted(self._phases.items())
+            labels = lambda operation, region: [('operation', operation), ('region', region)]
+            metric('api_calls_total', 'counter', 'EC2 and STS API calls made',
+                [('', labels(*key), op.calls) for key, op in operations])
+            metric('api_errors_total', 'counter', 'API calls that failed, by error code',
+                [('', labels(*key) + [('code', code)], count) for key, op in operations for code, count in sorted(op.errors.items())])
+            metric('api_throttles_total', 'counter', 'API calls that were throttled',
+                [('', labels(*key), op.throttles) for key, op in operations])
+            metric('api_retry_sleep_seconds_total', 'counter', 'Time spent waiting to retry API calls',
+                [('', labels(*key), op.retry_sleep) for key, op in operations])
+            samples = []
+            for key, op in operations:
+                for bound, total in op.latency.cumulative():
+                    samples.append(('_bucket', labels(*key) + [('le', '+Inf' if bound == float('inf') else _number(bound))], total))
+                samples.append(('_sum', labels(*key), op.latency.sum))
+                samples.append(('_count', labels(*key), op.latency.count))
+            metric('api_latency_seconds', 'histogram', 'API call latency', samples)
+            # Summed over every run of a daemon, so it only ever grows
+            metric('phase_seconds_total', 'counter', 'Time spent in each phase of the runs',
+                [('', [('phase', phase), ('region', region)], seconds) for (phase, region), seconds in phases])
+            samples = []
+            for region, histogram in sorted(self._completions.items()):
+                for bound, total in histogram.cumulative():
+                    samples.append(('_bucket', [('region', region), ('le', '+Inf' if bound == float('inf') else _number(bound))], total))
+                samples.append(('_sum', [('region', region)], histogram.sum))
+                samples.append(('_count', [('region', region)], histogram.count))
+            if samples:
+                metric('snapshot_completion_seconds', 'histogram', 'Time from a snapshot starting to it completing', samples)
+            copies = sorted(self._copies.items())
+            if copies:
+                samples = []
+                for (source, destination), c in copies:
+                    route = [('source', source), ('destination', destination)]
+                    for bound, total in c.seconds.cumulative():
+                        samples.append(('_bucket', route + [('le', '+Inf' if bound == float('inf') else _number(bound))], total))
+                    samples.append(('_sum', route, c.seconds.sum))
+                    samples.append(('_count', route, c.seconds.count))
+                metric('snapshot_copy_seconds', 'histogram', 'Time from starting a snapshot copy to it completing', samples)
+                metric('snapshot_copy_gib_total', 'counter', 'Size of the snapshots copied to other regions',
+                    [('', [('source', source), ('destination', destination)], c.gib) for (source, destination), c in copies])
+            pools = sorted(self._pools.items())
+            if pools:
+                metric('connection_pool_hits_total', 'counter', 'Idle EC2 connections taken by a thread instead of opening a new one',
+                    [('', [('region', region)], p.hits) for region, p in pools])
+                metric('connection_pool_misses_total', 'counter', 'EC2 connections made, by why one was needed',
+                    [('', [('region', region), ('reason', reason)], count) for region, p in pools
+                        for reason, count in (('new', p.misses - p.expired), ('expired', p.expired))])
+                samples = []
+                for region, p in pools:
+                    for bound, total in p.setup.cumulative():
+                        samples.append(('_bucket', [('region', region), ('le', '+Inf' if bound == float('inf') else _number(bound))], total))
+                    samples.append(('_sum', [('region', region)], p.setup.sum))
+                    samples.append(('_count', [('region', region)], p.setup.count))
+                metric('connection_setup_seconds', 'histogram', 'Time taken to make an EC2 connection, including assuming a role', samples)
+        lines.append('# HELP %s_last_run_timestamp_seconds When the run started' % prefix)
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_last_run_timestamp_seconds %s' % (prefix, _number(self.started)))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        ''' Writes a textfile for the node exporter. The file is replaced in one
+        step so the exporter never reads half of it '''
+        _write_atomically(path, self.to_prometheus())
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.to_dict(), indent=2, sort_keys=True) + '\n')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _write_atomically(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+def timed_iter(iterable, metrics, phase, region):
+    ''' Yields from iterable, adding the time spent waiting for each item to
+    the phase. Used for listings that are consumed as they are fetched '''
+    iterator = iter(iterable)
+    waited = 0.0
+    try:
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                waited += time.time() - started
+                return
+            waited += time.time() - started
+            yield item
+    finally:
+        metrics.add_phase(phase, region, waited)
+
+class InstrumentedConnection(object):
+    ''' Wraps a boto connection so every API call made through it is recorded
+    in metrics. Calls such as get_list('DescribeSnapshots', ...) are recorded
+    under their action, other methods under the action their name maps to '''
+
+    def __init__(self, conn, metrics, region):
+        self._conn = conn
+        self._metrics = metrics
+        self._region = region
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name in _ACTION_METHODS:
+            def call(action, *args, **kwargs):
+                return self._metrics.call(action, self._region, attr, action, *args, **kwargs)
+        else:
+            operation = operation_name(name)
+            def call(*args, **kwargs):
+                return self._metrics.call(operation, self._region, attr, *args, **kwargs)
+        call.__name__ = name
+        return call
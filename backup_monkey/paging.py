@@ -0,0 +1,52 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+
+__all__ = ('build_filter_params', 'iter_pages')
+log = logging.getLogger(__name__)
+
+def build_filter_params(params, filters):
+    ''' Adds Filter.N.Name / Filter.N.Value.M query parameters, the same way
+    boto's EC2Connection does for its get_all_* methods '''
+    for i, name in enumerate(sorted(filters), 1):
+        aws_name = name if name.startswith('tag:') else name.replace('_', '-')
+        params['Filter.%d.Name' % i] = aws_name
+        values = filters[name]
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            values = [values]
+        for j, value in enumerate(values, 1):
+            params['Filter.%d.Value.%d' % (i, j)] = value
+    return params
+
+def iter_pages(conn, action, params, cls, page_size, stats=None):
+    ''' Yields every object of a paginated Describe* call, one page at a time,
+    following NextToken until the last page. Each call is counted under the
+    action's name in stats, when given '''
+    next_token = None
+    pages = 0
+    while True:
+        page_params = dict(params)
+        page_params['MaxResults'] = page_size
+        if next_token:
+            page_params['NextToken'] = next_token
+        page = conn.get_list(action, page_params, [('item', cls)], verb='POST')
+        pages += 1
+        if stats is not None:
+            stats.incr(action)
+        for item in page:
+            yield item
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            log.debug('%s returned %d pages', action, pages)
+            return
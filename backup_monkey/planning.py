@@ -0,0 +1,65 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json, logging, math, time
+
+__all__ = ('PLAN_VERSION', 'DEFAULT_CALL_LATENCY', 'estimate_seconds', 'tag_batches', 'write_plan', 'read_plan')
+log = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+# Seconds per API call, when planning made no calls that could be timed
+DEFAULT_CALL_LATENCY = 0.25
+
+def estimate_seconds(calls, workers, latency):
+    ''' The time calls take when spread over workers, each taking latency seconds '''
+    return math.ceil(float(calls) / max(workers, 1)) * latency
+
+def tag_batches(creates, batch_size=500):
+    ''' The number of batched CreateTags calls needed when snapshots cannot be
+    tagged on creation. Snapshots sharing a tag set are tagged together '''
+    groups = {}
+    for create in creates:
+        if create['tags']:
+            key = frozenset(create['tags'].iteritems())
+            groups[key] = groups.get(key, 0) + 1
+    return sum(int(math.ceil(float(count) / batch_size)) for count in groups.itervalues())
+
+def write_plan(path, jobs):
+    ''' Writes the plans of one or more account and region jobs to a JSON file,
+    with the API calls and duration they predict added up '''
+    api_calls = {}
+    for job in jobs:
+        for action, count in job['api_calls'].iteritems():
+            api_calls[action] = api_calls.get(action, 0) + count
+    plan = {
+        'version': PLAN_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'api_calls': api_calls,
+        'jobs': jobs,
+    }
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+    log.info('Wrote the plan for %d jobs to %s', len(jobs), path)
+    return plan
+
+def read_plan(path):
+    ''' Reads a plan written by write_plan, raising ValueError if it cannot be used '''
+    with open(path) as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+        raise ValueError('%s is not a version %d Backup Monkey plan' % (path, PLAN_VERSION))
+    for job in plan['jobs']:
+        for key in ('region', 'creates', 'deletes'):
+            if key not in job:
+                raise ValueError('%s has a job without `%s`' % (path, key))
+    return plan
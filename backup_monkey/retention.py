@@ -0,0 +1,156 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar, heapq, logging, re, time
+
+__all__ = ('OVERRIDE_TAG', 'RetentionPolicy', 'parse_age', 'parse_timestamp', 'plan')
+log = logging.getLogger(__name__)
+
+# A volume tag (copied onto its snapshots) that overrides the retention policy,
+# e.g. BackupMonkeyRetention=7d4w12m or BackupMonkeyRetention=30
+OVERRIDE_TAG = 'BackupMonkeyRetention'
+
+_DAY = 86400
+_AGE_UNITS = {'h': 3600, 'd': _DAY, 'w': 7 * _DAY, 'm': 30 * _DAY, 'y': 365 * _DAY}
+_SPEC_ORDER = (('d', 'daily'), ('w', 'weekly'), ('m', 'monthly'), ('y', 'yearly'))
+_SPEC_UNITS = dict(_SPEC_ORDER)
+_SPEC_RE = re.compile(r'(\d+)([dwmy])')
+
+# Snapshots cluster on a few distinct dates, so the calendar work is done once per date
+_midnights = {}
+_day_buckets = {}
+
+def parse_timestamp(value):
+    ''' Converts an EC2 timestamp such as 2015-01-31T12:00:00.000Z to epoch seconds '''
+    date = value[:10]
+    midnight = _midnights.get(date)
+    if midnight is None:
+        midnight = _midnights[date] = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]), 0, 0, 0, 0, 0, 0))
+    return midnight + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+
+def parse_age(value):
+    ''' Converts an age such as 36h, 90d, 12w, 6m or 1y to seconds '''
+    match = re.match(r'^\s*(\d+)\s*([hdwmy])\s*$', value or '')
+    if not match:
+        raise ValueError('invalid age `%s`, expected a number followed by h, d, w, m or y' % value)
+    return int(match.group(1)) * _AGE_UNITS[match.group(2)]
+
+class RetentionPolicy(object):
+    ''' Grandfather-father-son retention. Keeps the newest keep_last snapshots,
+    plus the newest snapshot of each of the most recent `daily` days, `weekly`
+    weeks, `monthly` months and `yearly` years. Anything older than max_age
+    seconds is deleted regardless. A policy keeping nothing is refused unless
+    keep_none is set, as --max-snapshots-per-volume 0 always allowed: then only
+    snapshots still pending, such as the ones just created, survive '''
+
+    def __init__(self, keep_last=0, daily=0, weekly=0, monthly=0, yearly=0, max_age=None, keep_none=False):
+        self.keep_last = keep_last
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+        self.max_age = max_age
+        if not (keep_last or daily or weekly or monthly or yearly or keep_none):
+            raise ValueError('a retention policy must keep at least one snapshot')
+
+    @classmethod
+    def parse(cls, spec, keep_last=0, max_age=None):
+        ''' Builds a policy from a spec such as 7d4w12m1y. A plain number means
+        keep that many of the newest snapshots '''
+        spec = (spec or '').strip().lower()
+        if spec.isdigit():
+            return cls(keep_last=int(spec), max_age=max_age)
+        if not spec or _SPEC_RE.sub('', spec):
+            raise ValueError('invalid retention `%s`, expected a number or a spec such as 7d4w12m1y' % spec)
+        counts = {}
+        for count, unit in _SPEC_RE.findall(spec):
+            counts[_SPEC_UNITS[unit]] = int(count)
+        return cls(keep_last=keep_last, max_age=max_age, **counts)
+
+    def __str__(self):
+        parts = ['%d%s' % (getattr(self, name), unit) for unit, name in _SPEC_ORDER if getattr(self, name)]
+        if self.keep_last:
+            parts.insert(0, 'last %d' % self.keep_last)
+        if self.max_age:
+            parts.append('max age %dd' % (self.max_age // _DAY))
+        return ', '.join(parts) or 'none'
+
+def _buckets(t):
+    ''' Returns the (daily, weekly, monthly, yearly) bucket keys for an epoch time '''
+    day = int(t // _DAY)
+    buckets = _day_buckets.get(day)
+    if buckets is None:
+        tm = time.gmtime(day * _DAY)
+        # 1970-01-01 was a Thursday, so shifting by 3 days starts weeks on Monday
+        buckets = _day_buckets[day] = (day, (day + 3) // 7, tm.tm_year * 12 + tm.tm_mon, tm.tm_year)
+    return buckets
+
+class _VolumeState(object):
+    __slots__ = ('snapshots', 'buckets', 'newest')
+
+    def __init__(self):
+        self.snapshots = []
+        self.buckets = ({}, {}, {}, {})
+        self.newest = None
+
+def plan(snapshots, policy, now=None, key=None, override_tag=OVERRIDE_TAG):
+    ''' Splits snapshots into (keep, delete) lists.
+
+    The snapshots are visited once, in any order. Each one is dropped into its
+    volume's daily, weekly, monthly and yearly buckets, and only the newest
+    snapshot per bucket is remembered. The policy then picks the most recent
+    buckets, and the newest keep_last snapshots, without sorting any volume's
+    full list. key(snapshot) gives the volume a snapshot belongs to (default:
+    its volume_id). If the volume's newest snapshot is tagged with
+    override_tag, that policy is used for the whole volume; once the tag is
+    taken off the volume, its next snapshot ends the override '''
+    now = time.time() if now is None else now
+    key = key or (lambda s: s.volume_id)
+    volumes = {}
+    for snapshot in snapshots:
+        t = parse_timestamp(snapshot.start_time)
+        volume = key(snapshot)
+        state = volumes.get(volume)
+        if state is None:
+            state = volumes[volume] = _VolumeState()
+        entry = (t, snapshot.id, snapshot)
+        state.snapshots.append(entry)
+        for buckets, bucket in zip(state.buckets, _buckets(t)):
+            newest = buckets.get(bucket)
+            if newest is None or (t, snapshot.id) > newest[:2]:
+                buckets[bucket] = entry
+        if state.newest is None or (t, snapshot.id) > state.newest[:2]:
+            state.newest = entry
+
+    keep = []
+    delete = []
+    for volume, state in volumes.iteritems():
+        volume_policy = policy
+        override = (getattr(state.newest[2], 'tags', None) or {}).get(override_tag)
+        if override:
+            try:
+                volume_policy = RetentionPolicy.parse(override, max_age=policy.max_age)
+            except ValueError, e:
+                log.warning('Ignoring %s tag on %s: %s', override_tag, volume, e)
+        kept = set(entry[1] for entry in heapq.nlargest(volume_policy.keep_last, state.snapshots))
+        for count, buckets in zip((volume_policy.daily, volume_policy.weekly, volume_policy.monthly, volume_policy.yearly),
+                                  state.buckets):
+            for bucket in heapq.nlargest(count, buckets):
+                kept.add(buckets[bucket][1])
+        cutoff = now - volume_policy.max_age if volume_policy.max_age else None
+        for t, snapshot_id, snapshot in state.snapshots:
+            if snapshot_id in kept and (cutoff is None or t >= cutoff):
+                keep.append(snapshot)
+            else:
+                delete.append(snapshot)
+    return keep, delete
@@ -0,0 +1,141 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, random, threading
+
+__all__ = ('THROTTLE', 'TRANSIENT', 'PERMANENT', 'classify', 'RetryBudget', 'RetryPolicy', 'AdaptiveLimiter')
+log = logging.getLogger(__name__)
+
+THROTTLE = 'throttle'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+THROTTLE_CODES = frozenset([
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'SnapshotCreationPerVolumeRateExceeded',
+])
+
+TRANSIENT_CODES = frozenset([
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'IncorrectState',
+])
+
+def classify(error):
+    ''' Returns THROTTLE, TRANSIENT or PERMANENT for a BotoServerError '''
+    code = getattr(error, 'error_code', None) or getattr(error, 'code', None)
+    if code in THROTTLE_CODES:
+        return THROTTLE
+    if code in TRANSIENT_CODES:
+        return TRANSIENT
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and status >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+class RetryBudget(object):
+    ''' Caps the number of retries made over a whole run. A budget of None
+    never runs out '''
+
+    def __init__(self, retries=None):
+        self._remaining = retries
+        self._lock = threading.Lock()
+
+    def spend(self):
+        ''' Takes one retry from the budget, returns False once it is empty '''
+        if self._remaining is None:
+            return True
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+class RetryPolicy(object):
+    ''' Exponential backoff with full jitter: the n-th retry sleeps for a random
+    time between 0 and min(max_delay, base_delay * 2 ** (n - 1)) seconds '''
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, budget=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def should_retry(self, kind, attempt):
+        ''' Whether a failure of the given kind on the given attempt is retried '''
+        if kind == PERMANENT or attempt >= self.max_attempts:
+            return False
+        return self.budget.spend()
+
+class AdaptiveLimiter(object):
+    ''' Limits the number of concurrent API calls using additive-increase,
+    multiplicative-decrease. The limit is cut on every throttling error and
+    grows back by roughly one slot for each full window of successful calls '''
+
+    def __init__(self, maximum, minimum=1, decrease=0.5):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self._decrease = decrease
+        self._limit = float(self.maximum)
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= int(self._limit):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def on_throttle(self):
+        with self._cond:
+            previous = int(self._limit)
+            self._limit = max(self.minimum, self._limit * self._decrease)
+            if int(self._limit) != previous:
+                log.debug('Throttled, concurrency limit lowered to %d', int(self._limit))
+
+    def on_success(self):
+        with self._cond:
+            if self._limit < self.maximum:
+                previous = int(self._limit)
+                self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+                if int(self._limit) != previous:
+                    log.debug('Concurrency limit raised to %d', int(self._limit))
+                    self._cond.notify_all()
@@ -0,0 +1,103 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar, datetime, logging
+
+__all__ = ('CronSchedule', )
+log = logging.getLogger(__name__)
+
+_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+
+def _parse_field(value, name, low, high):
+    ''' Expands one cron field, such as */15, 1-5 or 0,30, to the set of values it allows '''
+    allowed = set()
+    for part in value.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            if not step.isdigit() or int(step) < 1:
+                raise ValueError('invalid step in %s `%s`' % (name, value))
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = part.split('-', 1)
+            if not (start.isdigit() and end.isdigit()):
+                raise ValueError('invalid range in %s `%s`' % (name, value))
+            start, end = int(start), int(end)
+        elif part.isdigit():
+            start = end = int(part)
+            if step > 1:
+                end = high
+        else:
+            raise ValueError('invalid %s `%s`' % (name, value))
+        if not low <= start <= end <= high:
+            raise ValueError('%s `%s` is outside %d-%d' % (name, value, low, high))
+        allowed.update(range(start, end + 1, step))
+    return allowed
+
+class CronSchedule(object):
+    ''' A five field cron expression (minute, hour, day of month, month, day of
+    week) or one of @hourly, @daily, @weekly, @monthly and @yearly, evaluated
+    in UTC. As in cron, when both the day of month and the day of week are
+    restricted a day matching either of them is due '''
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = _ALIASES.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise ValueError('invalid schedule `%s`, expected five fields or an alias such as @daily' % expression)
+        sets = [_parse_field(f, name, low, high) for f, (name, low, high) in zip(fields, _FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = sets
+        # cron counts Sunday as 0 or 7, Python as 6
+        self.weekdays = set((d - 1) % 7 for d in weekdays)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def __str__(self):
+        return self.expression
+
+    def _day_matches(self, date):
+        day = date.day in self.days
+        weekday = date.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        ''' The first time after when, in epoch seconds, that the schedule is due '''
+        t = datetime.datetime.utcfromtimestamp(int(when) // 60 * 60) + datetime.timedelta(minutes=1)
+        # Every valid schedule is due at least once in any eight years, e.g. on 29 February
+        limit = t + datetime.timedelta(days=8 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                year, month = (t.year + 1, 1) if t.month == 12 else (t.year, t.month + 1)
+                t = datetime.datetime(year, month, 1)
+            elif not self._day_matches(t):
+                t = datetime.datetime(t.year, t.month, t.day) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = datetime.datetime(t.year, t.month, t.day, t.hour) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(t.timetuple())
+        raise ValueError('schedule `%s` is never due' % self.expression)
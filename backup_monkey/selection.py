@@ -0,0 +1,426 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+''' Volume selection by tag, e.g.
+
+    env=prod AND (team=db* OR has:Backup) AND NOT missing:Name
+    tier!=scratch,temp
+
+Tests are key=value (any of several comma separated values, with * and ?
+wildcards), key!=value, has:key and missing:key. They combine with AND, OR,
+NOT and parentheses; tests next to each other are ANDed. Keys and values
+holding spaces or punctuation can be quoted.
+
+An expression is compiled once into a Selection. The ANDed tests EC2 can
+evaluate become server side filters. Whatever remains is evaluated once per
+distinct combination of the tags it reads, so a fleet of identically tagged
+volumes costs one dictionary lookup per volume '''
+
+import ast, logging, re
+
+__all__ = ('Selection', 'parse', 'from_tags')
+log = logging.getLogger(__name__)
+
+# EC2 accepts at most 200 values per filter
+FILTER_VALUES_LIMIT = 200
+
+_TOKEN_RE = re.compile(r'''\s*(?:(\()|(\))|(!=|=)|(,)|"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|([^\s()=!,"']+))''')
+
+def _has_wildcards(value):
+    return '*' in value or '?' in value or '\\' in value
+
+def _wildcard_re(values):
+    ''' A regular expression matching any of the values, using EC2's filter
+    wildcards: * for any characters, ? for one and \ to escape either '''
+    alternatives = []
+    for value in values:
+        parts = []
+        i = 0
+        while i < len(value):
+            c = value[i]
+            if c == '\\' and i + 1 < len(value):
+                i += 1
+                parts.append(re.escape(value[i]))
+            elif c == '*':
+                parts.append('.*')
+            elif c == '?':
+                parts.append('.')
+            else:
+                parts.append(re.escape(c))
+            i += 1
+        alternatives.append(''.join(parts))
+    return re.compile('(?:%s)\\Z' % '|'.join(alternatives), re.DOTALL)
+
+class Node(object):
+    ''' A test or operator of a selection expression.
+
+    matcher() compiles the node into a function of a volume's tags, and
+    keys() returns the tag keys that function reads '''
+
+    def matcher(self):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+class Tag(Node):
+    ''' key=value, matching any of values. Wildcards are literal characters
+    when wildcard is False, as in the old --reverse-tags blacklist '''
+
+    def __init__(self, key, values, wildcard=True):
+        self.key = key
+        self.values = tuple(values)
+        self.wildcard = wildcard and any(_has_wildcards(v) for v in self.values)
+
+    def _value_test(self):
+        if self.wildcard:
+            return _wildcard_re(self.values).match
+        return frozenset(self.values).__contains__
+
+    def matcher(self):
+        key, test = self.key, self._value_test()
+        def match(tags):
+            value = tags.get(key)
+            return value is not None and bool(test(value))
+        return match
+
+    def keys(self):
+        return set([self.key])
+
+    def pushable(self):
+        return len(self.values) <= FILTER_VALUES_LIMIT and (self.wildcard or not any(_has_wildcards(v) for v in self.values))
+
+    def __str__(self):
+        return '%s=%s' % (_quote(self.key), ','.join(_quote(v) for v in self.values))
+
+class Has(Node):
+    ''' has:key, matching volumes carrying the tag whatever its value '''
+
+    def __init__(self, key):
+        self.key = key
+
+    def matcher(self):
+        key = self.key
+        return lambda tags: key in tags
+
+    def keys(self):
+        return set([self.key])
+
+    def __str__(self):
+        return 'has:%s' % _quote(self.key)
+
+class Not(Node):
+
+    def __init__(self, node):
+        self.node = node
+
+    def matcher(self):
+        match = self.node.matcher()
+        return lambda tags: not match(tags)
+
+    def keys(self):
+        return self.node.keys()
+
+    def __str__(self):
+        if isinstance(self.node, Has):
+            return 'missing:%s' % _quote(self.node.key)
+        if isinstance(self.node, Tag):
+            return '%s!=%s' % (_quote(self.node.key), ','.join(_quote(v) for v in self.node.values))
+        return 'NOT %s' % _group(self.node)
+
+class And(Node):
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+
+    def matcher(self):
+        matches = [n.matcher() for n in self.nodes]
+        return lambda tags: all(match(tags) for match in matches)
+
+    def keys(self):
+        return set().union(*[n.keys() for n in self.nodes])
+
+    def __str__(self):
+        return ' AND '.join(_group(n) for n in self.nodes)
+
+class Or(Node):
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+
+    def matcher(self):
+        matches = [n.matcher() for n in self.nodes]
+        return lambda tags: any(match(tags) for match in matches)
+
+    def keys(self):
+        return set().union(*[n.keys() for n in self.nodes])
+
+    def __str__(self):
+        return ' OR '.join(_group(n) for n in self.nodes)
+
+def _quote(text):
+    if text and re.match(r'''^[^\s()=!,"']+$''', text) and text.upper() not in ('AND', 'OR', 'NOT') \
+            and not text.lower().startswith(('has:', 'missing:')):
+        return text
+    return '"%s"' % text.replace('"', '\\"')
+
+def _group(node):
+    return '(%s)' % node if isinstance(node, (And, Or)) else str(node)
+
+# Parsing
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = _TOKEN_RE.match(text, position)
+        if not m:
+            raise ValueError('cannot parse `%s` at `%s`' % (text, text[position:].strip()))
+        position = m.end()
+        group, value = [(i, v) for i, v in enumerate(m.groups()) if v is not None][0]
+        if group in (4, 5):
+            # Only the quote is unescaped, so \* still escapes a wildcard
+            quote = '"' if group == 4 else "'"
+            tokens.append(('string', value.replace('\\' + quote, quote)))
+        elif group == 6:
+            keyword = value.upper()
+            tokens.append(('keyword', keyword) if keyword in ('AND', 'OR', 'NOT') else ('word', value))
+        else:
+            tokens.append(('punctuation', value))
+    return tokens
+
+class _Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] not in kind.split('|')) or (value and token[1] != value):
+            raise ValueError('cannot parse `%s`: expected %s, found %s' % (self.text,
+                value or kind, token[1] if token[0] else 'the end'))
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        node = self.expression()
+        if self.peek()[0] is not None:
+            raise ValueError('cannot parse `%s`: unexpected `%s`' % (self.text, self.peek()[1]))
+        return node
+
+    def expression(self):
+        nodes = [self.conjunction()]
+        while self.peek() == ('keyword', 'OR'):
+            self.take()
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def conjunction(self):
+        nodes = [self.negation()]
+        while self.peek()[0] is not None and self.peek() not in (('keyword', 'OR'), ('punctuation', ')')):
+            if self.peek() == ('keyword', 'AND'):
+                self.take()
+            nodes.append(self.negation())
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def negation(self):
+        if self.peek() == ('keyword', 'NOT'):
+            self.take()
+            return Not(self.negation())
+        if self.peek() == ('punctuation', '('):
+            self.take()
+            node = self.expression()
+            self.take('punctuation', ')')
+            return node
+        return self.test()
+
+    def test(self):
+        kind = self.peek()[0]
+        key = self.take('word|string')
+        # A quoted key is always a key, even one starting with has:
+        for prefix, negate in (('has:', False), ('missing:', True)):
+            if kind == 'word' and key.lower().startswith(prefix):
+                key = key[len(prefix):] or self.take('word|string')
+                return Not(Has(key)) if negate else Has(key)
+        operator = self.take('punctuation')
+        if operator not in ('=', '!='):
+            raise ValueError('cannot parse `%s`: expected = or != after `%s`' % (self.text, key))
+        values = [self.value()]
+        while self.peek() == ('punctuation', ','):
+            self.take()
+            values.append(self.value())
+        node = Tag(key, values)
+        return Not(node) if operator == '!=' else node
+
+    def value(self):
+        # Keywords are values too once they follow =, e.g. state=NOT
+        kind, value = self.peek()
+        if kind == 'keyword':
+            self.position += 1
+            return value
+        return self.take('word|string')
+
+def parse(text):
+    ''' Parses a selection expression into a tree of nodes, raising ValueError
+    if it is not valid '''
+    if not text or not text.strip():
+        return And([])
+    return _Parser(text).parse()
+
+def from_tags(tags, reverse=False):
+    ''' Converts the old --tags name:value arguments into an expression. A value
+    may be a Python list literal, e.g. name:['foo','bar']. With reverse, volumes
+    carrying any of the tags are left out, matching values exactly '''
+    nodes = []
+    for tag in tags or ():
+        key, value = tag.split(':')
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        nodes.append(Tag(key, ['%s' % v for v in values], wildcard=not reverse))
+    if reverse:
+        return Not(Or(nodes)) if nodes else And([])
+    return And(nodes)
+
+def _simplify(node):
+    ''' Flattens nested ANDs and ORs, and merges ORed tests of one key so they
+    can be pushed down as a single filter '''
+    if isinstance(node, Not):
+        inner = _simplify(node.node)
+        return inner.node if isinstance(inner, Not) else Not(inner)
+    if not isinstance(node, (And, Or)):
+        return node
+    kind = type(node)
+    nodes = []
+    for child in (_simplify(n) for n in node.nodes):
+        nodes.extend(child.nodes if type(child) is kind else [child])
+    if kind is Or:
+        merged = []
+        tags = {}
+        for child in nodes:
+            if isinstance(child, Tag):
+                key = (child.key, child.wildcard or not any(_has_wildcards(v) for v in child.values))
+                if key in tags:
+                    other = tags[key]
+                    other_index = merged.index(other)
+                    merged[other_index] = tags[key] = Tag(other.key, other.values + child.values, wildcard=key[1])
+                    continue
+                tags[key] = child
+            merged.append(child)
+        nodes = merged
+    if len(nodes) == 1:
+        return nodes[0]
+    return kind(nodes)
+
+class Selection(object):
+    ''' A compiled selection expression.
+
+    filters holds the EC2 server side filters to list volumes with, and
+    residual whatever is left to evaluate locally, or None when EC2 does all
+    the work. select() yields the listed volumes that match '''
+
+    def __init__(self, node):
+        self.node = _simplify(node)
+        self.filters, self.residual = self._push_down(self.node)
+        self._match = self.residual.matcher() if self.residual else (lambda tags: True)
+
+    @classmethod
+    def compile(cls, expression=None, tags=None, reverse_tags=False):
+        ''' Builds a selection from an expression and the old --tags arguments,
+        ANDing them when both are given '''
+        nodes = []
+        if tags:
+            nodes.append(from_tags(tags, reverse_tags))
+        if expression:
+            nodes.append(parse(expression))
+        return cls(And(nodes))
+
+    @property
+    def selects_all(self):
+        return isinstance(self.node, And) and not self.node.nodes
+
+    @staticmethod
+    def _push_down(node):
+        filters = {}
+        residual = []
+        for conjunct in node.nodes if isinstance(node, And) else [node]:
+            name = values = None
+            if isinstance(conjunct, Tag) and conjunct.pushable():
+                name, values = 'tag:%s' % conjunct.key, list(conjunct.values)
+            elif isinstance(conjunct, Has):
+                name, values = 'tag-key', [conjunct.key]
+            elif isinstance(conjunct, Or) and all(isinstance(n, Has) for n in conjunct.nodes) \
+                    and len(conjunct.nodes) <= FILTER_VALUES_LIMIT:
+                name, values = 'tag-key', [n.key for n in conjunct.nodes]
+            # Filters are ANDed by name, so a second test of the same name is evaluated locally
+            if name and name not in filters:
+                filters[name] = values
+            else:
+                residual.append(conjunct)
+        if not residual:
+            return filters, None
+        return filters, residual[0] if len(residual) == 1 else And(residual)
+
+    def matches(self, tags):
+        ''' Whether a volume with these tags passes the part not pushed down to EC2 '''
+        return self._match(tags)
+
+    def select(self, volumes):
+        ''' Yields the volumes the residual matches, as they are listed. The
+        residual is evaluated once for each combination of the tags it reads,
+        and the decision looked up for every other volume carrying it '''
+        if self.residual is None:
+            for volume in volumes:
+                yield volume
+            return
+        keys = sorted(self.residual.keys())
+        match = self._match
+        decisions = {}
+        if len(keys) == 1:
+            signature = lambda tags, key=keys[0]: tags.get(key)
+        else:
+            signature = lambda tags: tuple(map(tags.get, keys))
+        seen = 0
+        volumes = iter(volumes)
+        for volume in volumes:
+            tags = volume.tags or {}
+            sig = signature(tags)
+            decision = decisions.get(sig)
+            if decision is None:
+                decision = decisions[sig] = match(tags)
+            if decision:
+                yield volume
+            seen += 1
+            # Tags unique to each volume, such as Name, make remembering pointless
+            if seen == 1000 and len(decisions) > seen // 2:
+                break
+        for volume in volumes:
+            if match(volume.tags or {}):
+                yield volume
+
+    def __str__(self):
+        return str(self.node) if not self.selects_all else '*'
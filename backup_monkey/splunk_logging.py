@@ -1,4 +1,24 @@
-import logging
+import atexit, logging, os, threading, time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The JSON lines format uses the fastest serializer available
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+log = logging.getLogger(__name__)
+
+_SEVERITIES = frozenset(['critical', 'high', 'medium', 'low', 'informational'])
+_TYPES = frozenset(['alarm', 'alert', 'event', 'task'])
 
 class Singleton(type):
     _instances = {}
@@ -8,27 +28,51 @@ class Singleton(type):
         return cls._instances[cls]
 
 class SplunkLogging(object):
+    ''' Writes key=value events for Splunk from a background thread.
+
+    write() only queues the event. A writer thread formats queued events and
+    appends them in batches, holding an exclusive lock on the file so several
+    processes can share it, and rotates the file once it reaches max_bytes.
+    When the queue is full, alarms and alerts wait for room for up to
+    block_timeout seconds while other events are dropped and counted.
+    Call flush() to write everything queued so far; it also runs at exit.
+
+    Values that are not strings, such as StatusEvents, are turned into strings
+    by the writer thread. Events are written as key=value lines, or as JSON
+    lines after set_format('json') '''
 
     __metaclass__ = Singleton
 
     log_file = '/var/log/backup_monkey.log'
     app = 'BACKUP_MONKEY'
-    keys = ['app', 'body', 'severity', 'src_account', 'src_role', 'src_region', 'src_volume', 'src_snapshot', 'src_tags', 'subject', 'type', 'category']
-    logger = logging.getLogger(__name__)
-    formatter = logging.Formatter('%(asctime)s %(message)s', '%Y-%m-%d %H:%M:%S')
+    keys = ['app', 'body', 'severity', 'src_account', 'src_role', 'src_region', 'src_volume', 'src_snapshot', 'src_instance', 'src_tags', 'subject', 'type', 'category', 'retry_count', 'retry_sleep']
+    date_format = '%Y-%m-%d %H:%M:%S'
+    formats = ('kv', 'json')
+    output_format = 'kv'
 
-    handler = logging.FileHandler(log_file)
-    logger.setLevel(logging.DEBUG)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    path = log_file
+    queue_size = 10000
+    batch_size = 500
+    flush_interval = 1.0
+    block_timeout = 5.0
+    max_bytes = 100 * 1024 * 1024
+    backup_count = 5
+    dropped = 0
+
+    # deque appends and pops are atomic, and far cheaper than a Queue on the hot path
+    _queue = deque()
+    _wakeup = threading.Event()
+    _write_lock = threading.Lock()
+    _start_lock = threading.Lock()
+    _writer = None
+    _writer_pid = None
+    _stamp = (None, None)
+    _stopping = False
 
     @classmethod
     def set_path(cls, path):
-        cls.handler = logging.FileHandler(path)
-        cls.handler.setFormatter(cls.formatter)
-        for h in cls.logger.handlers:
-            cls.logger.removeHandler(h)
-        cls.logger.addHandler(cls.handler)
+        cls.flush()
+        cls.path = path
 
     @classmethod
     def reset_path(cls):
@@ -38,16 +82,189 @@ class SplunkLogging(object):
     def set_app(cls, app):
         cls.app = app
 
+    @classmethod
+    def set_format(cls, output_format):
+        if output_format not in cls.formats:
+            raise ValueError('unknown log format `%s`, expected one of %s' % (output_format, ', '.join(cls.formats)))
+        cls.flush()
+        cls.output_format = output_format
+
+    @classmethod
+    def configure(cls, queue_size=None, batch_size=None, flush_interval=None, max_bytes=None, backup_count=None):
+        ''' Changes the writer's limits, after writing out anything already queued '''
+        cls.flush()
+        if queue_size is not None:
+            cls.queue_size = queue_size
+        if batch_size is not None:
+            cls.batch_size = batch_size
+        if flush_interval is not None:
+            cls.flush_interval = flush_interval
+        if max_bytes is not None:
+            cls.max_bytes = max_bytes
+        if backup_count is not None:
+            cls.backup_count = backup_count
+
     @classmethod
     def write(cls, **kwargs):
       """ Write to log file which will be parsed by splunk.
       severity is one of: critical, high, medium, low, informational, unknown
       type is one of: alarm, alert, event, task, unknown
       """
-      for k in cls.keys:
-        if k not in kwargs:
-          kwargs[k] = ''
-      kwargs['app'] = kwargs['app'] if kwargs['app'] else cls.app
-      kwargs['severity'] = kwargs['severity'] if kwargs['severity'] in ['critical', 'high', 'medium', 'low', 'informational'] else 'unknown' 
-      kwargs['type'] = kwargs['type'] if kwargs['type'] in ['alarm', 'alert', 'event', 'task'] else 'unknown' 
-      cls.logger.debug(','.join(sorted(['%s=%s' % (k, kwargs[k].replace('\r', ' ').replace('\n', ' ').strip()) for k in cls.keys if k in kwargs])))
+      if cls._writer_pid != os.getpid():
+        cls._start()
+      if len(cls._queue) >= cls.queue_size:
+        if kwargs.get('type') not in ('alarm', 'alert') or not cls._wait_for_room():
+          with cls._start_lock:
+            cls.dropped += 1
+          return
+      cls._queue.append((time.time(), kwargs))
+      if len(cls._queue) >= cls.batch_size:
+        cls._wakeup.set()
+
+    @classmethod
+    def flush(cls):
+      ''' Writes every queued event before returning '''
+      cls._drain()
+
+    @classmethod
+    def _wait_for_room(cls):
+      deadline = time.time() + cls.block_timeout
+      cls._wakeup.set()
+      while len(cls._queue) >= cls.queue_size:
+        if time.time() >= deadline:
+          return False
+        time.sleep(0.01)
+      return True
+
+    @classmethod
+    def _timestamp(cls, created):
+      # Events arrive in bursts, so the timestamp is formatted once per second
+      second = int(created)
+      if cls._stamp[0] != second:
+        cls._stamp = (second, time.strftime(cls.date_format, time.localtime(second)))
+      return cls._stamp[1]
+
+    @classmethod
+    def _format(cls, created, kwargs, keys=None):
+      keys = keys or sorted(cls.keys)
+      values = dict.fromkeys(keys, '')
+      values.update(kwargs)
+      values['app'] = values['app'] or cls.app
+      if values['severity'] not in _SEVERITIES:
+        values['severity'] = 'unknown'
+      if values['type'] not in _TYPES:
+        values['type'] = 'unknown'
+      json_lines = cls.output_format == 'json'
+      fields = []
+      for k in keys:
+        v = values[k]
+        if v:
+          if not isinstance(v, basestring):
+            v = str(v)
+          if not json_lines and ('\n' in v or '\r' in v):
+            v = v.replace('\r', ' ').replace('\n', ' ')
+          v = v.strip()
+        fields.append((k, v))
+      if json_lines:
+        event = dict(fields)
+        event['time'] = cls._timestamp(created)
+        return json.dumps(event) + '\n'
+      line = '%s %s\n' % (cls._timestamp(created), ','.join(['%s=%s' % field for field in fields]))
+      return line.encode('utf-8') if isinstance(line, unicode) else line
+
+    @classmethod
+    def _start(cls):
+      with cls._start_lock:
+        # A forked process does not inherit the writer thread
+        if cls._writer_pid == os.getpid():
+          return
+        cls._writer = threading.Thread(target=cls._run, name='splunk-logging')
+        cls._writer.daemon = True
+        cls._writer.start()
+        cls._writer_pid = os.getpid()
+
+    @classmethod
+    def _run(cls):
+      while True:
+        cls._wakeup.wait(cls.flush_interval)
+        cls._wakeup.clear()
+        # At exit the last flush is left to _shutdown, before the interpreter tears down
+        if cls._stopping:
+          return
+        try:
+          cls._drain()
+        except Exception:
+          log.exception('Cannot write Splunk events to %s', cls.path)
+
+    @classmethod
+    def _drain(cls):
+      with cls._write_lock:
+        keys = sorted(cls.keys)
+        lines = []
+        while True:
+          try:
+            created, kwargs = cls._queue.popleft()
+          except IndexError:
+            break
+          lines.append(cls._format(created, kwargs, keys))
+          if len(lines) >= cls.batch_size:
+            cls._append(''.join(lines))
+            lines = []
+        with cls._start_lock:
+          dropped, cls.dropped = cls.dropped, 0
+        if dropped:
+          log.warning('Dropped %d Splunk events as the queue was full', dropped)
+          lines.append(cls._format(time.time(), {'subject': 'Dropped `%d` events as the queue was full' % dropped,
+            'type': 'alert', 'severity': 'medium', 'category': 'logging'}))
+        if lines:
+          cls._append(''.join(lines))
+
+    @classmethod
+    def _append(cls, data):
+      ''' Appends data under an exclusive lock, rotating the file first when
+      data would take it past max_bytes '''
+      try:
+        while True:
+          f = open(cls.path, 'a')
+          try:
+            if fcntl:
+              fcntl.flock(f, fcntl.LOCK_EX)
+              # Another process may have rotated the file while we waited for the lock
+              try:
+                if os.fstat(f.fileno()).st_ino != os.stat(cls.path).st_ino:
+                  continue
+              except OSError:
+                continue
+            size = os.fstat(f.fileno()).st_size
+            if cls.max_bytes and size and size + len(data) > cls.max_bytes:
+              cls._rotate()
+              continue
+            f.write(data)
+            f.flush()
+            return
+          finally:
+            f.close()
+      except (IOError, OSError), e:
+        log.error('Cannot write Splunk events to %s: %s', cls.path, e)
+
+    @classmethod
+    def _rotate(cls):
+      if cls.backup_count < 1:
+        os.remove(cls.path)
+        return
+      for i in range(cls.backup_count - 1, 0, -1):
+        source = '%s.%d' % (cls.path, i)
+        if os.path.exists(source):
+          os.rename(source, '%s.%d' % (cls.path, i + 1))
+      os.rename(cls.path, '%s.1' % cls.path)
+
+    @classmethod
+    def _shutdown(cls):
+      # Stop the writer before the interpreter tears down the modules it uses
+      cls._stopping = True
+      cls._wakeup.set()
+      if cls._writer and cls._writer_pid == os.getpid():
+        cls._writer.join(cls.block_timeout)
+      cls.flush()
+
+atexit.register(SplunkLogging._shutdown)
@@ -1,4 +1,38 @@
 
+class StatusEvent(object):
+  ''' A status message that is only formatted when first turned into a string,
+  so events nobody writes out cost next to nothing '''
+  __slots__ = ('template', 'sub', '_text')
+
+  def __init__(self, template, sub):
+    self.template = template
+    self.sub = sub
+    self._text = None
+
+  def __str__(self):
+    if self._text is None:
+      text = self.template % self.sub if self.sub else self.template
+      self._text = text.encode('utf-8') if isinstance(text, unicode) else text
+    return self._text
+
+  def __repr__(self):
+    return 'StatusEvent(%r)' % str(self)
+
+class TagsField(object):
+  ''' The src_tags field for a set of tags, joined once however many events
+  carry it. Tags AWS reserves (aws:*) are left out when skip_reserved is set '''
+  __slots__ = ('tags', 'skip_reserved', '_text')
+
+  def __init__(self, tags, skip_reserved=False):
+    self.tags = tags
+    self.skip_reserved = skip_reserved
+    self._text = None
+
+  def __str__(self):
+    if self._text is None:
+      self._text = ' '.join([':'.join(i) for i in self.tags.items() if not (self.skip_reserved and i[0].startswith('aws:'))])
+    return self._text
+
 class BackupMonkeyStatus(object):
   messages = {
     'cross_account_connect': 'Creating cross account connection to `%s` account using `%s` role on `%s` region',
@@ -7,28 +41,68 @@ class BackupMonkeyStatus(object):
     'region_connect_error': 'Cannot complete connection to `%s` region',
     'region_connect_invalid': 'Cannot complete connection to `%s` region. Check to make sure you are connecting to a valid region',
     'tags_invalid': 'You have passed an invalid --tags parameter. Please make sure you follow the form: --tags name:value',
+    'select_invalid': 'You have passed an invalid --select expression. E.g. --select "env=prod AND NOT has:NoBackup"',
     'volumes_fetch': 'Fetching volumes on `%s` region',
     'volumes_fetch_error': 'Cannot fetch volumes on `%s` region',
     'volume_describe': 'Parsing information on volume `%s`',
     'volume_describe_error': 'Cannot parse information on volume `%s`',
     'snapshots_fetch': 'Fetching snapshots on `%s` region',
     'snapshots_fetch_error': 'Cannot fetch snapshots on `%s` region',
+    'snapshots_inventory': 'Using the snapshot inventory for `%s` region, refreshed `%s` pending snapshots',
+    'snapshots_fetch_summary': 'Fetched `%s` snapshots and kept `%s` for retention',
     'snapshot_create': 'Creating snapshot of volume `%s` and setting a description of `%s`',
     'snapshot_create_success': 'Successfully created snapshot `%s` from volume `%s`',
     'snapshot_create_error': 'Cannot create snapshot of volume `%s`',
+    'snapshot_create_summary': 'Created `%s` snapshots (`%s` failed) in `%s` seconds, `%s` snapshots per second using `%s` workers',
+    'snapshot_skip_unchanged': 'Skipping volume `%s`, unchanged since snapshot `%s` according to `%s`',
+    'snapshot_change_summary': 'Skipped `%s` of `%s` volumes as unchanged, avoiding `%s` CreateSnapshot calls now and as many DeleteSnapshot calls later, using `%s` describe calls',
+    'snapshot_create_instance': 'Creating crash-consistent snapshots of `%s` volumes of instance `%s`: `%s`',
+    'snapshot_create_instance_error': 'Cannot create snapshots of instance `%s`',
+    'snapshot_instance_summary': 'Created `%s` snapshots with `%s` CreateSnapshots calls, one per instance, using `%s` describe calls',
+    'journal_resume': 'Resuming run `%s` in `%s` region from its journal: `%s` snapshots already created and `%s` deleted, `%s` creates and `%s` deletes in flight',
+    'journal_reconcile': 'Reconciled `%s` in-flight creates and `%s` in-flight deletes with `%s` describe calls: `%s` snapshots had been created and `%s` deleted',
+    'journal_skip_create': 'Skipping `%s`, snapshotted as `%s` before the run was resumed',
+    'journal_retention': 'Resuming retention from the journal with `%s` of `%s` snapshots left to delete',
+    'journal_complete': 'Run `%s` complete with `%s` snapshots created and `%s` deleted, compacted its journal of `%s` entries',
+    'snapshot_tag_error': 'Cannot tag `%s` snapshots: `%s`',
+    'snapshot_tag_summary': 'Tagged `%s` snapshots on creation and `%s` snapshots with `%s` batched calls, saving `%s` API calls',
     'snapshot_delete': 'Deleting snapshot `%s` with a description of `%s`',
     'snapshot_delete_success': 'Successfully deleted snapshot `%s` with a description of `%s`',
     'snapshot_delete_error': 'Cannot delete snapshot `%s` with a description of `%s`',
+    'snapshot_delete_summary': 'Deleted `%s` snapshots (`%s` failed, `%s` retries) in `%s` seconds, `%s` deletes per second using `%s` workers',
+    'snapshot_pending_limit': 'Keeping at most `%s` snapshots pending on `%s` region, `%s` already pending',
+    'snapshot_pending_summary': 'At most `%s` snapshots were pending (limit `%s`), `%s` snapshots queued for `%s` seconds in all, `%s` describe calls, limit lowered `%s` times',
+    'snapshot_wait': 'Waiting for `%s` snapshots to complete for up to `%s` seconds on `%s` region',
+    'snapshot_wait_progress': '`%s` of `%s` snapshots completed, `%s` failed, `%s` pending at `%s` average progress',
+    'snapshot_wait_complete': 'Snapshot `%s` of volume `%s` completed `%s` seconds after it started',
+    'snapshot_wait_error': 'Snapshot `%s` of volume `%s` ended with status `%s`',
+    'snapshot_wait_timeout': 'Gave up on `%s` snapshots still pending after `%s` seconds: `%s`',
+    'snapshot_wait_failed': '`%s` new snapshots failed on `%s` region, not removing old snapshots',
+    'snapshot_wait_summary': 'Waited `%s` seconds for `%s` snapshots: `%s` completed (p50 `%s`, p90 `%s`, max `%s` seconds), `%s` failed and `%s` still pending, using `%s` describe calls',
+    'snapshot_copy': 'Copying `%s` snapshots from `%s` region to `%s` region, at most `%s` at a time',
+    'snapshot_copy_complete': 'Copy `%s` of snapshot `%s` completed on `%s` region `%s` seconds after it started',
+    'snapshot_copy_error': 'Cannot copy snapshot `%s` to `%s` region: `%s`',
+    'snapshot_copy_timeout': 'Gave up on `%s` copies to `%s` region not completed after `%s` seconds: `%s`',
+    'snapshot_copy_failed': '`%s` copies to `%s` region failed, not removing old snapshots',
+    'snapshot_copy_summary': 'Copied `%s` snapshots (`%s` GiB) to `%s` region in `%s` seconds (p50 `%s`, p90 `%s`, max `%s` seconds per copy), `%s` GiB per hour, `%s` failed, `%s` still copying and `%s` not started, at most `%s` at a time, using `%s` describe calls',
+    'plan_summary': 'Planned for `%s` region: `%s` snapshots to create, `%s` to delete, `%s` API calls in about `%s` seconds',
+    'plan_apply': 'Applying a plan to create `%s` snapshots and delete `%s` on `%s` region',
+    'plan_mismatch': 'The plan for `%s` region does not match this region and account',
     'retry_after_sleep': '`%s` attmpts fails and waiting `%s` seconds then retry',
     'retry_all_fail': 'Total `%s` retries fail and give up'
   }
 
+  @staticmethod
+  def event(key, sub=None):
+    ''' A StatusEvent for the message, formatted only when it is written out '''
+    if sub and not isinstance(sub, tuple):
+      sub = (sub,)
+    return StatusEvent(BackupMonkeyStatus.messages[key], sub)
+
+  @staticmethod
+  def tags(tags, skip_reserved=False):
+    return TagsField(tags, skip_reserved)
+
   @staticmethod
   def parse_status(key, sub=None):
-    if sub:
-      if type(sub) == type(tuple()):
-        return eval('"' + BackupMonkeyStatus.messages[key] + '" % ' + str(sub))
-      else:
-        return eval('"' + BackupMonkeyStatus.messages[key] + '" % "' + sub + '"')
-    else:
-      return BackupMonkeyStatus.messages[key]
+    return str(BackupMonkeyStatus.event(key, sub))
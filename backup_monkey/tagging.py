@@ -0,0 +1,67 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, threading
+
+__all__ = ('TagBatcher', 'tag_specification_params')
+log = logging.getLogger(__name__)
+
+def tag_specification_params(params, tags, resource_type='snapshot', index=1):
+    ''' Adds TagSpecification.N query parameters, so a resource is tagged by the
+    same call that creates it '''
+    prefix = 'TagSpecification.%d' % index
+    params['%s.ResourceType' % prefix] = resource_type
+    for i, key in enumerate(sorted(tags), 1):
+        params['%s.Tag.%d.Key' % (prefix, i)] = key
+        params['%s.Tag.%d.Value' % (prefix, i)] = tags[key]
+    return params
+
+class TagBatcher(object):
+    ''' Collects resources that need tagging, and tags every group of resources
+    sharing an identical tag set with one call to create_tags(resource_ids, tags).
+    A group is sent as soon as it reaches batch_size resources, the rest when
+    flush() is called. Empty tag sets are never sent '''
+
+    def __init__(self, create_tags, batch_size=500):
+        self._create_tags = create_tags
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._groups = {}
+        self.calls = 0
+        self.tagged = 0
+
+    def add(self, resource_id, tags):
+        if not tags:
+            return
+        key = frozenset(tags.iteritems())
+        with self._lock:
+            group = self._groups.setdefault(key, [])
+            group.append(resource_id)
+            if len(group) < self._batch_size:
+                return
+            del self._groups[key]
+        self._send(group, tags)
+
+    def flush(self):
+        with self._lock:
+            groups = self._groups
+            self._groups = {}
+        for key, group in groups.iteritems():
+            self._send(group, dict(key))
+
+    def _send(self, resource_ids, tags):
+        with self._lock:
+            self.calls += 1
+            self.tagged += len(resource_ids)
+        log.debug('Tagging %d resources with %s', len(resource_ids), tags)
+        self._create_tags(resource_ids, tags)
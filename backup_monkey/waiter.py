@@ -0,0 +1,146 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, time
+
+__all__ = ('SnapshotWaiter', 'WaitResult')
+log = logging.getLogger(__name__)
+
+# DescribeSnapshots is eventually consistent, so a new snapshot may be missing
+# from a few polls before it shows up
+MISSING_POLLS = 3
+
+class WaitResult(object):
+    ''' What became of the snapshots a SnapshotWaiter watched: completed maps
+    snapshot ids to seconds from start to completion, failed maps them to the
+    status they ended in, and pending lists those still pending at the timeout '''
+
+    def __init__(self, completed, failed, pending, elapsed, polls, calls):
+        self.completed = completed
+        self.failed = failed
+        self.pending = pending
+        self.elapsed = elapsed
+        self.polls = polls
+        self.calls = calls
+
+    def latency(self, q):
+        ''' The q quantile of the completion latencies, in seconds '''
+        latencies = sorted(self.completed.values())
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+class SnapshotWaiter(object):
+    ''' Polls pending snapshots until they complete, fail or the timeout passes.
+
+    describe(snapshot_ids) is called with at most batch_size ids at a time and
+    returns the snapshots that still exist. Polls start min_interval apart.
+    Once snapshots report progress, the next poll is timed for when the
+    furthest along should finish at its rate so far. Until then the interval
+    grows by half while nothing changes. It always stays between min_interval
+    and max_interval '''
+
+    def __init__(self, describe, timeout=7200, min_interval=10.0, max_interval=120.0, batch_size=200,
+                 on_complete=None, on_fail=None, on_poll=None, clock=time.time, sleep=time.sleep):
+        self._describe = describe
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self._on_complete = on_complete
+        self._on_fail = on_fail
+        self._on_poll = on_poll
+        self._clock = clock
+        self._sleep = sleep
+        self._started = {}
+        self._volumes = {}
+
+    def add(self, snapshot_id, volume_id, started_at):
+        ''' Watches a snapshot started at started_at, in epoch seconds '''
+        self._started[snapshot_id] = started_at
+        self._volumes[snapshot_id] = volume_id
+
+    def __len__(self):
+        return len(self._started)
+
+    def _poll(self, pending):
+        ''' Describes every pending snapshot, returning {id: (status, progress)} '''
+        seen = {}
+        calls = 0
+        ids = sorted(pending)
+        for i in range(0, len(ids), self.batch_size):
+            calls += 1
+            for snapshot in self._describe(ids[i:i + self.batch_size]):
+                seen[snapshot.id] = (snapshot.status, _progress(getattr(snapshot, 'progress', None)))
+        return seen, calls
+
+    def wait(self):
+        began = self._clock()
+        deadline = began + self.timeout
+        pending = set(self._started)
+        completed = {}
+        failed = {}
+        polls = calls = 0
+        interval = self.min_interval
+        last_progress = None
+        missing = {}
+        while pending:
+            seen, batch_calls = self._poll(pending)
+            now = self._clock()
+            polls += 1
+            calls += batch_calls
+            finished = 0
+            for snapshot_id in sorted(pending):
+                status, progress = seen.get(snapshot_id, ('missing', None))
+                if status == 'missing':
+                    missing[snapshot_id] = missing.get(snapshot_id, 0) + 1
+                    if missing[snapshot_id] < MISSING_POLLS:
+                        continue
+                if status == 'completed':
+                    completed[snapshot_id] = max(0.0, now - self._started[snapshot_id])
+                    if self._on_complete:
+                        self._on_complete(snapshot_id, self._volumes[snapshot_id], completed[snapshot_id])
+                elif status != 'pending':
+                    failed[snapshot_id] = status
+                    if self._on_fail:
+                        self._on_fail(snapshot_id, self._volumes[snapshot_id], status)
+                else:
+                    continue
+                pending.discard(snapshot_id)
+                finished += 1
+            progress = dict((s, seen[s][1]) for s in pending if s in seen and seen[s][1] is not None)
+            mean_progress = sum(progress.values()) / len(progress) if progress else None
+            if self._on_poll:
+                self._on_poll(len(completed), len(failed), len(pending), mean_progress)
+            if not pending or now >= deadline:
+                break
+            # At the rate so far, the next snapshot should finish in about this long
+            soonest = min([(now - self._started[s]) * (100.0 - p) / p for s, p in progress.items() if p > 0] or [None])
+            interval = self._next_interval(interval, finished, mean_progress, last_progress, soonest)
+            last_progress = mean_progress
+            self._sleep(max(0.0, min(interval, deadline - now)))
+        return WaitResult(completed, failed, sorted(pending), self._clock() - began, polls, calls)
+
+    def _next_interval(self, interval, finished, progress, last_progress, soonest):
+        if soonest is not None:
+            interval = soonest
+        elif not finished and (progress is None or (last_progress is not None and progress <= last_progress)):
+            interval = interval * 1.5
+        return max(self.min_interval, min(interval, self.max_interval))
+
+def _progress(value):
+    ''' Converts EC2's progress, such as 45%, to a number '''
+    try:
+        return float(str(value).rstrip('%'))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,109 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging, sys, threading, time
+
+from Queue import Queue
+
+__all__ = ('WorkerPool', 'Counters')
+log = logging.getLogger(__name__)
+
+class Counters(object):
+    ''' Named counters that can be safely incremented from worker threads '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + amount
+
+    def get(self, key):
+        with self._lock:
+            return self._counts.get(key, 0)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._counts.items())
+
+class WorkerPool(object):
+    ''' Runs a function over a stream of items on a bounded number of threads.
+
+    Items are handed to the workers through a bounded queue, so the producer
+    never gets more than queue_size items ahead of them. The first exception
+    that escapes the function stops the pool, and is re-raised in the calling
+    thread once every worker has finished. With a single worker the items are
+    processed inline, exactly as a plain loop would. '''
+
+    _stop = object()
+
+    def __init__(self, workers=1, queue_size=None, name='worker'):
+        self._workers = max(1, int(workers or 1))
+        self._queue_size = queue_size or self._workers * 2
+        self._name = name
+
+    def run(self, func, items):
+        ''' Calls func for every item, returns (items processed, elapsed seconds) '''
+        start = time.time()
+        if self._workers == 1:
+            count = 0
+            for item in items:
+                func(item)
+                count += 1
+            return count, time.time() - start
+
+        queue = Queue(self._queue_size)
+        abort = threading.Event()
+        lock = threading.Lock()
+        errors = []
+        processed = [0]
+
+        def work():
+            while True:
+                item = queue.get()
+                try:
+                    if item is self._stop:
+                        return
+                    if abort.is_set():
+                        continue
+                    func(item)
+                    with lock:
+                        processed[0] += 1
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+                    abort.set()
+                finally:
+                    queue.task_done()
+
+        threads = [threading.Thread(target=work, name='%s-%d' % (self._name, i)) for i in range(self._workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        log.debug('Started %d %s threads', self._workers, self._name)
+        try:
+            for item in items:
+                if abort.is_set():
+                    break
+                queue.put(item)
+        finally:
+            for t in threads:
+                queue.put(self._stop)
+            for t in threads:
+                t.join()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return processed[0], time.time() - start
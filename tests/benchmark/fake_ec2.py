@@ -0,0 +1,233 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar, random, threading, time
+
+from boto.exception import BotoServerError
+
+__all__ = ('FakeEC2Connection', 'FakeConnections')
+
+DAY = 86400
+# Generated snapshots are taken daily, counting back from this time
+NEWEST = calendar.timegm((2015, 6, 30, 3, 0, 0, 0, 0, 0))
+
+class AttachData(object):
+    __slots__ = ('instance_id', 'device')
+
+    def __init__(self, instance_id, device):
+        self.instance_id = instance_id
+        self.device = device
+
+class FakeVolume(object):
+    __slots__ = ('id', 'tags', 'attach_data', 'status')
+
+    def __init__(self, index):
+        self.id = 'vol-%08x' % index
+        self.tags = {'Name': 'server-%d' % index, 'env': 'prod' if index % 2 else 'dev'}
+        self.attach_data = AttachData('i-%08x' % (index // 2), '/dev/sd%s' % 'fg'[index % 2])
+        self.status = 'in-use'
+
+class FakeSnapshot(object):
+    __slots__ = ('id', 'volume_id', 'start_time', 'status', 'description', 'tags')
+
+    def __init__(self, id, volume_id, start_time, status, description, tags):
+        self.id = id
+        self.volume_id = volume_id
+        self.start_time = start_time
+        self.status = status
+        self.description = description
+        self.tags = tags
+
+class Page(list):
+    next_token = None
+
+def _filters(params):
+    filters = {}
+    for key, name in params.iteritems():
+        if key.startswith('Filter.') and key.endswith('.Name'):
+            prefix = key[:-len('Name')] + 'Value.'
+            filters[name] = set(v for k, v in params.iteritems() if k.startswith(prefix))
+    return filters
+
+def _matches(values, value):
+    for pattern in values:
+        if pattern.endswith('*') and value.startswith(pattern[:-1]) or value == pattern:
+            return True
+    return False
+
+class FakeEC2Connection(object):
+    ''' An in-memory stand-in for boto's EC2Connection holding `volumes`
+    volumes and `snapshots` Backup Monkey snapshots, spread evenly over the
+    volumes and taken a day apart. Nothing is generated until it is listed,
+    so a million snapshots cost no memory until a caller keeps them.
+
+    Every call sleeps for `latency` seconds, and fails with
+    RequestLimitExceeded with probability `throttle_rate` '''
+
+    def __init__(self, volumes=100000, snapshots=1000000, latency=0.0, throttle_rate=0.0, seed=1):
+        self.volume_count = volumes
+        self.snapshot_count = snapshots
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._deleted = set()
+        self._created = []
+        self._created_ids = {}
+        self.calls = {}
+        self.throttled = 0
+        self._start_times = {}
+
+    # Generated data
+
+    def _volume_index(self, volume_id):
+        try:
+            index = int(volume_id[4:], 16)
+        except ValueError:
+            return None
+        return index if volume_id.startswith('vol-') and index < self.volume_count else None
+
+    def _snapshots_of(self, volume_index):
+        ''' The number of generated snapshots of a volume '''
+        count, extra = divmod(self.snapshot_count, self.volume_count)
+        return count + (1 if volume_index < extra else 0)
+
+    def _start_time(self, age):
+        start_time = self._start_times.get(age)
+        if start_time is None:
+            start_time = self._start_times[age] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(NEWEST - age * DAY))
+        return start_time
+
+    def _snapshot(self, index):
+        if index >= self.snapshot_count:
+            return self._created[index - self.snapshot_count]
+        age, volume_index = divmod(index, self.volume_count)
+        volume_id = 'vol-%08x' % volume_index
+        return FakeSnapshot('snap-%08x' % index, volume_id, self._start_time(age), 'completed',
+            'BACKUP_MONKEY %s' % volume_id, {'BackupMonkey': 'BACKUP_MONKEY', 'Name': 'server-%d' % volume_index})
+
+    def _snapshot_indexes(self, filters):
+        ''' Returns (count, index_at) for the snapshots that may match the
+        filters, where index_at maps a listing position to a snapshot index.
+        Positions are used as NextToken, so pages never rescan earlier ones '''
+        if 'snapshot-id' in filters:
+            indexes = []
+            for snapshot_id in sorted(filters['snapshot-id']):
+                if snapshot_id in self._created_ids:
+                    indexes.append(self._created_ids[snapshot_id])
+                elif snapshot_id.startswith('snap-'):
+                    index = int(snapshot_id[5:], 16)
+                    if index < self.snapshot_count:
+                        indexes.append(index)
+            return len(indexes), indexes.__getitem__
+        if 'volume-id' in filters:
+            volumes = [v for v in (self._volume_index(i) for i in sorted(filters['volume-id'])) if v is not None]
+            counts = [self._snapshots_of(v) for v in volumes]
+            def index_at(cursor):
+                for volume_index, count in zip(volumes, counts):
+                    if cursor < count:
+                        return cursor * self.volume_count + volume_index
+                    cursor -= count
+            return sum(counts), index_at
+        return self.snapshot_count + len(self._created), lambda cursor: cursor
+
+    # API calls
+
+    def _call(self, action):
+        with self._lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = self.throttle_rate and self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            e = BotoServerError(503, 'Service Unavailable', 'Request limit exceeded.')
+            e.error_code = 'RequestLimitExceeded'
+            raise e
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self._call(action)
+        filters = _filters(params)
+        page_size = int(params.get('MaxResults', 1000))
+        cursor = int(params.get('NextToken', 0))
+        page = Page()
+        if action == 'DescribeVolumes':
+            count = self.volume_count
+            while cursor < count and len(page) < page_size:
+                volume = FakeVolume(cursor)
+                cursor += 1
+                if all(_matches(values, volume.tags.get(name[4:], '')) for name, values in filters.iteritems()
+                       if name.startswith('tag:')):
+                    page.append(volume)
+        elif action == 'DescribeSnapshots':
+            count, index_at = self._snapshot_indexes(filters)
+            while cursor < count and len(page) < page_size:
+                index = index_at(cursor)
+                cursor += 1
+                snapshot = self._snapshot(index)
+                if snapshot.id in self._deleted:
+                    continue
+                if 'status' in filters and snapshot.status not in filters['status']:
+                    continue
+                if 'description' in filters and not _matches(filters['description'], snapshot.description):
+                    continue
+                if not all(_matches(values, snapshot.tags.get(name[4:], '')) for name, values in filters.iteritems()
+                           if name.startswith('tag:')):
+                    continue
+                page.append(snapshot)
+        else:
+            raise NotImplementedError(action)
+        if cursor < count:
+            page.next_token = str(cursor)
+        return page
+
+    def get_object(self, action, params, cls, verb='GET'):
+        if action != 'CreateSnapshot':
+            raise NotImplementedError(action)
+        self._call(action)
+        tags = {}
+        for key, value in params.iteritems():
+            if key.startswith('TagSpecification.1.Tag.') and key.endswith('.Key'):
+                tags[value] = params[key[:-len('Key')] + 'Value']
+        with self._lock:
+            index = self.snapshot_count + len(self._created)
+            snapshot = FakeSnapshot('snap-%08x' % index, params['VolumeId'], time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                'pending', params.get('Description', ''), tags)
+            self._created.append(snapshot)
+            self._created_ids[snapshot.id] = index
+        return FakeSnapshot(snapshot.id, snapshot.volume_id, snapshot.start_time, snapshot.status, snapshot.description, {})
+
+    def create_tags(self, resource_ids, tags):
+        self._call('CreateTags')
+        return True
+
+    def delete_snapshot(self, snapshot_id):
+        self._call('DeleteSnapshot')
+        with self._lock:
+            if snapshot_id in self._deleted:
+                e = BotoServerError(400, 'Bad Request', 'The snapshot does not exist.')
+                e.error_code = 'InvalidSnapshot.NotFound'
+                raise e
+            self._deleted.add(snapshot_id)
+        return True
+
+class FakeConnections(object):
+    ''' Stands in for a ConnectionCache, handing out the same fake connection
+    for every region '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, region, account=None, role=None):
+        return self.conn
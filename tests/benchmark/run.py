@@ -0,0 +1,224 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs Backup Monkey against an in-memory EC2 stand-in and reports the wall
+time, CPU time, peak RSS, RSS growth and API calls of each phase. Nothing
+touches the network. Run from the top of the source tree:
+
+    python -m tests.benchmark.run --output results/1.0.0.json
+    python -m tests.benchmark.run --compare results/1.0.0.json
+    python -m tests.benchmark.run --volumes 1000 --snapshots 10000 --latency 0.05 --throttle-rate 0.02 --workers 8
+"""
+
+import argparse, json, logging, os, resource, subprocess, sys, tempfile, threading, time
+
+import backup_monkey
+from backup_monkey import SplunkLogging
+from backup_monkey.core import BackupMonkey
+from backup_monkey.metrics import Metrics
+from backup_monkey.retry import RetryBudget, RetryPolicy
+
+from tests.benchmark.fake_ec2 import FakeEC2Connection, FakeConnections
+
+log = logging.getLogger(__name__)
+
+PHASES = ('discovery', 'snapshot', 'retention')
+# Compared between runs; for all of them lower is better
+COMPARED = ('wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rss_growth_mb', 'api_calls')
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+_PAGE_MB = os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0) if hasattr(os, 'sysconf') else None
+
+def _rss_mb():
+    ''' The process's current RSS, or None where /proc is not available '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_MB
+    except (IOError, IndexError, ValueError, TypeError):
+        return None
+
+class RssSampler(object):
+    ''' Samples the current RSS every interval seconds while a phase runs, so
+    each phase gets its own peak. getrusage's ru_maxrss cannot give that, as
+    it is the peak of the whole process so far. A spike shorter than the
+    interval can be missed '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = _rss_mb()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start = _rss_mb()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(name, conn, func):
+    ''' Runs func, returning what it cost '''
+    calls = dict(conn.calls)
+    throttled = conn.throttled
+    wall = time.time()
+    cpu = _cpu()
+    with RssSampler() as rss:
+        func()
+    wall = time.time() - wall
+    cpu = _cpu() - cpu
+    api_calls = dict((action, count - calls.get(action, 0)) for action, count in conn.calls.items()
+        if count != calls.get(action, 0))
+    result = {
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu, 3),
+        'peak_rss_mb': round(rss.peak, 1) if rss.peak is not None else None,
+        'rss_growth_mb': round(rss.peak - rss.start, 1) if rss.peak is not None else None,
+        'api_calls': sum(api_calls.values()),
+        'api_calls_by_action': api_calls,
+        'throttled': conn.throttled - throttled,
+    }
+    log.info('%-10s %8.2fs wall %8.2fs cpu %8sMB peak RSS %8sMB growth %8d API calls', name, wall, cpu,
+        result['peak_rss_mb'], result['rss_growth_mb'], result['api_calls'])
+    return result
+
+def run_benchmark(args):
+    conn = FakeEC2Connection(args.volumes, args.snapshots, args.latency, args.throttle_rate)
+    metrics = Metrics()
+    monkey = BackupMonkey('us-east-1', args.keep, [], False, None, None, 0, workers=args.workers,
+        delete_workers=args.delete_workers, connections=FakeConnections(conn), page_size=args.page_size,
+        metrics=metrics)
+    # Real backoff would make throttled runs take minutes
+    monkey._retry_policy = RetryPolicy(base_delay=args.retry_delay, max_delay=args.retry_delay * 10,
+        budget=RetryBudget(None))
+    if not args.log:
+        # Throttled runs log every retry, which would swamp the results
+        logging.getLogger('backup_monkey.core').setLevel(logging.CRITICAL)
+
+    phases = {}
+    phases['discovery'] = measure('discovery', conn, lambda: sum(1 for v in monkey.iter_volumes_to_snapshot()))
+    phases['snapshot'] = measure('snapshot', conn, monkey.snapshot_volumes)
+    phases['retention'] = measure('retention', conn, monkey.remove_old_snapshots)
+    SplunkLogging.flush()
+    return {
+        'version': backup_monkey.__version__,
+        'revision': _git_revision(),
+        'python': sys.version.split()[0],
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'volumes': args.volumes,
+            'snapshots': args.snapshots,
+            'keep': args.keep,
+            'latency': args.latency,
+            'throttle_rate': args.throttle_rate,
+            'workers': args.workers,
+            'delete_workers': args.delete_workers,
+            'page_size': args.page_size,
+        },
+        'phases': phases,
+        'metrics': metrics.to_dict(),
+    }
+
+def compare(baseline, result):
+    ''' Returns a line per phase and measure, with the change from baseline '''
+    lines = []
+    if baseline.get('config') != result['config']:
+        lines.append('Warning: the baseline was run with a different configuration: %s' % baseline.get('config'))
+    for phase in PHASES:
+        for key in COMPARED:
+            old = baseline.get('phases', {}).get(phase, {}).get(key)
+            new = result['phases'][phase][key]
+            if old is None or new is None:
+                continue
+            change = (new - old) * 100.0 / old if old else 0.0
+            lines.append('%-10s %-13s %12s -> %12s %+7.1f%%' % (phase, key, old, new, change))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks Backup Monkey against an in-memory EC2 stand-in')
+    parser.add_argument('--volumes', type=int, default=100000,
+                        help='the number of volumes. Default: 100000')
+    parser.add_argument('--snapshots', type=int, default=1000000,
+                        help='the number of existing snapshots, spread evenly over the volumes. Default: 1000000')
+    parser.add_argument('--keep', type=int, default=7,
+                        help='--max-snapshots-per-volume for the retention phase. Default: 7')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every API call takes. Default: 0')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='the fraction of API calls that fail with RequestLimitExceeded. Default: 0')
+    parser.add_argument('--retry-delay', type=float, default=0.01,
+                        help='the base retry delay, in seconds. Default: 0.01')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--delete-workers', type=int)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--log', action='store_true', default=False,
+                        help='log every event, as a real run does')
+    parser.add_argument('--output', metavar='PATH',
+                        help='write the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results with an earlier --output')
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    splunk_log = tempfile.NamedTemporaryFile(prefix='backup-monkey-benchmark', suffix='.log', delete=False)
+    SplunkLogging.set_path(splunk_log.name)
+    try:
+        result = run_benchmark(args)
+    finally:
+        SplunkLogging.reset_path()
+        os.remove(splunk_log.name)
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        log.info('Wrote results to %s', args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for line in compare(baseline, result):
+            log.info(line)
+
+if __name__ == '__main__':
+    main()
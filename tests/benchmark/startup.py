@@ -0,0 +1,182 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how long backup-monkey takes to start: importing the CLI, answering
+--version, and reaching its first EC2 API call with --region given and with
+the region looked up from a local stand-in for the instance metadata service,
+both with an empty and a warm --cache-dir. Each is the median of --repeat new
+processes, counted from when the process is started. Run from the top of the
+source tree:
+
+    python -m tests.benchmark.startup --output results/startup-1.0.0.json
+    python -m tests.benchmark.startup --compare results/startup-1.0.0.json
+"""
+
+import argparse, json, logging, os, shutil, subprocess, sys, tempfile, threading, time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+MEASURES = ('python', 'import', 'version', 'first_call_region', 'first_call_lookup', 'first_call_cached')
+
+class _FirstCall(object):
+    ''' Stands in for an EC2 connection, and ends the process at the first API
+    call, reporting when it was made '''
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            sys.stdout.write('%r\n' % time.time())
+            sys.stdout.flush()
+            os._exit(0)
+        return call
+
+def child(metadata_url, splunk_log, argv):
+    ''' Runs the CLI with argv, up to its first API call '''
+    from backup_monkey import cli, connections, identity, SplunkLogging
+    SplunkLogging.set_path(splunk_log)
+    identity.IDENTITY_URL = metadata_url
+    connections.ConnectionCache.get = lambda self, region, account=None, role=None: _FirstCall()
+    sys.argv = ['backup-monkey'] + argv
+    cli.run()
+
+def _metadata_server(latency):
+    ''' Serves an instance identity document after latency seconds, on its own thread '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            body = json.dumps({'region': 'us-east-1', 'accountId': '111111111111'})
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _time(command, reports_time=False):
+    ''' Seconds from starting command to it exiting, or to the time it printed '''
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    started = time.time()
+    output = subprocess.check_output(command, env=env, cwd=ROOT, stderr=open(os.devnull, 'w'))
+    ended = time.time()
+    if reports_time:
+        ended = float(output.strip().splitlines()[-1])
+    return ended - started
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run_benchmark(args):
+    server = _metadata_server(args.metadata_latency)
+    metadata_url = 'http://127.0.0.1:%d/latest/dynamic/instance-identity/document' % server.server_address[1]
+    cache_dir = tempfile.mkdtemp(prefix='backup-monkey-startup')
+    splunk_log = os.path.join(cache_dir, 'backup_monkey.log')
+    def first_call(*argv):
+        return [sys.executable, '-m', 'tests.benchmark.startup', '--child', '--metadata-url', metadata_url,
+            '--splunk-log', splunk_log, '--'] + list(argv) + ['--snapshot-only', '--cache-dir', cache_dir]
+    commands = {
+        'python': ([sys.executable, '-c', 'pass'], False),
+        'import': ([sys.executable, '-c', 'import backup_monkey.cli'], False),
+        'version': ([sys.executable, os.path.join('bin', 'backup-monkey'), '--version'], False),
+        'first_call_region': (first_call('--region', 'us-east-1'), True),
+        'first_call_lookup': (first_call('--cache-ttl', '0h'), True),
+        'first_call_cached': (first_call(), True),
+    }
+    try:
+        # Compile the modules, and fill the cache for first_call_cached
+        _time(first_call('--cache-ttl', '1d'), True)
+        results = {}
+        for name in MEASURES:
+            command, reports_time = commands[name]
+            results[name] = round(_median([_time(command, reports_time) for i in range(args.repeat)]) * 1000, 1)
+            log.info('%-18s %8.1fms', name, results[name])
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir)
+
+    from tests.benchmark.run import _git_revision
+    import backup_monkey
+    return {
+        'version': backup_monkey.__version__,
+        'revision': _git_revision(),
+        'python': sys.version.split()[0],
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {'repeat': args.repeat, 'metadata_latency': args.metadata_latency},
+        'milliseconds': results,
+    }
+
+def compare(baseline, result):
+    ''' Returns a line per measure, with the change from baseline '''
+    lines = []
+    if baseline.get('config') != result['config']:
+        lines.append('Warning: the baseline was run with a different configuration: %s' % baseline.get('config'))
+    for name in MEASURES:
+        old = baseline.get('milliseconds', {}).get(name)
+        new = result['milliseconds'][name]
+        if old is None:
+            continue
+        change = (new - old) * 100.0 / old if old else 0.0
+        lines.append('%-18s %10s -> %10s %+7.1f%%' % (name, old, new, change))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks how long Backup Monkey takes to start')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='the number of processes to start for each measure. Default: 10')
+    parser.add_argument('--metadata-latency', type=float, default=0.05,
+                        help='seconds the instance metadata stand-in takes to answer. Default: 0.05')
+    parser.add_argument('--output', metavar='PATH',
+                        help='write the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results with an earlier --output')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--metadata-url', help=argparse.SUPPRESS)
+    parser.add_argument('--splunk-log', help=argparse.SUPPRESS)
+    parser.add_argument('argv', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.metadata_url, args.splunk_log, [a for a in args.argv if a != '--'])
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    result = run_benchmark(args)
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        log.info('Wrote results to %s', args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for line in compare(baseline, result):
+            log.info(line)
+
+if __name__ == '__main__':
+    main()
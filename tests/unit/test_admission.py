@@ -0,0 +1,149 @@
+from unittest import TestCase
+import socket, threading
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.admission import PendingSnapshotLimiter
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exception import BackupMonkeyException
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id='vol-1', status='pending', start_time=None):
+        self.id = id
+        self.volume_id = volume_id
+        self.status = status
+        self.start_time = start_time
+        self.tags = {}
+
+class Snapshots(object):
+    ''' Snapshots complete on the poll after they are first described '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.described = set()
+        self.calls = []
+
+    def describe(self, snapshot_ids):
+        with self.lock:
+            self.calls.append(list(snapshot_ids))
+            result = [MockSnapshot(i, status='completed' if i in self.described else 'pending') for i in snapshot_ids]
+            self.described.update(snapshot_ids)
+            return result
+
+class PendingSnapshotLimiterTest(TestCase):
+
+    def setUp(self):
+        self.snapshots = Snapshots()
+        self.limiter = PendingSnapshotLimiter(self.snapshots.describe, 3, min_interval=0.001, max_interval=0.01,
+            batch_size=2)
+
+    def test_limits_in_flight(self):
+        in_flight = []
+        lock = threading.Lock()
+        def snapshot(i):
+            volume_id = 'vol-%d' % i
+            self.limiter.acquire(volume_id)
+            with lock:
+                in_flight.append(self.limiter.in_flight)
+            self.limiter.started(volume_id, 'snap-%d' % i)
+        threads = [threading.Thread(target=snapshot, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(in_flight) == 20
+        assert max(in_flight) <= 3
+        assert self.limiter.peak == 3
+        assert self.limiter.waits > 0
+        # Pending snapshots are described two ids at a time
+        assert max(len(c) for c in self.snapshots.calls) == 2
+
+    def test_seed_counts_pending(self):
+        assert self.limiter.seed([MockSnapshot('snap-a', 'vol-a'), MockSnapshot('snap-b', 'vol-b')]) == 2
+        self.limiter.acquire('vol-1')
+        assert self.limiter.in_flight == 3
+        self.limiter.release('vol-1')
+        assert self.limiter.in_flight == 2
+
+    def test_per_volume(self):
+        self.limiter.acquire('vol-1')
+        self.limiter.started('vol-1', 'snap-1')
+        self.limiter.acquire('vol-2')
+        self.limiter.started('vol-2', 'snap-2')
+        # vol-1 has a pending snapshot, so its next one waits for it
+        self.limiter.acquire('vol-1')
+        assert 'snap-1' in self.snapshots.described
+        assert self.limiter.waits == 1
+
+    def test_missing_snapshots_are_given_time(self):
+        limiter = PendingSnapshotLimiter(lambda ids: [], 1, min_interval=0.001)
+        limiter.acquire('vol-1')
+        limiter.started('vol-1', 'snap-1')
+        limiter.acquire('vol-2')
+        assert limiter.polls == limiter.missing_polls
+
+    def test_limit_exceeded(self):
+        assert not self.limiter.limit_exceeded()
+        self.limiter.acquire('vol-1')
+        self.limiter.started('vol-1', 'snap-1')
+        self.limiter.acquire('vol-2')
+        self.limiter.started('vol-2', 'snap-2')
+        assert self.limiter.limit_exceeded()
+        assert self.limiter.limit == 2
+        assert self.limiter.lowered == 1
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.created = []
+        self.pending = set(['snap-old'])
+        self.refused = 0
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if params.get('Filter.1.Name') == 'status':
+            return [MockSnapshot('snap-old', 'vol-9')]
+        ids = [v for k, v in sorted(params.items()) if k.startswith('Filter.1.Value.')]
+        # Snapshots complete once they have been described
+        result = [MockSnapshot(i, status='pending' if i in self.pending else 'completed') for i in ids]
+        self.pending.difference_update(ids)
+        return result
+
+    def get_object(self, action, params, cls, verb='GET'):
+        if len(self.created) == 1 and not self.refused:
+            self.refused += 1
+            e = BotoServerError(400, 'Bad Request', 'Too many pending snapshots')
+            e.error_code = 'SnapshotLimitExceeded'
+            raise e
+        snapshot_id = 'snap-%d' % len(self.created)
+        self.created.append(params['VolumeId'])
+        self.pending.add(snapshot_id)
+        return MockSnapshot(snapshot_id, params['VolumeId'])
+
+class PendingLimitTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, max_pending=3)
+        self.conn = self.backup_monkey._conn._conn
+
+    def test_requeues_refused_snapshots(self):
+        self.backup_monkey._start_pending_limiter()
+        limiter = self.backup_monkey._pending_limiter
+        limiter.min_interval = 0.001
+        for i in range(4):
+            self.backup_monkey._create_volume_snapshot('vol-%d' % i, 'BACKUP_MONKEY', {}, {})
+        assert self.conn.created == ['vol-0', 'vol-1', 'vol-2', 'vol-3']
+        # snap-old and snap-0 were pending when EC2 refused vol-1
+        assert limiter.lowered == 1
+        assert limiter.limit == 2
+        assert limiter.peak <= 3
+
+    def test_other_errors_release_the_slot(self):
+        self.backup_monkey._start_pending_limiter()
+        limiter = self.backup_monkey._pending_limiter
+        self.conn.get_object = mock.Mock(side_effect=socket.error('Connection reset by peer'))
+        for i in range(3):
+            self.assertRaises(socket.error, self.backup_monkey._create_volume_snapshot, 'vol-%d' % i, 'BACKUP_MONKEY', {}, {})
+        # Only snap-old is left in flight, so the limiter still has room
+        assert limiter.in_flight == 1
+
+    def test_without_limiter(self):
+        self.backup_monkey._create_volume_snapshot('vol-0', 'BACKUP_MONKEY', {}, {})
+        self.assertRaises(BackupMonkeyException, self.backup_monkey._create_volume_snapshot, 'vol-1', 'BACKUP_MONKEY', {}, {})
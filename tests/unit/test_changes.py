@@ -0,0 +1,141 @@
+from unittest import TestCase
+import json, os, shutil, tempfile
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.changes import (ChangeDetector, ChangedBlocksSignal, DetachedSignal, WriteActivitySignal,
+    latest_snapshot, local_changed_blocks)
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.inventory import SnapshotRecord
+from backup_monkey.retention import parse_timestamp
+
+NOW = parse_timestamp('2015-01-31T12:00:00.000Z')
+
+def record(id, volume_id='vol-1', start_time='2015-01-30T12:00:00.000Z', instance_id=None, status='completed'):
+    description = ' '.join(['BACKUP_MONKEY', volume_id] + ([instance_id, '/dev/sdf'] if instance_id else []))
+    return SnapshotRecord(id, volume_id, start_time, status, description, {})
+
+class MockVolume(object):
+    def __init__(self, id, instance_id=None):
+        self.id = id
+        self.attach_data = mock.Mock(instance_id=instance_id, device='/dev/sdf' if instance_id else None)
+        self.tags = {}
+
+class Signal(object):
+    def __init__(self, name, changed):
+        self.name = name
+        self._changed = changed
+
+    def changed(self, volume, last):
+        return self._changed
+
+class ChangeDetectorTest(TestCase):
+
+    def test_decide(self):
+        volume = MockVolume('vol-1')
+        detector = ChangeDetector([Signal('a', None), Signal('b', False)], max_interval=7 * 86400, clock=lambda: NOW)
+        assert detector.decide(volume, None) == (True, 'no earlier snapshot')
+        assert detector.decide(volume, record('snap-1')) == (False, 'b')
+        assert detector.decide(volume, record('snap-1', start_time='2015-01-24T12:00:00.000Z')) == (True, 'last snapshot too old')
+        # Any signal reporting a change wins, and no opinion at all means a snapshot
+        detector.signals = [Signal('a', False), Signal('b', True)]
+        assert detector.decide(volume, record('snap-1')) == (True, 'b')
+        detector.signals = [Signal('a', None)]
+        assert detector.decide(volume, record('snap-1')) == (True, 'no signal')
+
+    def test_detached(self):
+        signal = DetachedSignal()
+        assert signal.changed(MockVolume('vol-1'), record('snap-1')) is False
+        assert signal.changed(MockVolume('vol-1'), record('snap-1', instance_id='i-1')) is True
+        assert signal.changed(MockVolume('vol-1', 'i-1'), record('snap-1')) is None
+        # Snapshots taken with the rest of their instance name only the instance
+        assert signal.changed(MockVolume('vol-1'), record('snap-1')._replace(description='BACKUP_MONKEY i-1')) is True
+
+    def test_latest_snapshot(self):
+        records = [record('snap-1', start_time='2015-01-29T12:00:00.000Z'), record('snap-2'),
+            record('snap-3', start_time='2015-01-31T00:00:00.000Z', status='error')]
+        assert latest_snapshot(records).id == 'snap-2'
+        assert latest_snapshot([]) is None
+
+class FileSignalTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'signal.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mtime=NOW):
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_write_activity(self):
+        signal = WriteActivitySignal(self.path)
+        last = record('snap-1')
+        assert signal.changed(MockVolume('vol-1'), last) is None
+        self.write({'vol-1': '2015-01-30T08:00:00Z', 'vol-2': NOW - 60, 'vol-3': 'yesterday'})
+        assert signal.changed(MockVolume('vol-1'), last) is False
+        assert signal.changed(MockVolume('vol-2'), last) is True
+        assert signal.changed(MockVolume('vol-3'), last) is None
+        assert signal.changed(MockVolume('vol-4'), last) is None
+        # Not written since the snapshot, so it cannot vouch for it
+        self.write({'vol-1': '2015-01-30T08:00:00Z'}, mtime=NOW - 2 * 86400)
+        assert signal.changed(MockVolume('vol-1'), last) is None
+
+    def test_changed_blocks(self):
+        self.write({'vol-1': {'since': 'snap-1', 'changed_blocks': 0}, 'vol-2': {'since': 'snap-1', 'changed_blocks': 12}})
+        signal = ChangedBlocksSignal(local_changed_blocks(self.path))
+        assert signal.changed(MockVolume('vol-1'), record('snap-1')) is False
+        assert signal.changed(MockVolume('vol-2'), record('snap-1', 'vol-2')) is True
+        # Counts since an older snapshot say nothing about the last one
+        assert signal.changed(MockVolume('vol-1'), record('snap-9')) is None
+        assert ChangedBlocksSignal(local_changed_blocks(self.path), threshold=20).changed(
+            MockVolume('vol-2'), record('snap-1', 'vol-2')) is False
+
+class MockSnapshot(object):
+    def __init__(self, record):
+        for field in SnapshotRecord._fields:
+            setattr(self, field, getattr(record, field))
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.calls = []
+        self.snapshots = [record('snap-1', 'vol-1'), record('snap-2', 'vol-2', instance_id='i-1'),
+            record('snap-3', 'vol-3', start_time='2015-01-01T00:00:00.000Z')]
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.calls.append((action, params))
+        values = [v for k, v in params.items() if k.startswith('Filter.') and '.Value.' in k]
+        return MockResultSet(MockSnapshot(r) for r in self.snapshots if r.volume_id in values)
+
+class SkipUnchangedTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        detector = ChangeDetector([DetachedSignal()], clock=lambda: NOW)
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, change_detector=detector)
+        self.conn = self.backup_monkey._conn._conn
+        self.backup_monkey._filter_values_limit = 3
+
+    def test_plan_skips_unchanged(self):
+        # vol-1 stayed detached, vol-2 was detached since, vol-3's snapshot is too old, vol-4 has none
+        volumes = [MockVolume('vol-%d' % i) for i in range(1, 5)] + [MockVolume('vol-5', 'i-5')]
+        with mock.patch.object(self.backup_monkey, 'iter_volumes_to_snapshot', return_value=iter(volumes)):
+            plan = self.backup_monkey.plan(remove=False)
+        assert [c['volume_id'] for c in plan['creates']] == ['vol-2', 'vol-3', 'vol-4', 'vol-5']
+        assert plan['unchanged'] == 1
+        # One lookup per 3 volumes
+        assert len(self.conn.calls) == 2
+        assert plan['api_calls']['DescribeSnapshots'] == 2
+        assert self.backup_monkey._inventory.volume_ids == set(v.id for v in volumes)
+
+    def test_failed_lookup(self):
+        self.conn.get_list = mock.Mock(side_effect=BotoServerError(403, 'Forbidden', 'Not authorized'))
+        volumes = [MockVolume('vol-1')]
+        with mock.patch.object(self.backup_monkey, 'iter_volumes_to_snapshot', return_value=iter(volumes)):
+            self.assertRaises(BackupMonkeyException, self.backup_monkey.snapshot_volumes)
@@ -0,0 +1,117 @@
+from unittest import TestCase
+import datetime, gc, threading, time
+import mock
+from backup_monkey.connections import CredentialCache, ConnectionCache, ConnectionPool
+from backup_monkey.metrics import Metrics
+
+class MockCredentials(object):
+    def __init__(self, seconds):
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+        self.expiration = expiration.strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.access_key = 'access'
+        self.secret_key = 'secret'
+        self.session_token = 'token'
+
+def mock_sts(seconds):
+    sts = mock.MagicMock()
+    sts.return_value.assume_role.side_effect = lambda **kwargs: mock.MagicMock(credentials=MockCredentials(seconds))
+    return sts
+
+class ConnectionsTest(TestCase):
+
+    def test_credentials_cached(self):
+        with mock.patch('backup_monkey.connections.STSConnection', mock_sts(3600)) as sts:
+            cache = CredentialCache(refresh_margin=300)
+            first = cache.get('111111111111', 'Snapshot')
+            assert cache.get('111111111111', 'Snapshot') is first
+            assert sts.return_value.assume_role.call_count == 1
+            cache.get('222222222222', 'Snapshot')
+            assert sts.return_value.assume_role.call_count == 2
+
+    def test_credentials_refreshed_before_expiry(self):
+        with mock.patch('backup_monkey.connections.STSConnection', mock_sts(200)) as sts:
+            cache = CredentialCache(refresh_margin=300)
+            credentials, refresh_at = cache.get('111111111111', 'Snapshot')
+            assert refresh_at < time.time()
+            cache.get('111111111111', 'Snapshot')
+            assert sts.return_value.assume_role.call_count == 2
+
+    @mock.patch('backup_monkey.connections.ec2.connect_to_region', side_effect=lambda region, **kwargs: mock.MagicMock())
+    def test_connections_reused_per_account_and_region(self, connect):
+        with mock.patch('backup_monkey.connections.STSConnection', mock_sts(3600)) as sts:
+            cache = ConnectionCache()
+            conn = cache.get('us-east-1', '111111111111', 'Snapshot')
+            assert cache.get('us-east-1', '111111111111', 'Snapshot') is conn
+            assert cache.get('eu-west-1', '111111111111', 'Snapshot') is not conn
+            assert sts.return_value.assume_role.call_count == 1
+            assert connect.call_count == 2
+
+    @mock.patch('backup_monkey.connections.ec2.connect_to_region', return_value=None)
+    def test_unknown_region(self, connect):
+        assert ConnectionCache().get('xx-north-9') is None
+
+class MockConnection(object):
+    def __init__(self, n):
+        self.n = n
+
+    def describe(self):
+        return self.n
+
+class ConnectionPoolTest(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.connected = []
+        self.refresh_at = None
+
+    def connect(self):
+        self.connected.append(MockConnection(len(self.connected)))
+        return self.connected[-1], self.refresh_at
+
+    def in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        gc.collect()
+        return result[0]
+
+    def test_one_connection_per_thread(self):
+        pool = ConnectionPool(self.connect, 'us-east-1', self.metrics)
+        assert pool.describe() == 0
+        assert pool.describe() == 0
+        # Two threads at once each get their own connection
+        started = threading.Event()
+        seen = []
+        def hold():
+            seen.append(pool.describe())
+            started.wait(5)
+        threads = [threading.Thread(target=hold) for i in range(2)]
+        for t in threads:
+            t.start()
+        while len(seen) < 2:
+            time.sleep(0.001)
+        started.set()
+        for t in threads:
+            t.join()
+        assert sorted(seen) == [1, 2]
+        gc.collect()
+        # Connections of threads that have ended are handed to the next ones
+        assert self.in_thread(lambda: pool.describe()) in (1, 2)
+        assert len(self.connected) == 3
+        pools = self.metrics.to_dict()['connection_pool']
+        # Only the connection handed on counts as a hit, not every call on a thread's own
+        assert pools[0]['misses'] == 3 and pools[0]['hits'] == 1
+        assert 'backup_monkey_connection_pool_misses_total{region="us-east-1",reason="new"} 3' in self.metrics.to_prometheus()
+
+    def test_refreshed_credentials(self):
+        pool = ConnectionPool(self.connect, 'us-east-1', self.metrics)
+        self.refresh_at = time.time() - 1
+        pool.describe()
+        self.refresh_at = None
+        # The first connection's credentials have expired, so it is replaced
+        assert pool.describe() == 1
+        assert pool.describe() == 1
+        assert self.in_thread(lambda: pool.describe()) == 2
+        pools = self.metrics.to_dict()['connection_pool']
+        assert pools[0]['misses'] == 3 and pools[0]['expired'] == 1
@@ -0,0 +1,177 @@
+from unittest import TestCase
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.copies import CopyLimitExceeded, CopyQueue, SOURCE_REGION_TAG, SOURCE_VOLUME_TAG
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.inventory import Inventory, SnapshotRecord
+from backup_monkey.retention import RetentionPolicy
+
+class MockSnapshot(object):
+    def __init__(self, id, status='pending', volume_id='vol-ffffffff', tags=None, start_time='2015-01-01T00:00:00.000Z',
+                 description='BACKUP_MONKEY vol-1'):
+        self.id = id
+        self.status = status
+        self.volume_id = volume_id
+        self.volume_size = 8
+        self.tags = tags or {}
+        self.start_time = start_time
+        self.description = description
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class Destination(object):
+    ''' Copies take two polls to complete, and at most limit may be in progress '''
+    def __init__(self, limit=None, failing=()):
+        self.limit = limit
+        self.failing = failing
+        self.polls = {}
+        self.calls = []
+        self.in_progress = set()
+
+    def copy(self, snapshot_id):
+        if self.limit is not None and len(self.in_progress) >= self.limit:
+            raise CopyLimitExceeded('too many copies')
+        if snapshot_id in self.failing:
+            return None
+        copy_id = 'copy-%s' % snapshot_id
+        self.in_progress.add(copy_id)
+        return copy_id
+
+    def describe(self, copy_ids):
+        self.calls.append(list(copy_ids))
+        result = []
+        for copy_id in copy_ids:
+            self.polls[copy_id] = self.polls.get(copy_id, 0) + 1
+            done = self.polls[copy_id] >= 2
+            if done:
+                self.in_progress.discard(copy_id)
+            result.append(MockSnapshot(copy_id, 'completed' if done else 'pending'))
+        return result
+
+class CopyQueueTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def queue(self, destination, limit, **kwargs):
+        return CopyQueue(destination.copy, destination.describe, limit, min_interval=10, max_interval=60, batch_size=2,
+            clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_limits_copies_in_progress(self):
+        destination = Destination()
+        completed = []
+        queue = self.queue(destination, 2, on_complete=lambda *args: completed.append(args))
+        result = queue.run(['snap-%d' % i for i in range(5)])
+        assert sorted(result.completed) == ['snap-%d' % i for i in range(5)]
+        assert queue.peak == 2
+        assert result.completed['snap-0'] == ('copy-snap-0', 25)
+        assert result.gib == 40 and completed[0][3] == 8
+        assert not result.failed and not result.pending and not result.queued
+
+    def test_lowers_limit_when_refused(self):
+        destination = Destination(limit=2)
+        queue = self.queue(destination, 4)
+        result = queue.run(['snap-%d' % i for i in range(5)])
+        assert len(result.completed) == 5
+        assert queue.limit == 2 and queue.lowered == 1
+
+    def test_failures_and_timeout(self):
+        destination = Destination(failing=['snap-1'])
+        failed = []
+        queue = self.queue(destination, 1, timeout=30, on_fail=lambda *args: failed.append(args))
+        result = queue.run(['snap-0', 'snap-1', 'snap-2', 'snap-3'])
+        assert result.failed == {'snap-1': 'error'}
+        assert failed == [('snap-1', None, 'error')]
+        assert sorted(result.completed) == ['snap-0']
+        assert result.pending == ['snap-2']
+        assert result.queued == ['snap-3']
+
+class MockResultSet(list):
+    next_token = None
+
+class SourceRegion(object):
+    def get_list(self, action, params, markers, verb='GET'):
+        return MockResultSet()
+
+class DestinationRegion(object):
+    def __init__(self):
+        self.copied = []
+        self.deleted = []
+        self.existing = [MockSnapshot('copy-old-%d' % i, 'completed', start_time='2015-01-0%dT00:00:00.000Z' % (i + 1),
+                tags={SOURCE_REGION_TAG: 'us-east-1', SOURCE_VOLUME_TAG: 'vol-%d' % (i % 2)})
+            for i in range(4)]
+
+    def get_object(self, action, params, cls, verb='GET'):
+        if len(self.copied) == 1:
+            e = BotoServerError(400, 'Bad Request', 'Too many snapshot copies in progress')
+            e.error_code = 'ResourceLimitExceeded'
+            self.copied.append(None)
+            raise e
+        self.copied.append(params)
+        return MockSnapshot('copy-%d' % len(self.copied))
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if params.get('Filter.1.Name') == 'snapshot-id':
+            return MockResultSet(MockSnapshot(v, 'completed') for k, v in params.items() if k.startswith('Filter.1.Value.'))
+        return MockResultSet(self.existing)
+
+    def delete_snapshot(self, snapshot_id):
+        self.deleted.append(snapshot_id)
+
+class CopySnapshotsTest(TestCase):
+
+    def setUp(self):
+        self.conns = {'us-east-1': SourceRegion(), 'us-west-2': DestinationRegion()}
+        patcher = mock.patch.object(BackupMonkey, '_get_connection', autospec=True,
+            side_effect=lambda monkey: self.conns[monkey._region])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backup_monkey = BackupMonkey('us-east-1', 1, [], False, None, None, 0)
+        self.backup_monkey._created = [SnapshotRecord('snap-%d' % i, 'vol-%d' % i, '2015-01-05T00:00:00.000Z', 'pending',
+            'BACKUP_MONKEY vol-%d' % i, {'Name': 'db', 'BackupMonkey': 'BACKUP_MONKEY'}) for i in range(3)]
+        self.backup_monkey._completed = set(['snap-0', 'snap-1'])
+
+    def test_copies_completed_snapshots(self):
+        results = self.backup_monkey.copy_snapshots(['us-west-2', 'us-east-1'], max_copies=2, min_interval=0.001)
+        assert list(results) == ['us-west-2']
+        assert sorted(results['us-west-2'].completed) == ['snap-0', 'snap-1']
+        copied = [p for p in self.conns['us-west-2'].copied if p]
+        assert sorted(p['SourceSnapshotId'] for p in copied) == ['snap-0', 'snap-1']
+        tags = dict((p['TagSpecification.1.Tag.%d.Key' % i], p['TagSpecification.1.Tag.%d.Value' % i])
+            for p in copied[:1] for i in range(1, 6))
+        assert tags == {'Name': 'db', 'BackupMonkey': 'BACKUP_MONKEY', SOURCE_REGION_TAG: 'us-east-1',
+            SOURCE_VOLUME_TAG: 'vol-0', 'BackupMonkeySourceSnapshot': 'snap-0'}
+        assert copied[0]['SourceRegion'] == 'us-east-1' and copied[0]['Description'] == 'BACKUP_MONKEY vol-0'
+
+    def test_failed_copy(self):
+        self.conns['us-west-2'].get_object = mock.Mock(side_effect=BotoServerError(400, 'Bad Request', 'Nope'))
+        self.assertRaises(BackupMonkeyException, self.backup_monkey.copy_snapshots, ['us-west-2'], min_interval=0.001)
+
+    def test_retention_by_source_volume(self):
+        self.backup_monkey._retention_policy = RetentionPolicy(keep_last=1)
+        self.backup_monkey.remove_old_copies(['us-west-2'])
+        # The newest copy of each source volume is kept
+        assert sorted(self.conns['us-west-2'].deleted) == ['copy-old-0', 'copy-old-1']
+
+    def test_retention_leaves_copies_alone(self):
+        destination = self.conns['us-west-2']
+        destination.existing += [MockSnapshot('snap-own-%d' % i, 'completed', volume_id='vol-9',
+            start_time='2015-01-0%dT00:00:00.000Z' % (i + 1)) for i in range(2)]
+        BackupMonkey('us-west-2', 1, [], False, None, None, 0).remove_old_snapshots()
+        # Every copy has volume id vol-ffffffff, but only the region's own snapshots are considered
+        assert destination.deleted == ['snap-own-0']
+
+    def test_retention_skips_copies_in_inventory(self):
+        inventory = Inventory()
+        list(inventory.sync(SnapshotRecord.from_snapshot(s) for s in self.conns['us-west-2'].existing))
+        BackupMonkey('us-west-2', 1, [], False, None, None, 0, inventory=inventory).remove_old_snapshots()
+        assert self.conns['us-west-2'].deleted == []
@@ -0,0 +1,154 @@
+from unittest import TestCase
+import calendar, json, os, shutil, tempfile, threading, urllib2
+from backup_monkey.daemon import DaemonJob, Scheduler, StatusServer, load_jobs, parse_address
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.metrics import Metrics
+from backup_monkey.schedule import CronSchedule
+
+def epoch(*args):
+    return calendar.timegm(args + (0, ) * (6 - len(args)))
+
+class CronScheduleTest(TestCase):
+
+    def test_next_after(self):
+        now = epoch(2015, 1, 30, 10, 7)
+        assert CronSchedule('*/15 * * * *').next_after(now) == epoch(2015, 1, 30, 10, 15)
+        assert CronSchedule('0 3 * * *').next_after(now) == epoch(2015, 1, 31, 3)
+        assert CronSchedule('0 0 1 * *').next_after(now) == epoch(2015, 2, 1)
+        # 2015-01-30 is a Friday, and cron counts Sunday as 0 or 7
+        assert CronSchedule('0 12 * * 0').next_after(now) == epoch(2015, 2, 1, 12)
+        assert CronSchedule('0 12 * * 7').next_after(now) == epoch(2015, 2, 1, 12)
+        assert CronSchedule('@hourly').next_after(now) == epoch(2015, 1, 30, 11)
+        assert CronSchedule('0 0 29 2 *').next_after(now) == epoch(2016, 2, 29)
+
+    def test_day_of_month_or_week(self):
+        # Either the 1st or a Monday
+        schedule = CronSchedule('0 0 1 * 1')
+        assert schedule.next_after(epoch(2015, 1, 30)) == epoch(2015, 2, 1)
+        assert schedule.next_after(epoch(2015, 2, 1)) == epoch(2015, 2, 2)
+
+    def test_always_after(self):
+        schedule = CronSchedule('30 10 * * *')
+        assert schedule.next_after(epoch(2015, 1, 30, 10, 30)) == epoch(2015, 1, 31, 10, 30)
+        assert schedule.next_after(epoch(2015, 1, 30, 10, 29, 59)) == epoch(2015, 1, 30, 10, 30)
+
+    def test_invalid(self):
+        for expression in ('', '* * * *', '60 * * * *', '* * 0 * *', '*/0 * * * *', '5-1 * * * *', 'x * * * *'):
+            self.assertRaises(ValueError, CronSchedule, expression)
+        self.assertRaises(ValueError, CronSchedule('0 0 30 2 *').next_after, 0)
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock(epoch(2015, 1, 30, 10, 7))
+        self.release = threading.Event()
+        self.ran = []
+
+    def run_job(self, job):
+        self.ran.append(job.name)
+        self.release.wait(5)
+        if job.name == 'broken':
+            raise BackupMonkeyException('broken')
+
+    def test_runs_when_due_and_never_twice(self):
+        job = DaemonJob('prod', CronSchedule('*/15 * * * *'), [])
+        scheduler = Scheduler([job], self.run_job, clock=self.clock)
+        assert scheduler.tick() == 8 * 60
+        assert self.ran == []
+        self.clock.now = epoch(2015, 1, 30, 10, 15)
+        scheduler.tick()
+        assert job.running_since == self.clock.now
+        # Still running when it comes due again
+        self.clock.now = epoch(2015, 1, 30, 10, 30)
+        scheduler.tick()
+        assert job.skipped == 1
+        self.release.set()
+        scheduler.join()
+        assert self.ran == ['prod']
+        assert job.runs == 1 and job.last_run['ok'] and job.last_success == self.clock.now
+        assert job.next_run == epoch(2015, 1, 30, 10, 45)
+
+    def test_failed_job(self):
+        self.release.set()
+        job = DaemonJob('broken', CronSchedule('@hourly'), [])
+        scheduler = Scheduler([job], self.run_job, clock=self.clock)
+        scheduler.start(job)
+        scheduler.join()
+        assert job.failures == 1
+        assert job.last_run['error'] == 'broken'
+        healthy, details = scheduler.health()
+        assert not healthy
+        scheduler.tick()
+        healthy, details = scheduler.health()
+        assert healthy and details['failing'] == ['broken']
+        assert 'backup_monkey_job_failures_total{job="broken"} 1' in scheduler.to_prometheus()
+
+class StatusServerTest(TestCase):
+
+    def setUp(self):
+        self.job = DaemonJob('prod', CronSchedule('@daily'), ['--select', 'env=prod'])
+        self.scheduler = Scheduler([self.job], lambda job: None)
+        self.scheduler.tick()
+        self.metrics = Metrics()
+        self.metrics.observe('DescribeVolumes', 'us-east-1', 0.1)
+        self.server = StatusServer(('127.0.0.1', 0), self.scheduler, self.metrics)
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_endpoints(self):
+        assert json.load(urllib2.urlopen(self.url + '/health'))['status'] == 'ok'
+        jobs = json.load(urllib2.urlopen(self.url + '/jobs'))
+        assert [j['name'] for j in jobs] == ['prod']
+        assert jobs[0]['args'] == ['--select', 'env=prod'] and jobs[0]['last_run'] is None
+        metrics = urllib2.urlopen(self.url + '/metrics').read()
+        assert 'backup_monkey_api_calls_total{operation="DescribeVolumes",region="us-east-1"} 1' in metrics
+        assert 'backup_monkey_job_runs_total{job="prod"} 0' in metrics
+        self.scheduler.stop()
+        try:
+            urllib2.urlopen(self.url + '/health')
+            assert False
+        except urllib2.HTTPError as e:
+            assert e.code == 503
+
+class LoadJobsTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'jobs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, config):
+        with open(self.path, 'w') as f:
+            json.dump(config, f)
+
+    def test_load_jobs(self):
+        self.write({'jobs': [
+            {'name': 'prod', 'schedule': '0 */6 * * *', 'args': ['--select', 'env=prod']},
+            {'name': 'dev', 'schedule': '@daily', 'args': '--select "env=dev OR env=test" --retention 7d'},
+        ]})
+        jobs = load_jobs(self.path)
+        assert [j.name for j in jobs] == ['prod', 'dev']
+        assert jobs[1].args == ['--select', 'env=dev OR env=test', '--retention', '7d']
+
+    def test_invalid_jobs(self):
+        for config in ([], {'jobs': []}, {'jobs': [{'schedule': '@daily'}]}, {'jobs': [{'name': 'a', 'schedule': 'daily'}]},
+                       {'jobs': [{'name': 'a', 'schedule': '@daily'}, {'name': 'a', 'schedule': '@hourly'}]}):
+            self.write(config)
+            self.assertRaises(ValueError, load_jobs, self.path)
+
+    def test_parse_address(self):
+        assert parse_address('0.0.0.0:9000') == ('0.0.0.0', 9000)
+        assert parse_address('9000') == ('127.0.0.1', 9000)
+        self.assertRaises(ValueError, parse_address, 'localhost')
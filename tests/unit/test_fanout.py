@@ -0,0 +1,32 @@
+from unittest import TestCase
+from backup_monkey import SplunkLogging
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.fanout import run_jobs, format_results
+import tempfile, os
+
+class FanOutTest(TestCase):
+    log_file = tempfile.mkstemp()[1]
+
+    @classmethod
+    def setUpClass(cls):
+        SplunkLogging.set_path(cls.log_file)
+
+    def test_run_jobs(self):
+        def func(region):
+            if region == 'eu-west-1':
+                raise BackupMonkeyException('broken')
+        results = run_jobs([(r, r) for r in ['us-east-1', 'eu-west-1', 'us-west-2']], func)
+        assert [r.name for r in results] == ['us-east-1', 'eu-west-1', 'us-west-2']
+        assert [r.ok for r in results] == [True, False, True]
+        assert results[1].error == 'broken'
+
+    def test_format_results(self):
+        results = run_jobs([('us-east-1', None)], lambda job: None)
+        lines = format_results(results)
+        assert len(lines) == 2
+        assert lines[1].startswith('us-east-1  OK')
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.log_file)
+        SplunkLogging.reset_path()
@@ -0,0 +1,68 @@
+from unittest import TestCase
+import json, os, shutil, tempfile
+import mock
+from backup_monkey.identity import DiskCache, instance_identity
+
+DOCUMENT = json.dumps({'region': 'eu-west-1', 'accountId': '111111111111', 'instanceId': 'i-1'})
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class DiskCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'identity.json')
+        self.clock = Clock()
+        self.cache = DiskCache(self.path, 3600, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_expires(self):
+        fetch = mock.Mock(return_value={'region': 'eu-west-1'})
+        assert self.cache.cached('identity', fetch) == {'region': 'eu-west-1'}
+        assert self.cache.cached('identity', fetch) == {'region': 'eu-west-1'}
+        # A new process reads the same file
+        assert DiskCache(self.path, 3600, clock=self.clock).get('identity') == {'region': 'eu-west-1'}
+        assert fetch.call_count == 1
+        self.clock.now += 3600
+        self.cache.cached('identity', fetch)
+        assert fetch.call_count == 2
+
+    def test_none_is_not_cached(self):
+        fetch = mock.Mock(return_value=None)
+        assert self.cache.cached('identity', fetch) is None
+        assert not os.path.exists(self.path)
+
+    def test_disabled(self):
+        cache = DiskCache(self.path, 0)
+        cache.set('identity', {'region': 'eu-west-1'})
+        assert cache.get('identity') is None
+        assert not os.path.exists(self.path)
+
+    def test_corrupt_or_unwritable(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        assert self.cache.get('identity') is None
+        self.cache.set('identity', 'x')
+        assert self.cache.get('identity') == 'x'
+        unwritable = DiskCache(os.path.join(self.path, 'identity.json'), 3600)
+        unwritable.set('identity', 'x')
+        assert unwritable.get('identity') is None
+
+class InstanceIdentityTest(TestCase):
+
+    @mock.patch('boto.utils.retry_url', return_value=DOCUMENT)
+    def test_identity(self, retry_url):
+        assert instance_identity() == {'region': 'eu-west-1', 'account': '111111111111'}
+        assert retry_url.call_count == 1
+
+    @mock.patch('boto.utils.retry_url', return_value='')
+    def test_not_on_ec2(self, retry_url):
+        assert instance_identity() is None
@@ -0,0 +1,85 @@
+from unittest import TestCase
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.core import BackupMonkey
+
+class MockVolume(object):
+    def __init__(self, id, instance_id=None, device=None):
+        self.id = id
+        self.attach_data = mock.Mock(instance_id=instance_id, device=device)
+        self.tags = {'Name': id}
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id):
+        self.id = id
+        self.volume_id = volume_id
+        self.status = None
+        self.state = 'pending'
+        self.start_time = '2015-01-01T00:00:00.000Z'
+        self.tags = {}
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.calls = []
+        self.unsupported = False
+        mapping = dict((device, mock.Mock(volume_id=volume_id)) for device, volume_id in
+            (('/dev/xvda', 'vol-root'), ('/dev/sdf', 'vol-1'), ('/dev/sdg', 'vol-2'), ('/dev/sdh', 'vol-3')))
+        self.instance = mock.Mock(id='i-1', root_device_name='/dev/xvda', block_device_mapping=mapping)
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.calls.append((action, params))
+        if action == 'DescribeInstances':
+            return MockResultSet([mock.Mock(instances=[self.instance])])
+        if self.unsupported:
+            e = BotoServerError(400, 'Bad Request', 'Unknown action')
+            e.error_code = 'InvalidAction'
+            raise e
+        excluded = [v for k, v in params.items() if k.startswith('InstanceSpecification.ExcludeDataVolumeId.')]
+        return MockResultSet(MockSnapshot('snap-%s' % volume_id, volume_id) for volume_id in ('vol-1', 'vol-2', 'vol-3')
+            if volume_id not in excluded)
+
+    def get_object(self, action, params, cls, verb='GET'):
+        self.calls.append((action, params))
+        return MockSnapshot('snap-%s' % params['VolumeId'], params['VolumeId'])
+
+class InstanceSnapshotsTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, instance_snapshots=True)
+        self.conn = self.backup_monkey._conn._conn
+        # vol-3 and the boot volume of i-1 are not selected, and vol-4 is alone on i-2
+        self.volumes = [MockVolume('vol-1', 'i-1', '/dev/sdf'), MockVolume('vol-5'), MockVolume('vol-4', 'i-2', '/dev/sdf'),
+            MockVolume('vol-2', 'i-1', '/dev/sdg')]
+
+    def snapshot_volumes(self):
+        with mock.patch.object(self.backup_monkey, 'iter_volumes_to_snapshot', return_value=iter(self.volumes)):
+            self.backup_monkey.snapshot_volumes()
+        return [(action, params.get('VolumeId') or params.get('InstanceSpecification.InstanceId') or params.get('Filter.1.Value.1'))
+            for action, params in self.conn.calls]
+
+    def test_one_call_per_instance(self):
+        calls = self.snapshot_volumes()
+        assert calls == [('CreateSnapshot', 'vol-5'), ('DescribeInstances', 'i-1'), ('CreateSnapshots', 'i-1'),
+            ('CreateSnapshot', 'vol-4')]
+        params = self.conn.calls[2][1]
+        assert params['InstanceSpecification.ExcludeBootVolume'] == 'true'
+        assert params['InstanceSpecification.ExcludeDataVolumeId.1'] == 'vol-3'
+        assert 'InstanceSpecification.ExcludeDataVolumeId.2' not in params
+        assert params['CopyTagsFromSource'] == 'volume'
+        assert params['TagSpecification.1.Tag.1.Key'] == 'BackupMonkey'
+        created = dict((r.volume_id, r) for r in self.backup_monkey._created)
+        assert sorted(created) == ['vol-1', 'vol-2', 'vol-4', 'vol-5']
+        assert created['vol-1'].description == 'BACKUP_MONKEY i-1'
+        assert created['vol-1'].status == 'pending'
+        assert created['vol-1'].tags == {'Name': 'vol-1', 'BackupMonkey': 'BACKUP_MONKEY'}
+
+    def test_unsupported_falls_back_to_volumes(self):
+        self.conn.unsupported = True
+        calls = self.snapshot_volumes()
+        assert calls[2:5] == [('CreateSnapshots', 'i-1'), ('CreateSnapshot', 'vol-1'), ('CreateSnapshot', 'vol-2')]
+        assert not self.backup_monkey._instance_snapshots
+        assert len(self.backup_monkey._created) == 4
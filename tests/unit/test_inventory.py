@@ -0,0 +1,105 @@
+from unittest import TestCase
+import os, shutil, sqlite3, tempfile
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.inventory import Inventory, SnapshotRecord, SqliteInventory
+
+def record(id, volume_id='vol-1', status='completed'):
+    return SnapshotRecord(id, volume_id, '2015-01-01T00:00:00.000Z', status, 'BACKUP_MONKEY %s' % volume_id, {'Name': 'foo'})
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.calls.append((action, params))
+        ids = [v for k, v in params.items() if k.startswith('Filter.1.Value.')]
+        # snap-gone was deleted out of band, everything else has completed
+        return MockResultSet([record(i)._replace(status='completed') for i in ids if i != 'snap-gone'])
+
+class InventoryTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sync_only_fresh_when_consumed(self):
+        inventory = Inventory()
+        listing = inventory.sync(iter([record('snap-1'), record('snap-2')]))
+        next(listing)
+        assert not inventory.is_fresh()
+        list(listing)
+        assert inventory.is_fresh()
+        assert sorted(r.id for r in inventory.snapshots()) == ['snap-1', 'snap-2']
+
+    def test_sqlite_persists_between_runs(self):
+        inventory = SqliteInventory(self.path, 'self/us-east-1')
+        assert not inventory.is_fresh()
+        list(inventory.sync(iter([record('snap-1'), record('snap-2')])))
+        inventory.add_snapshot(record('snap-3', status='pending'))
+        inventory.remove_snapshot('snap-1')
+        inventory.close()
+
+        inventory = SqliteInventory(self.path, 'self/us-east-1')
+        assert inventory.is_fresh()
+        assert sorted(r.id for r in inventory.snapshots()) == ['snap-2', 'snap-3']
+        assert inventory.pending_snapshot_ids() == ['snap-3']
+        assert inventory.snapshots()[0].tags == {'Name': 'foo'}
+        inventory.close()
+
+        # other scopes and stale listings are not fresh
+        assert not SqliteInventory(self.path, 'self/eu-west-1').is_fresh()
+        assert not SqliteInventory(self.path, 'self/us-east-1', max_age=0).is_fresh()
+
+    def test_scopes_share_one_database(self):
+        east = SqliteInventory(self.path, 'self/us-east-1')
+        west = SqliteInventory(self.path, 'self/us-west-2')
+        # Nothing may hold a write transaction between calls, or this would time out
+        other = sqlite3.connect(self.path, timeout=0.1)
+        def write():
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+        east.add_snapshot(record('snap-1'))
+        write()
+        west.set_volumes({'vol-2': {}})
+        west.add_snapshot(record('snap-2', 'vol-2'))
+        write()
+        east.remove_snapshot('snap-1')
+        write()
+        listing = west.sync(iter([record('snap-%d' % i, 'vol-2') for i in range(2, 1003)]))
+        for i in range(1001):
+            next(listing)
+        write()
+        # The listing was not finished, so it is not fresh for the next run
+        assert not SqliteInventory(self.path, 'self/us-west-2').is_fresh()
+        list(listing)
+        write()
+        assert SqliteInventory(self.path, 'self/us-west-2').is_fresh()
+        assert len(west.snapshots()) == 1001 and east.snapshots() == []
+        other.close()
+        east.close()
+        west.close()
+
+    def test_retention_reads_fresh_inventory(self):
+        inventory = Inventory()
+        list(inventory.sync(iter([record('snap-%d' % i) for i in range(5)])))
+        inventory.add_snapshot(record('snap-new', status='pending'))
+        inventory.add_snapshot(record('snap-gone', status='pending'))
+        conn = MockEC2Connection()
+        with mock.patch('backup_monkey.core.BackupMonkey.get_connection', return_value=conn):
+            monkey = BackupMonkey('us-west-2', 3, [], None, None, None, 0, inventory=inventory)
+        monkey._connection = conn
+
+        snapshots = list(monkey._backup_snapshots_for_retention())
+        # a single describe of the pending snapshots, rather than a full listing
+        assert len(conn.calls) == 1
+        assert conn.calls[0][1]['Filter.1.Name'] == 'snapshot-id'
+        assert len(snapshots) == 6
+        assert 'snap-gone' not in [s.id for s in inventory.snapshots()]
+        assert inventory.pending_snapshot_ids() == []
@@ -0,0 +1,164 @@
+from unittest import TestCase
+import json, os, shutil, tempfile
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.inventory import SnapshotRecord
+from backup_monkey.journal import RunJournal
+from backup_monkey.retention import parse_timestamp
+
+NOW = parse_timestamp('2015-01-01T00:00:00.000Z')
+
+def record(id, volume_id, description=None):
+    return SnapshotRecord(id, volume_id, '2015-01-01T00:01:00.000Z', 'pending', description or 'BACKUP_MONKEY %s' % volume_id,
+        {'BackupMonkey': 'BACKUP_MONKEY'})
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal', 'self-us-west-2.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def journal(self, resume=False):
+        return RunJournal(self.path, resume=resume, clock=lambda: NOW)
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+class RunJournalTest(JournalTestCase):
+
+    def test_resume(self):
+        journal = self.journal()
+        journal.creating('vol-1', 'BACKUP_MONKEY vol-1', {})
+        journal.created(record('snap-1', 'vol-1'), tagged=False)
+        journal.creating('vol-2', 'BACKUP_MONKEY vol-2', {})
+        journal.deleting('snap-old')
+        journal.deleted('snap-older')
+        journal.close()
+        # A line cut short by the crash
+        with open(self.path, 'a') as f:
+            f.write('{"op": "creating", "vol')
+
+        resumed = self.journal(resume=True)
+        assert resumed.resumed and resumed.run_id == journal.run_id
+        assert resumed.created_snapshot('vol-1') == 'snap-1'
+        assert resumed.created_snapshot('vol-2') is None
+        assert [e['volume'] for e in resumed.in_flight_creates()] == ['vol-2']
+        assert resumed.in_flight_deletes() == ['snap-old']
+        assert resumed.is_deleted('snap-older')
+        assert resumed.untagged() == [('snap-1', {'BackupMonkey': 'BACKUP_MONKEY'})]
+        resumed.tagged(['snap-1'])
+        assert resumed.untagged() == []
+        resumed.close()
+
+        # Without --resume the unfinished run is left behind
+        fresh = self.journal()
+        assert not fresh.resumed and fresh.run_id != journal.run_id
+        assert fresh.created_snapshot('vol-1') is None
+        fresh.close()
+
+    def test_complete_compacts(self):
+        journal = self.journal()
+        journal.created(record('snap-1', 'vol-1'), tagged=True)
+        journal.deleted('snap-old')
+        summary = journal.complete()
+        journal.close()
+        assert self.lines() == [summary]
+        assert summary['created'] == 1 and summary['deleted'] == 1 and summary['entries'] == 3
+        # A completed run is not resumed
+        assert not self.journal(resume=True).resumed
+
+    def test_sync_batches(self):
+        journal = RunJournal(self.path, sync_every=3, sync_interval=3600, clock=lambda: NOW)
+        with mock.patch('os.fsync') as fsync:
+            for i in range(7):
+                journal.deleted('snap-%d' % i)
+            assert fsync.call_count == 2
+            journal.close()
+            assert fsync.call_count == 3
+
+class MockVolume(object):
+    def __init__(self, id):
+        self.id = id
+        self.attach_data = mock.Mock(instance_id=None, device=None)
+        self.tags = {}
+
+class MockSnapshot(object):
+    def __init__(self, record, tags=None):
+        for field in SnapshotRecord._fields:
+            setattr(self, field, getattr(record, field))
+        self.tags = tags or {}
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.calls = []
+        # vol-2's create went through before the crash, but was never tagged
+        self.snapshots = [MockSnapshot(record('snap-2', 'vol-2')),
+            MockSnapshot(record('snap-stale', 'vol-3')._replace(start_time='2014-12-01T00:00:00.000Z'))]
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.calls.append((action, params))
+        values = [v for k, v in params.items() if k.startswith('Filter.') and '.Value.' in k]
+        if params.get('Filter.1.Name') == 'snapshot-id' or params.get('Filter.2.Name') == 'snapshot-id':
+            return MockResultSet(s for s in self.snapshots if s.id in values)
+        return MockResultSet(s for s in self.snapshots if s.volume_id in values)
+
+    def get_object(self, action, params, cls, verb='GET'):
+        self.calls.append((action, params))
+        return MockSnapshot(record('snap-%s' % params['VolumeId'][4:], params['VolumeId']))
+
+    def create_tags(self, resource_ids, tags):
+        self.calls.append(('CreateTags', resource_ids))
+
+    def delete_snapshot(self, snapshot_id):
+        self.calls.append(('DeleteSnapshot', snapshot_id))
+
+class ResumeTest(JournalTestCase):
+
+    def setUp(self):
+        super(ResumeTest, self).setUp()
+        journal = self.journal()
+        journal.creating('vol-1', 'BACKUP_MONKEY vol-1', {})
+        journal.created(record('snap-1', 'vol-1'), tagged=True)
+        for volume_id in ('vol-2', 'vol-3'):
+            journal.creating(volume_id, 'BACKUP_MONKEY %s' % volume_id, {'BackupMonkey': 'BACKUP_MONKEY'})
+        journal.plan_deletes([record('snap-old-%d' % i, 'vol-1')._replace(status='completed') for i in range(3)])
+        journal.deleted('snap-old-0')
+        journal.deleting('snap-old-1')
+        journal.close()
+        self.journal_run = journal.run_id
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def monkey(self, mock):
+        return BackupMonkey('us-west-2', 3, [], False, None, None, 0, journal=self.journal(resume=True))
+
+    def test_resume_skips_journaled_work(self):
+        monkey = self.monkey()
+        conn = monkey._conn._conn
+        volumes = [MockVolume('vol-%d' % i) for i in range(1, 5)]
+        with mock.patch.object(monkey, 'iter_volumes_to_snapshot', return_value=iter(volumes)):
+            monkey.snapshot_volumes()
+        calls = [(action, params.get('VolumeId') if isinstance(params, dict) else params) for action, params in conn.calls]
+        # One describe for the in-flight creates, one for the in-flight delete
+        assert calls == [('DescribeSnapshots', None), ('DescribeSnapshots', None), ('CreateTags', ['snap-2']),
+            ('CreateSnapshot', 'vol-3'), ('CreateSnapshot', 'vol-4')]
+        assert sorted(r.id for r in monkey._created) == ['snap-1', 'snap-2', 'snap-3', 'snap-4']
+
+        del conn.calls[:]
+        with mock.patch.object(monkey, 'iter_backup_snapshots') as listing:
+            monkey.remove_old_snapshots()
+        assert not listing.called
+        # snap-old-1 was in flight and is gone now, snap-old-0 was deleted before
+        assert conn.calls == [('DeleteSnapshot', 'snap-old-2')]
+
+        summary = monkey.complete_journal()
+        monkey._journal.close()
+        assert summary['run'] == self.journal_run
+        assert summary['created'] == 4 and summary['deleted'] == 3
+        assert self.lines() == [summary]
@@ -0,0 +1,102 @@
+from unittest import TestCase
+import json, os, shutil, tempfile
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.core import BackupMonkey
+from backup_monkey.metrics import Histogram, InstrumentedConnection, Metrics, operation_name, timed_iter
+
+class MockEC2Connection(object):
+    region = 'us-east-1'
+
+    def get_list(self, action, params, markers, verb='GET'):
+        return []
+
+    def delete_snapshot(self, snapshot_id):
+        e = BotoServerError(400, 'Bad Request')
+        e.error_code = 'RequestLimitExceeded'
+        raise e
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.conn = InstrumentedConnection(MockEC2Connection(), self.metrics, 'us-east-1')
+
+    def test_operation_name(self):
+        assert operation_name('delete_snapshot') == 'DeleteSnapshot'
+        assert operation_name('_create_snapshot') == 'CreateSnapshot'
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [0.01] * 90 + [0.7] * 9 + [40]:
+            histogram.observe(value)
+        assert histogram.quantile(0.5) == 0.025
+        assert histogram.quantile(0.95) == 1.0
+        assert histogram.quantile(1) == 40
+        assert list(histogram.cumulative())[-1] == (float('inf'), 100)
+
+    def test_instrumented_connection(self):
+        self.conn.get_list('DescribeSnapshots', {}, [])
+        self.conn.get_list('DescribeSnapshots', {}, [])
+        self.assertRaises(BotoServerError, self.conn.delete_snapshot, 'snap-1')
+        assert self.conn.region == 'us-east-1'
+        operations = dict((o['operation'], o) for o in self.metrics.to_dict()['operations'])
+        assert operations['DescribeSnapshots']['calls'] == 2
+        assert operations['DeleteSnapshot']['errors'] == {'RequestLimitExceeded': 1}
+        assert operations['DeleteSnapshot']['throttles'] == 1
+
+    def test_phases(self):
+        with self.metrics.phase('snapshot', 'us-east-1'):
+            pass
+        assert list(timed_iter([1, 2], self.metrics, 'discovery', 'us-east-1')) == [1, 2]
+        phases = [p['phase'] for p in self.metrics.to_dict()['phases']]
+        assert phases == ['discovery', 'snapshot']
+        assert '# TYPE backup_monkey_phase_seconds_total counter' in self.metrics.to_prometheus()
+
+    def test_export(self):
+        self.conn.get_list('DescribeVolumes', {}, [])
+        self.metrics.add_retry_sleep('DescribeVolumes', 'us-east-1', 1.5)
+        path = tempfile.mkdtemp()
+        try:
+            self.metrics.write_prometheus(os.path.join(path, 'metrics.prom'))
+            self.metrics.write_json(os.path.join(path, 'metrics.json'))
+            with open(os.path.join(path, 'metrics.prom')) as f:
+                prom = f.read()
+            with open(os.path.join(path, 'metrics.json')) as f:
+                summary = json.load(f)
+            assert sorted(os.listdir(path)) == ['metrics.json', 'metrics.prom']
+        finally:
+            shutil.rmtree(path)
+        assert 'backup_monkey_api_calls_total{operation="DescribeVolumes",region="us-east-1"} 1\n' in prom
+        assert 'backup_monkey_api_latency_seconds_bucket{operation="DescribeVolumes",region="us-east-1",le="+Inf"} 1\n' in prom
+        assert 'backup_monkey_api_retry_sleep_seconds_total{operation="DescribeVolumes",region="us-east-1"} 1.5\n' in prom
+        assert summary['operations'][0]['retry_sleep_seconds'] == 1.5
+
+class ThrottledOnce(object):
+    region = 'us-east-1'
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.calls += 1
+        if self.calls == 1:
+            e = BotoServerError(400, 'Bad Request')
+            e.error_code = 'RequestLimitExceeded'
+            raise e
+        return []
+
+class RetryMetricsTest(TestCase):
+
+    def test_retry_sleep_is_recorded_under_the_action(self):
+        metrics = Metrics()
+        with mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=ThrottledOnce):
+            monkey = BackupMonkey('us-east-1', 3, [], False, None, None, 0, metrics=metrics)
+        monkey._retry_policy.delay = lambda attempt: 0.01
+        def describe():
+            return monkey._conn.get_list('DescribeSnapshots', {}, [])
+        assert monkey._retryInCaseOfException(describe, action='DescribeSnapshots', category='snapshots') == []
+        # The helper's name is not an operation, the action it calls is
+        operations = dict((o['operation'], o) for o in metrics.to_dict()['operations'])
+        assert sorted(operations) == ['DescribeSnapshots']
+        assert operations['DescribeSnapshots']['retry_sleep_seconds'] == 0.01
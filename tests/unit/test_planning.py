@@ -0,0 +1,87 @@
+from unittest import TestCase
+import os, shutil, tempfile
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.planning import read_plan, tag_batches, write_plan
+
+class MockAttachData(object):
+    instance_id = 'i-1'
+    device = '/dev/sdf'
+
+class MockVolume(object):
+    def __init__(self, id, tags):
+        self.id = id
+        self.tags = tags
+        self.attach_data = MockAttachData()
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id, start_time):
+        self.id = id
+        self.volume_id = volume_id
+        self.start_time = start_time
+        self.description = 'BACKUP_MONKEY %s' % volume_id
+        self.status = 'completed'
+        self.tags = {}
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.created = []
+        self.deleted = []
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if action == 'DescribeVolumes':
+            return MockResultSet([MockVolume('vol-1', {'Name': 'foo', 'aws:x': 'y'}), MockVolume('vol-2', {})])
+        return MockResultSet([MockSnapshot('snap-%d' % d, 'vol-1', '2015-01-%02dT00:00:00.000Z' % d) for d in range(1, 6)])
+
+    def get_object(self, action, params, cls, verb='GET'):
+        self.created.append(params)
+        return MockSnapshot('snap-new', params['VolumeId'], '2015-02-01T00:00:00.000Z')
+
+    def delete_snapshot(self, snapshot_id):
+        self.deleted.append(snapshot_id)
+
+class PlanningTest(TestCase):
+
+    def setUp(self):
+        self.conn = MockEC2Connection()
+        with mock.patch('backup_monkey.core.BackupMonkey.get_connection', return_value=self.conn):
+            self.backup_monkey = BackupMonkey('us-west-2', 3, [], None, None, None, 0, workers=2)
+        self.backup_monkey._connection = self.conn
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_plan_makes_no_changes(self):
+        plan = self.backup_monkey.plan()
+        assert self.conn.created == [] and self.conn.deleted == []
+        assert [c['volume_id'] for c in plan['creates']] == ['vol-1', 'vol-2']
+        assert plan['creates'][0]['description'] == 'BACKUP_MONKEY vol-1 i-1 /dev/sdf'
+        assert plan['creates'][0]['tags'] == {'Name': 'foo', 'BackupMonkey': 'BACKUP_MONKEY'}
+        assert sorted(d['snapshot_id'] for d in plan['deletes']) == ['snap-1', 'snap-2']
+        assert plan['keeps'] == 3
+        assert plan['api_calls'] == {'DescribeVolumes': 1, 'DescribeSnapshots': 1, 'CreateSnapshot': 2, 'DeleteSnapshot': 2}
+        assert plan['fallback_api_calls'] == {'CreateTags': 2}
+
+    def test_apply_saved_plan(self):
+        path = os.path.join(self.dir, 'plan.json')
+        write_plan(path, [self.backup_monkey.plan()])
+        plan = read_plan(path)
+        assert plan['api_calls']['CreateSnapshot'] == 2
+        self.backup_monkey.apply(plan['jobs'][0])
+        assert sorted(p['VolumeId'] for p in self.conn.created) == ['vol-1', 'vol-2']
+        assert self.conn.created[0]['TagSpecification.1.ResourceType'] == 'snapshot'
+        assert sorted(self.conn.deleted) == ['snap-1', 'snap-2']
+
+    def test_read_plan_rejects_other_files(self):
+        path = os.path.join(self.dir, 'plan.json')
+        with open(path, 'w') as f:
+            f.write('{"jobs": []}')
+        self.assertRaises(ValueError, read_plan, path)
+
+    def test_tag_batches(self):
+        creates = [{'tags': {'Name': 'a'}}] * 501 + [{'tags': {'Name': 'b'}}, {'tags': {}}]
+        assert tag_batches(creates) == 3
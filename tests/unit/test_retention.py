@@ -0,0 +1,91 @@
+from unittest import TestCase
+import calendar, datetime, random
+from backup_monkey.retention import RetentionPolicy, parse_age, parse_timestamp, plan
+
+NOW = calendar.timegm((2015, 6, 30, 12, 0, 0, 0, 0, 0))
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id, days_ago, tags=None):
+        self.id = id
+        self.volume_id = volume_id
+        start = datetime.datetime.utcfromtimestamp(NOW) - datetime.timedelta(days=days_ago)
+        self.start_time = start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self.tags = tags or {}
+
+def daily_snapshots(volume_id, days, tags=None):
+    return [MockSnapshot('snap-%s-%03d' % (volume_id, d), volume_id, d, tags) for d in range(days)]
+
+def ids(snapshots):
+    return sorted(s.id for s in snapshots)
+
+class RetentionTest(TestCase):
+
+    def test_parse(self):
+        policy = RetentionPolicy.parse('7d4w12m1y')
+        assert (policy.keep_last, policy.daily, policy.weekly, policy.monthly, policy.yearly) == (0, 7, 4, 12, 1)
+        assert RetentionPolicy.parse('30').keep_last == 30
+        self.assertRaises(ValueError, RetentionPolicy.parse, '7x')
+        self.assertRaises(ValueError, RetentionPolicy.parse, '')
+        self.assertRaises(ValueError, RetentionPolicy)
+
+    def test_parse_age(self):
+        assert parse_age('2d') == 2 * 86400
+        assert parse_age('36h') == 36 * 3600
+        self.assertRaises(ValueError, parse_age, 'soon')
+
+    def test_parse_timestamp(self):
+        assert parse_timestamp('1970-01-02T00:00:00.000Z') == 86400
+
+    def test_keep_last(self):
+        snapshots = daily_snapshots('vol-1', 20)
+        random.shuffle(snapshots)
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=3), now=NOW)
+        assert ids(keep) == ['snap-vol-1-000', 'snap-vol-1-001', 'snap-vol-1-002']
+        assert len(delete) == 17
+
+    def test_gfs(self):
+        snapshots = daily_snapshots('vol-1', 400)
+        keep, delete = plan(snapshots, RetentionPolicy.parse('7d4w12m'), now=NOW)
+        kept_days = set(int(s.id[-3:]) for s in keep)
+        # the last 7 days are all kept
+        assert set(range(7)) <= kept_days
+        # one per week and month on top of that, never more than the policy allows
+        assert len(keep) <= 7 + 4 + 12
+        assert len(keep) + len(delete) == 400
+        # the newest snapshot of June (the current month) is today's
+        assert 0 in kept_days
+
+    def test_max_age(self):
+        snapshots = daily_snapshots('vol-1', 30)
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=30, max_age=parse_age('10d')), now=NOW)
+        assert len(keep) == 11
+        assert len(delete) == 19
+
+    def test_volumes_are_independent(self):
+        snapshots = daily_snapshots('vol-1', 10) + daily_snapshots('vol-2', 10)
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=2), now=NOW)
+        assert ids(keep) == ['snap-vol-1-000', 'snap-vol-1-001', 'snap-vol-2-000', 'snap-vol-2-001']
+
+    def test_tag_override(self):
+        snapshots = daily_snapshots('vol-1', 10, {'BackupMonkeyRetention': '5'}) + daily_snapshots('vol-2', 10)
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=2), now=NOW)
+        assert len([s for s in keep if s.volume_id == 'vol-1']) == 5
+        assert len([s for s in keep if s.volume_id == 'vol-2']) == 2
+
+    def test_tag_override_ends_with_newest_snapshot(self):
+        # The tag was taken off the volume before its two newest snapshots
+        snapshots = daily_snapshots('vol-1', 10, {'BackupMonkeyRetention': '5'})
+        for snapshot in snapshots[:2]:
+            snapshot.tags = {}
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=2), now=NOW)
+        assert ids(keep) == ['snap-vol-1-000', 'snap-vol-1-001']
+
+    def test_keep_none(self):
+        keep, delete = plan(daily_snapshots('vol-1', 3), RetentionPolicy(keep_last=0, keep_none=True), now=NOW)
+        assert keep == [] and len(delete) == 3
+        assert str(RetentionPolicy(keep_none=True)) == 'none'
+
+    def test_invalid_tag_override_is_ignored(self):
+        snapshots = daily_snapshots('vol-1', 10, {'BackupMonkeyRetention': 'forever'})
+        keep, delete = plan(snapshots, RetentionPolicy(keep_last=2), now=NOW)
+        assert len(keep) == 2
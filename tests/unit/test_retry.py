@@ -0,0 +1,49 @@
+from unittest import TestCase
+from boto.exception import BotoServerError
+from backup_monkey.retry import *
+
+def error(code, status=400):
+    e = BotoServerError(status, 'reason')
+    e.error_code = code
+    return e
+
+class RetryTest(TestCase):
+
+    def test_classify(self):
+        assert classify(error('RequestLimitExceeded')) == THROTTLE
+        assert classify(error('InternalError')) == TRANSIENT
+        assert classify(error(None, 503)) == TRANSIENT
+        assert classify(error('InvalidSnapshot.NotFound')) == PERMANENT
+        assert classify(error('SnapshotLimitExceeded')) == PERMANENT
+
+    def test_delay_bounds(self):
+        policy = RetryPolicy(base_delay=1.0, max_delay=10.0)
+        for attempt in range(1, 10):
+            for i in range(20):
+                assert 0 <= policy.delay(attempt) <= min(10.0, 2 ** (attempt - 1))
+
+    def test_should_retry(self):
+        policy = RetryPolicy(max_attempts=3)
+        assert policy.should_retry(THROTTLE, 1)
+        assert policy.should_retry(TRANSIENT, 2)
+        assert not policy.should_retry(TRANSIENT, 3)
+        assert not policy.should_retry(PERMANENT, 1)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget=RetryBudget(2))
+        assert policy.should_retry(THROTTLE, 1)
+        assert policy.should_retry(THROTTLE, 1)
+        assert not policy.should_retry(THROTTLE, 1)
+
+    def test_adaptive_limiter(self):
+        limiter = AdaptiveLimiter(8)
+        assert limiter.limit == 8
+        limiter.on_throttle()
+        assert limiter.limit == 4
+        limiter.on_throttle()
+        limiter.on_throttle()
+        limiter.on_throttle()
+        assert limiter.limit == 1
+        for i in range(100):
+            limiter.on_success()
+        assert limiter.limit == 8
@@ -0,0 +1,135 @@
+from unittest import TestCase
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.selection import Selection, parse, from_tags
+
+class MockVolume(object):
+    def __init__(self, id, tags):
+        self.id = id
+        self.tags = tags
+
+volumes = [
+    MockVolume('vol-1', {'env': 'prod', 'team': 'db-core', 'Name': 'a'}),
+    MockVolume('vol-2', {'env': 'prod', 'team': 'web', 'Backup': 'yes'}),
+    MockVolume('vol-3', {'env': 'dev', 'team': 'db-core', 'Name': 'c'}),
+    MockVolume('vol-4', {'env': 'prod', 'team': 'db-edge', 'NoBackup': '', 'Name': 'd'}),
+    MockVolume('vol-5', {}),
+    MockVolume('vol-6', {'env': 'prod', 'team': 'a*b', 'Name': 'f'}),
+]
+
+def ids(vols):
+    return [v.id for v in vols]
+
+def selected(expression, tags=None, reverse_tags=False):
+    ''' Evaluates every part of the selection locally, nothing pushed down '''
+    match = Selection.compile(expression, tags, reverse_tags).node.matcher()
+    return [v.id for v in volumes if match(v.tags)]
+
+class SelectionTest(TestCase):
+
+    def test_operators(self):
+        assert selected('env=prod') == ['vol-1', 'vol-2', 'vol-4', 'vol-6']
+        assert selected('env=prod AND team=web') == ['vol-2']
+        assert selected('env=prod team=web') == ['vol-2']
+        assert selected('team=web OR env=dev') == ['vol-2', 'vol-3']
+        assert selected('NOT env=prod') == ['vol-3', 'vol-5']
+        assert selected('env!=prod') == ['vol-3', 'vol-5']
+        assert selected('env=prod AND (team=web OR has:NoBackup)') == ['vol-2', 'vol-4']
+        assert selected('env=prod AND NOT (team=web OR has:NoBackup)') == ['vol-1', 'vol-6']
+        assert selected('') == ids(volumes)
+
+    def test_precedence(self):
+        # AND binds tighter than OR
+        assert selected('env=dev OR env=prod AND team=web') == ['vol-2', 'vol-3']
+
+    def test_wildcards(self):
+        assert selected('team=db*') == ['vol-1', 'vol-3', 'vol-4']
+        assert selected('team=db-?dg?') == ['vol-4']
+        assert selected('team=web,db-c*') == ['vol-1', 'vol-2', 'vol-3']
+        assert selected(r'team="a\*b"') == ['vol-6']
+
+    def test_has_and_missing(self):
+        assert selected('has:Backup') == ['vol-2']
+        assert selected('missing:Name') == ['vol-2', 'vol-5']
+        assert selected('has:"NoBackup"') == ['vol-4']
+        assert selected('"has:Name"=x') == []
+
+    def test_invalid(self):
+        for expression in ('env=', 'env=prod AND', '(env=prod', 'env prod', 'env=prod)', 'NOT'):
+            self.assertRaises(ValueError, parse, expression)
+
+    def test_round_trip(self):
+        for expression in ('env=prod AND (team=db* OR has:Backup) AND missing:NoBackup',
+                           'NOT (env=dev OR env=test) AND "my key"!="a b",c'):
+            node = Selection(parse(expression)).node
+            assert Selection(parse(str(node))).node == node
+
+    def test_push_down(self):
+        selection = Selection.compile('env=prod AND (team=db* OR team=web) AND has:Name AND NOT has:NoBackup')
+        assert selection.filters == {'tag:env': ['prod'], 'tag:team': ['db*', 'web'], 'tag-key': ['Name']}
+        assert str(selection.residual) == 'missing:NoBackup'
+
+    def test_push_down_everything(self):
+        selection = Selection.compile('env=prod AND (has:Backup OR has:Snapshot)')
+        assert selection.filters == {'tag:env': ['prod'], 'tag-key': ['Backup', 'Snapshot']}
+        assert selection.residual is None
+
+    def test_same_key_twice(self):
+        selection = Selection.compile('team=db* AND team=*core')
+        assert selection.filters == {'tag:team': ['db*']}
+        assert ids(selection.select(volumes)) == ['vol-1', 'vol-3']
+
+    def test_select_remembers_decisions(self):
+        selection = Selection.compile('NOT team=db* AND has:Name')
+        assert selection.filters == {'tag-key': ['Name']}
+        with mock.patch.object(selection, '_match', wraps=selection._match) as match:
+            # has:Name is left to EC2
+            assert ids(selection.select(iter(volumes + volumes))) == ['vol-2', 'vol-5', 'vol-6'] * 2
+        # vol-1 and vol-3 share a team, and the second pass is all lookups
+        assert match.call_count == 5
+
+    def test_old_tags(self):
+        assert Selection(from_tags(['name:foo'])).node == parse('name=foo')
+        assert Selection(from_tags(["name:['bar','baz']"])).node == parse('name=bar,baz')
+        assert Selection.compile(None, ['team:db-core', 'env:prod']).filters == {'tag:team': ['db-core'], 'tag:env': ['prod']}
+        assert selected(None, ['team:web', 'env:dev'], reverse_tags=True) == ['vol-1', 'vol-4', 'vol-5', 'vol-6']
+        # The blacklist matches values exactly, as it always has
+        assert selected(None, ['team:db*'], reverse_tags=True) == ids(volumes)
+        self.assertRaises(ValueError, from_tags, ['name'])
+
+    def test_tags_and_select(self):
+        assert selected('team=db*', ['env:prod']) == ['vol-1', 'vol-4']
+
+class MockResultSet(list):
+    next_token = None
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.filters = []
+
+    def get_list(self, action, params, markers, verb='GET'):
+        filters = dict((v, params[k[:-len('Name')] + 'Value.1']) for k, v in params.items() if k.endswith('.Name'))
+        self.filters.append(filters)
+        return MockResultSet(v for v in volumes if v.tags.get('env') == filters.get('tag:env', v.tags.get('env')))
+
+class BackupMonkeySelectionTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey.get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0,
+            select='env=prod AND NOT has:NoBackup')
+
+    def test_volumes_to_snapshot(self):
+        assert ids(self.backup_monkey.get_volumes_to_snapshot()) == ['vol-1', 'vol-2', 'vol-6']
+        assert self.backup_monkey._conn.filters == [{'tag:env': 'prod'}]
+
+    def test_compiled_once(self):
+        with mock.patch('backup_monkey.core.Selection.compile', wraps=Selection.compile) as compile:
+            self.backup_monkey.get_volumes_to_snapshot()
+            self.backup_monkey.get_volumes_to_snapshot()
+        assert compile.call_count == 1
+
+    def test_invalid(self):
+        self.backup_monkey._select = 'env=prod AND ('
+        self.assertRaises(BackupMonkeyException, self.backup_monkey.get_volumes_to_snapshot)
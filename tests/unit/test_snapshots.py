@@ -0,0 +1,78 @@
+from unittest import TestCase
+import mock
+from backup_monkey.core import BackupMonkey
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id, start_time, description='BACKUP_MONKEY', status='completed'):
+        self.id = id
+        self.volume_id = volume_id
+        self.start_time = start_time
+        self.description = description
+        self.status = status
+        self.tags = {}
+
+class MockVolume(object):
+    def __init__(self, id, tags={}):
+        self.id = id
+        self.tags = tags
+
+class MockResultSet(list):
+    next_token = None
+
+def params_to_filters(params):
+    filters = {}
+    for k, v in params.items():
+        if k.startswith('Filter.') and k.endswith('.Name'):
+            prefix = k[:-len('Name')]
+            keys = [p for p in params if p.startswith(prefix + 'Value.')]
+            values = [params[p] for p in sorted(keys, key=lambda p: int(p.split('.')[-1]))]
+            filters[v] = values[0] if len(values) == 1 else values
+    return filters
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.snapshot_filters = []
+        self.volumes = [MockVolume('vol-%04d' % i, {'name': 'foo'}) for i in range(450)]
+        self.pages = 1
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if action == 'DescribeVolumes':
+            return MockResultSet(self.volumes)
+        assert params['Owner.1'] == 'self'
+        page = int(params.get('NextToken', 0))
+        self.snapshot_filters.append(params_to_filters(params))
+        ret = MockResultSet([MockSnapshot('snap-%d' % page, 'vol-0000', '2015-01-01T00:00:00.000Z')])
+        if page + 1 < self.pages:
+            ret.next_token = str(page + 1)
+        return ret
+
+class SnapshotsTest(TestCase):
+
+    def setUp(self):
+        self.conn = MockEC2Connection()
+        with mock.patch('backup_monkey.core.BackupMonkey.get_connection', return_value=self.conn):
+            self.backup_monkey = BackupMonkey('us-west-2', 3, [], None, None, None, 0)
+        self.backup_monkey._connection = self.conn
+
+    def test_server_side_filters(self):
+        snapshots = self.backup_monkey.get_backup_snapshots()
+        assert len(snapshots) == 1
+        assert self.conn.snapshot_filters == [{'description': 'BACKUP_MONKEY*', 'status': 'completed'}]
+
+    def test_marker_tag_filter(self):
+        self.backup_monkey._require_marker_tag = True
+        self.backup_monkey.get_backup_snapshots()
+        assert self.conn.snapshot_filters[0]['tag:BackupMonkey'] == 'BACKUP_MONKEY'
+
+    def test_volume_id_filters(self):
+        self.backup_monkey._tags = ['name:foo']
+        snapshots = self.backup_monkey.get_backup_snapshots()
+        assert len(self.conn.snapshot_filters) == 3
+        assert [len(f['volume-id']) for f in self.conn.snapshot_filters] == [200, 200, 50]
+        assert len(snapshots) == 3
+
+    def test_pagination(self):
+        self.conn.pages = 4
+        snapshots = list(self.backup_monkey.iter_backup_snapshots())
+        assert [s.id for s in snapshots] == ['snap-0', 'snap-1', 'snap-2', 'snap-3']
+        assert len(self.conn.snapshot_filters) == 4
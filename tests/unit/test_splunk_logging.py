@@ -1,11 +1,12 @@
 from unittest import TestCase
-import tempfile, os
+import json, tempfile, os, threading
 from backup_monkey import SplunkLogging
+from backup_monkey.status import BackupMonkeyStatus as _status
 
 class SplunkLoggingTest(TestCase):
   parsed = None
   values = {}
-  keys = ['body', 'severity', 'src_account', 'src_role', 'src_region', 'src_volume', 'src_snapshot', 'src_tags', 'subject', 'type', 'category']
+  keys = ['body', 'severity', 'src_account', 'src_role', 'src_region', 'src_volume', 'src_snapshot', 'src_instance', 'src_tags', 'subject', 'type', 'category']
   log_file = tempfile.mkstemp()[1]
 
   @classmethod
@@ -13,6 +14,7 @@ class SplunkLoggingTest(TestCase):
     values = dict([(k, k) for k in cls.keys])
     SplunkLogging.set_path(cls.log_file)
     SplunkLogging.write(**values)
+    SplunkLogging.flush()
 
     with open(cls.log_file) as f:
       for line in f:
@@ -32,6 +34,7 @@ class SplunkLoggingTest(TestCase):
 
   def test_no_line_breaks(self):
     SplunkLogging.write(subject='subject\r\n', body='body\ngoes\rhere')
+    SplunkLogging.flush()
     with open(self.log_file) as f:
       for line in f:
         parsed = dict((k.split(' ')[-1], v) for k,v in [tuple(kv.split('=')) for kv in line.split(',')])
@@ -39,6 +42,74 @@ class SplunkLoggingTest(TestCase):
     assert parsed['subject'] == 'subject'
     assert parsed['body'] == 'body goes here'
 
+  def test_drop_when_full(self):
+    open(self.log_file, 'w').close()
+    SplunkLogging.configure(queue_size=2)
+    try:
+      # Hold up the writer so the queue fills
+      with SplunkLogging._write_lock:
+        for i in range(5):
+          SplunkLogging.write(subject='event %d' % i, type='event')
+      SplunkLogging.flush()
+    finally:
+      SplunkLogging.configure(queue_size=10000)
+    with open(self.log_file) as f:
+      lines = f.readlines()
+    assert len(lines) == 3
+    assert 'subject=event 0' in lines[0]
+    assert 'Dropped `3` events' in lines[2]
+
+  def test_threads(self):
+    open(self.log_file, 'w').close()
+    def write(n):
+      for i in range(200):
+        SplunkLogging.write(subject='thread %d event %d' % (n, i))
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    SplunkLogging.flush()
+    with open(self.log_file) as f:
+      lines = f.readlines()
+    assert len(lines) == 800
+    assert all(len(line.split(',')) == len(SplunkLogging.keys) for line in lines)
+
+  def test_rotation(self):
+    open(self.log_file, 'w').close()
+    SplunkLogging.configure(max_bytes=1000, batch_size=1)
+    try:
+      for i in range(20):
+        SplunkLogging.write(subject='event %d' % i)
+        SplunkLogging.flush()
+    finally:
+      SplunkLogging.configure(max_bytes=100 * 1024 * 1024, batch_size=500)
+    assert os.path.getsize(self.log_file) <= 1000
+    assert os.path.exists(self.log_file + '.1')
+    assert os.path.exists(self.log_file + '.2')
+    for i in range(1, 6):
+      if os.path.exists('%s.%d' % (self.log_file, i)):
+        os.remove('%s.%d' % (self.log_file, i))
+
+  def test_json_format(self):
+    open(self.log_file, 'w').close()
+    SplunkLogging.set_format('json')
+    try:
+      SplunkLogging.write(subject=_status.event('region_connect', 'us-east-1'), body='a\nb', type='event', src_instance='i-1')
+      SplunkLogging.flush()
+    finally:
+      SplunkLogging.set_format('kv')
+    with open(self.log_file) as f:
+      event = json.loads(f.readline())
+    open(self.log_file, 'w').close()
+    assert event['subject'] == 'Connecting to `us-east-1` region'
+    assert event['body'] == 'a\nb'
+    assert event['type'] == 'event'
+    assert event['src_instance'] == 'i-1'
+    assert event['severity'] == 'unknown'
+    assert 'time' in event
+    self.assertRaises(ValueError, SplunkLogging.set_format, 'xml')
+
   @classmethod
   def tearDownClass(cls):
     os.remove(cls.log_file)
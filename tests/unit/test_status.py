@@ -0,0 +1,31 @@
+from unittest import TestCase
+from backup_monkey.status import BackupMonkeyStatus as _status
+
+class StatusTest(TestCase):
+
+    def test_parse_status(self):
+        assert _status.parse_status('region_connect', 'us-east-1') == 'Connecting to `us-east-1` region'
+        assert _status.parse_status('snapshot_create_success', ('snap-1', 'vol-1')) == \
+            'Successfully created snapshot `snap-1` from volume `vol-1`'
+        assert _status.parse_status('cross_account_error') == 'Cannot complete cross account connection'
+
+    def test_quotes_are_kept(self):
+        assert _status.parse_status('snapshot_delete', ('snap-1', 'it\'s "quoted"')) == \
+            'Deleting snapshot `snap-1` with a description of `it\'s "quoted"`'
+
+    def test_event_is_lazy(self):
+        class Arg(object):
+            calls = 0
+            def __str__(self):
+                Arg.calls += 1
+                return 'vol-1'
+        event = _status.event('snapshot_create_error', Arg())
+        assert Arg.calls == 0
+        assert str(event) == 'Cannot create snapshot of volume `vol-1`'
+        assert str(event) == 'Cannot create snapshot of volume `vol-1`'
+        assert Arg.calls == 1
+
+    def test_tags(self):
+        tags = _status.tags({'Name': 'foo', 'aws:cloudformation:stack-name': 'bar'}, skip_reserved=True)
+        assert str(tags) == 'Name:foo'
+        assert str(_status.tags({})) == ''
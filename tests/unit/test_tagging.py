@@ -0,0 +1,88 @@
+from unittest import TestCase
+import threading
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.core import BackupMonkey
+from backup_monkey.tagging import TagBatcher, tag_specification_params
+
+class TaggingTest(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.batcher = TagBatcher(lambda ids, tags: self.calls.append((sorted(ids), tags)), batch_size=3)
+
+    def test_identical_tags_are_coalesced(self):
+        for i in range(5):
+            self.batcher.add('snap-%d' % i, {'env': 'prod'})
+        self.batcher.add('snap-5', {'env': 'dev'})
+        assert self.calls == [(['snap-0', 'snap-1', 'snap-2'], {'env': 'prod'})]
+        self.batcher.flush()
+        assert len(self.calls) == 3
+        assert (['snap-3', 'snap-4'], {'env': 'prod'}) in self.calls
+        assert (['snap-5'], {'env': 'dev'}) in self.calls
+        assert self.batcher.calls == 3
+        assert self.batcher.tagged == 6
+
+    def test_empty_tags_are_skipped(self):
+        self.batcher.add('snap-0', {})
+        self.batcher.flush()
+        assert self.calls == []
+
+    def test_tag_specification_params(self):
+        params = tag_specification_params({'VolumeId': 'vol-1'}, {'b': '2', 'a': '1'})
+        assert params == {
+            'VolumeId': 'vol-1',
+            'TagSpecification.1.ResourceType': 'snapshot',
+            'TagSpecification.1.Tag.1.Key': 'a',
+            'TagSpecification.1.Tag.1.Value': '1',
+            'TagSpecification.1.Tag.2.Key': 'b',
+            'TagSpecification.1.Tag.2.Value': '2',
+        }
+
+class MockSnapshot(object):
+    def __init__(self, id):
+        self.id = id
+        self.status = 'pending'
+        self.start_time = '2015-01-01T00:00:00.000Z'
+
+class MockVolume(object):
+    def __init__(self, id):
+        self.id = id
+        self.attach_data = mock.Mock(instance_id=None, device=None)
+        self.tags = {'env': 'prod'}
+
+class NoTagOnCreateConnection(object):
+    ''' An endpoint that does not support TagSpecification '''
+    def __init__(self):
+        self.tagged = []
+
+    def get_object(self, action, params, cls, verb='GET'):
+        if any(k.startswith('TagSpecification.') for k in params):
+            e = BotoServerError(400, 'Bad Request', 'Unknown parameter')
+            e.error_code = 'UnknownParameter'
+            raise e
+        return MockSnapshot('snap-%s' % params['VolumeId'])
+
+    def create_tags(self, resource_ids, tags):
+        self.tagged.append(sorted(resource_ids))
+
+class TagFallbackTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=NoTagOnCreateConnection)
+    def setUp(self, mock):
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, workers=1)
+        self.backup_monkey._tag_batcher = TagBatcher(self.backup_monkey._create_tags, batch_size=3)
+        self.conn = self.backup_monkey._conn._conn
+
+    def test_full_batches_are_sent_with_one_worker(self):
+        volumes = [MockVolume('vol-%d' % i) for i in range(7)]
+        with mock.patch.object(self.backup_monkey, 'iter_volumes_to_snapshot', return_value=iter(volumes)):
+            # A full batch sent while the create still held the only limiter slot used to hang here
+            thread = threading.Thread(target=self.backup_monkey.snapshot_volumes)
+            thread.daemon = True
+            thread.start()
+            thread.join(10)
+        assert not thread.is_alive()
+        assert len(self.backup_monkey._created) == 7
+        assert sorted(sum(self.conn.tagged, [])) == sorted('snap-vol-%d' % i for i in range(7))
+        assert [len(ids) for ids in self.conn.tagged] == [3, 3, 1]
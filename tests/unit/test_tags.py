@@ -39,7 +39,19 @@ match_tag_multiple = MockVolume('vol-d59b7114', params_to_dict(tag_multiple))
 
 volumes = [a, match_tag, match_tag_or_1, b, match_tag_or_2, match_tag_multiple]
 
+def params_to_filters(params):
+    filters = {}
+    for k, v in params.items():
+        if k.startswith('Filter.') and k.endswith('.Name'):
+            prefix = k[:-len('Name')]
+            filters[v] = [params[p] for p in sorted(params) if p.startswith(prefix + 'Value.')]
+    return filters
+
 class MockEC2Connection(object):
+    def get_list(self, action, params, markers, verb='GET'):
+        assert action == 'DescribeVolumes'
+        return self.get_all_volumes(filters=params_to_filters(params))
+
     def get_all_volumes(self, filters=[]):
         if filters:
             if isinstance(filters['tag:name'], list):
@@ -0,0 +1,137 @@
+from unittest import TestCase
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exception import BackupMonkeyException
+from backup_monkey.inventory import Inventory, SnapshotRecord
+from backup_monkey.metrics import Metrics
+from backup_monkey.waiter import SnapshotWaiter
+
+class MockSnapshot(object):
+    def __init__(self, id, status, progress):
+        self.id = id
+        self.status = status
+        self.progress = progress
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class MockSnapshots(object):
+    ''' Snapshots that complete finish_at seconds after the clock's start, or end in another status '''
+    def __init__(self, clock, finish_at, end_status=None):
+        self.clock = clock
+        self.finish_at = finish_at
+        self.end_status = end_status or {}
+        self.calls = []
+
+    def describe(self, snapshot_ids):
+        self.calls.append(list(snapshot_ids))
+        elapsed = self.clock.now - 1000.0
+        snapshots = []
+        for i in snapshot_ids:
+            if i in self.end_status:
+                if self.end_status[i]:
+                    snapshots.append(MockSnapshot(i, self.end_status[i], '0%'))
+            elif elapsed >= self.finish_at[i]:
+                snapshots.append(MockSnapshot(i, 'completed', '100%'))
+            else:
+                snapshots.append(MockSnapshot(i, 'pending', '%d%%' % (100 * elapsed / self.finish_at[i])))
+        return snapshots
+
+class SnapshotWaiterTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def waiter(self, snapshots, **kwargs):
+        waiter = SnapshotWaiter(snapshots.describe, clock=self.clock, sleep=self.clock.sleep, **kwargs)
+        for i in sorted(snapshots.finish_at):
+            waiter.add(i, 'vol-%s' % i, 1000.0)
+        return waiter
+
+    def test_batches_and_latency(self):
+        snapshots = MockSnapshots(self.clock, dict(('snap-%03d' % i, 60 + i) for i in range(450)))
+        result = self.waiter(snapshots, max_interval=30).wait()
+        assert not result.failed and not result.pending
+        assert len(result.completed) == 450
+        assert [len(c) for c in snapshots.calls[:3]] == [200, 200, 50]
+        # Completions are seen within a poll interval of happening
+        assert 60 <= result.completed['snap-000'] <= 90
+        assert result.latency(1.0) >= 509
+
+    def test_backs_off_without_progress(self):
+        snapshots = MockSnapshots(self.clock, {'snap-1': 1000}, end_status={'snap-2': 'pending'})
+        snapshots.finish_at['snap-2'] = None
+        waiter = SnapshotWaiter(snapshots.describe, timeout=600, min_interval=10, max_interval=100,
+            clock=self.clock, sleep=self.clock.sleep)
+        waiter.add('snap-2', 'vol-2', 1000.0)
+        result = waiter.wait()
+        assert self.clock.sleeps[:5] == [10, 15.0, 22.5, 33.75, 50.625]
+        assert max(self.clock.sleeps) == 100
+        assert result.pending == ['snap-2']
+        assert result.elapsed == 600
+
+    def test_polls_sooner_when_nearly_done(self):
+        snapshots = MockSnapshots(self.clock, {'snap-1': 100})
+        self.waiter(snapshots, min_interval=10, max_interval=1000).wait()
+        # After 10s at 10%, the snapshot should finish 90s later
+        assert self.clock.sleeps[:2] == [10, 90.0]
+
+    def test_failed_and_missing(self):
+        snapshots = MockSnapshots(self.clock, {'snap-1': 30, 'snap-2': 30, 'snap-3': 30},
+            end_status={'snap-2': 'error', 'snap-3': None})
+        failed = []
+        result = self.waiter(snapshots, on_fail=lambda *args: failed.append(args)).wait()
+        assert result.completed.keys() == ['snap-1']
+        assert result.failed == {'snap-2': 'error', 'snap-3': 'missing'}
+        assert failed[0] == ('snap-2', 'vol-snap-2', 'error')
+        # A snapshot missing from the listing is given a few polls to appear
+        assert result.polls >= 3
+
+class MockEC2Connection(object):
+    def __init__(self):
+        self.status = {}
+
+    def get_list(self, action, params, markers, verb='GET'):
+        ids = [v for k, v in sorted(params.items()) if k.startswith('Filter.1.Value.')]
+        return [MockSnapshot(i, self.status[i], '100%') for i in ids]
+
+class WaitForSnapshotsTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        self.metrics = Metrics()
+        self.inventory = Inventory()
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, metrics=self.metrics,
+            inventory=self.inventory)
+        for i in ('snap-1', 'snap-2'):
+            record = SnapshotRecord(i, 'vol-' + i, '2015-01-01T00:00:00.000Z', 'pending', 'BACKUP_MONKEY', {'Name': i})
+            self.backup_monkey._created.append(record)
+            self.inventory.add_snapshot(record)
+        self.conn = self.backup_monkey._conn._conn
+
+    def test_completed(self):
+        self.conn.status = {'snap-1': 'completed', 'snap-2': 'completed'}
+        result = self.backup_monkey.wait_for_snapshots(timeout=60)
+        assert sorted(result.completed) == ['snap-1', 'snap-2']
+        assert self.inventory.pending_snapshot_ids() == []
+        assert [r.tags for r in sorted(self.inventory.snapshots())] == [{'Name': 'snap-1'}, {'Name': 'snap-2'}]
+        assert self.metrics.to_dict()['snapshot_completion_seconds'][0]['snapshots'] == 2
+        assert 'backup_monkey_snapshot_completion_seconds_count{region="us-west-2"} 2' in self.metrics.to_prometheus()
+
+    def test_failed(self):
+        self.conn.status = {'snap-1': 'completed', 'snap-2': 'error'}
+        self.assertRaises(BackupMonkeyException, self.backup_monkey.wait_for_snapshots, timeout=60)
+        assert [r.id for r in self.inventory.snapshots()] == ['snap-1']
+
+    def test_nothing_created(self):
+        self.backup_monkey._created = []
+        assert self.backup_monkey.wait_for_snapshots() is None
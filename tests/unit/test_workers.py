@@ -0,0 +1,110 @@
+from unittest import TestCase
+import threading
+import mock
+from boto.exception import BotoServerError
+from backup_monkey.core import BackupMonkey
+from backup_monkey.workers import WorkerPool, Counters
+
+class WorkerPoolTest(TestCase):
+
+    def test_serial(self):
+        seen = []
+        count, elapsed = WorkerPool(1).run(seen.append, range(10))
+        assert count == 10
+        assert seen == range(10)
+
+    def test_concurrent(self):
+        seen = []
+        lock = threading.Lock()
+        def func(item):
+            with lock:
+                seen.append(item)
+        count, elapsed = WorkerPool(4).run(func, range(100))
+        assert count == 100
+        assert sorted(seen) == range(100)
+
+    def test_exception_aborts(self):
+        def func(item):
+            if item == 5:
+                raise ValueError('boom')
+        self.assertRaises(ValueError, WorkerPool(4).run, func, range(1000))
+
+    def test_counters(self):
+        counters = Counters()
+        WorkerPool(4).run(lambda i: counters.incr('items'), range(50))
+        assert counters.get('items') == 50
+        assert counters.get('missing') == 0
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id, day):
+        self.id = id
+        self.volume_id = volume_id
+        self.start_time = '2015-01-%02dT00:00:00.000Z' % day
+        self.description = 'BACKUP_MONKEY %s' % volume_id
+        self.status = 'completed'
+        self.tags = {}
+
+class MockResultSet(list):
+    next_token = None
+
+def error(code):
+    e = BotoServerError(400, 'Bad Request', code)
+    e.error_code = code
+    return e
+
+class MockEC2Connection(object):
+    ''' Ten snapshots of each of two volumes. snap-vol-1-01 is in use and
+    cannot be deleted, and the first delete of snap-vol-2-01 is throttled '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.two_in_flight = threading.Event()
+        self.active = 0
+        self.peak = 0
+        self.deleted = []
+        self.throttled = False
+
+    def get_list(self, action, params, markers, verb='GET'):
+        return MockResultSet(MockSnapshot('snap-%s-%02d' % (volume_id, day), volume_id, day)
+            for volume_id in ('vol-1', 'vol-2') for day in range(1, 11))
+
+    def delete_snapshot(self, snapshot_id):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            if self.active >= 2:
+                self.two_in_flight.set()
+        try:
+            # Wait for a second delete to be in flight at the same time
+            self.two_in_flight.wait(1)
+            with self.lock:
+                if snapshot_id == 'snap-vol-1-01':
+                    raise error('InvalidSnapshot.InUse')
+                if snapshot_id == 'snap-vol-2-01' and not self.throttled:
+                    self.throttled = True
+                    raise error('RequestLimitExceeded')
+                self.deleted.append(snapshot_id)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class ConcurrentDeleteTest(TestCase):
+
+    @mock.patch('backup_monkey.core.BackupMonkey._get_connection', side_effect=MockEC2Connection)
+    def setUp(self, mock):
+        self.backup_monkey = BackupMonkey('us-west-2', 3, [], False, None, None, 0, delete_workers=4)
+        self.backup_monkey._retry_policy.base_delay = 0.001
+        self.conn = self.backup_monkey._conn._conn
+
+    def test_deletes_on_several_workers(self):
+        with mock.patch.object(self.backup_monkey, '_info', wraps=self.backup_monkey._info) as info:
+            self.backup_monkey.remove_old_snapshots()
+        assert self.conn.peak >= 2
+        # The 3 newest of each volume are kept, and the one in use is left behind
+        expected = ['snap-%s-%02d' % (v, d) for v in ('vol-1', 'vol-2') for d in range(1, 8)]
+        expected.remove('snap-vol-1-01')
+        assert sorted(self.conn.deleted) == expected
+        summaries = [c[1]['subject'].sub for c in info.call_args_list
+            if str(c[1]['subject']).startswith('Deleted ')]
+        assert len(summaries) == 1
+        deleted, failed, retries, elapsed, rate, workers = summaries[0]
+        assert (deleted, failed, retries, workers) == ('13', '1', '1', '4')